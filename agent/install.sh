@@ -126,7 +126,8 @@ echo "Copying scripts..."
 find ./src -type f -name "*.py" -exec sed -i 's/\r$//' {} \;
 cp ./src/__main__.py "$INSTALL_DIR/"
 cp ./src/uninstall.sh "$INSTALL_DIR/"
-cp -r ./src/modules/* "$MOD_DIR/"
+# -L: modules/websocket.py is a symlink to the module shared with the API server
+cp -rL ./src/modules/* "$MOD_DIR/"
 chmod +x "$INSTALL_DIR/__main__.py" "$INSTALL_DIR/uninstall.sh"
 
 # Virtual env setup
@@ -1,38 +1,119 @@
 import os
 import subprocess
 import time
-from typing import Optional, Dict, Any
+import psutil
+from typing import Optional, Dict, Any, List
 from .register import ServerRegister
 from .vnc import PortManager, VNCSession
+from .profiles import X11Capabilities, resolve_profile
+from .bridge import WebSocketBridge
+from .recording import RecordingStore
+from .telemetry import TelemetryCollector
 
 
 class Agent:
     """Класс агента для регистрации"""
 
+    # Процессы виртуальных X-серверов, сессии которых обслуживаются в многосессионном режиме
+    VIRTUAL_X_SERVERS = ('Xvfb',)
+    # Сколько проверок подряд без единой сессии нужно, чтобы остановить VNC и снять хост с регистрации:
+    # одиночный пустой результат бывает при сбое loginctl, а не при выходе пользователя
+    EMPTY_SCANS_LIMIT = 2
+
     def __init__(self, logger, config: Dict[str, Any]):
         self.logger = logger
         self.config = config
-        self.server_register = ServerRegister(logger)
-
         self.vnc_config = config.get('VNC', {})
+        self.vnc_profile = resolve_profile(self.vnc_config, logger)
+        self.vnc_binary_options = X11Capabilities.probe_binary(
+            self.vnc_config.get('VNC_BINARY', '/usr/bin/x11vnc'))
+        if self.vnc_binary_options is None:
+            self.logger.warning("Unable to detect x11vnc options, profile is applied without checks")
 
-        self.vnc_session = VNCSession(
-            logger,
-            self.vnc_config.get('VNC_BINARY', '/usr/bin/x11vnc'),
-            self.vnc_config.get('WEBSOCKIFY_BINARY', '/usr/bin/websockify'),
-            self.vnc_config.get('ADMIN_PASS', 'password'),
-            self.vnc_config.get('VIEW_ONLY_PASS', 'password')
-        )
+        # Сессии, подключения к которым записываются: имена пользователей, дисплеи или '*'
+        self.RECORD_SESSIONS = [str(s) for s in self.vnc_config.get('RECORD_SESSIONS') or []]
+
+        # Один встроенный мост на все сессии хоста, если websockify не используется
+        self.bridge = None
+        if self.vnc_config.get('BRIDGE', 'websockify') == 'builtin':
+            self.bridge = WebSocketBridge(
+                logger, self.vnc_config.get('NOVNC_WEB_DIR', '/usr/share/novnc'),
+                recordings=self.create_recording_store(), playback_token=str(self.config.get("API_AUTH_TOKEN")))
+            playback_port = int(self.vnc_config.get('RECORDING_PLAYBACK_PORT', 0))
+            if self.bridge.recordings is not None and playback_port:
+                self.bridge.add_playback_listener(playback_port)
+        elif self.RECORD_SESSIONS:
+            self.logger.warning("Session recording requires BRIDGE: builtin, sessions are not recorded")
 
-        self.SERVER_API_URL = self.build_api_url()
+        # Запущенные VNC-сессии по идентификатору сессии
+        self.vnc_sessions: Dict[str, VNCSession] = {}
+
+        self.SERVER_API_URLS = self.build_api_urls('register')
+        self.TELEMETRY_API_URLS = self.build_api_urls('telemetry')
         self.API_AUTH_TOKEN = str(self.config.get("API_AUTH_TOKEN"))
         self.SCAN_INTERVAL = int(self.config.get('SCAN_INTERVAL', 30))
         self.RETRY_INTERVAL = int(self.config.get('RETRY_INTERVAL', 60))
+        self.MULTI_SESSION = bool(self.config.get('MULTI_SESSION', False))
+        self.SUPERVISE_INTERVAL = int(self.config.get('SUPERVISE_INTERVAL', 5))
+        self.TELEMETRY_INTERVAL = int(self.config.get('TELEMETRY_INTERVAL', 30))
+
+        self.server_register = ServerRegister(logger, backoff_max=self.RETRY_INTERVAL)
+
+        # Замеры нагрузки для регистрации и heartbeat (TELEMETRY_INTERVAL: 0 - не отправляются)
+        self.telemetry = TelemetryCollector(self.bridge) if self.TELEMETRY_INTERVAL > 0 else None
+        self.next_heartbeat = time.monotonic() + self.TELEMETRY_INTERVAL
+
+        # Зарегистрированное состояние устарело и должно быть поставлено в очередь
+        self.pending_registration = False
+        self.ip: Optional[str] = None
+        # Проверок подряд, не нашедших ни одной графической сессии
+        self.empty_scans = 0
+
+    def build_api_urls(self, endpoint: str) -> List[str]:
+        """Получить URL метода /api/servers/<endpoint> на каждом узле API (SERVER_IP - адрес или список адресов)"""
+        servers = self.config.get('SERVER_IP', 'localhost:8080')
+        if isinstance(servers, str):
+            servers = servers.split(',')
+        return [f"http://{str(server).strip()}/api/servers/{endpoint}" for server in servers if str(server).strip()]
+
+    def create_recording_store(self) -> Optional[RecordingStore]:
+        """Хранилище записей сессий, если заданы RECORD_SESSIONS"""
+        if not self.RECORD_SESSIONS:
+            return None
+        try:
+            return RecordingStore(
+                self.logger,
+                self.vnc_config.get('RECORDING_DIR', '/opt/vnc-rm-agent/recordings'),
+                segment_size=int(self.vnc_config.get('RECORDING_SEGMENT_SIZE', 64)) * 1024 * 1024,
+                keyframe_interval=float(self.vnc_config.get('RECORDING_KEYFRAME_INTERVAL', 30)),
+                max_size=int(self.vnc_config.get('RECORDING_MAX_SIZE', 10240)) * 1024 * 1024,
+                queue_size=int(self.vnc_config.get('RECORDING_QUEUE_SIZE', 32)) * 1024 * 1024
+            )
+        except OSError as e:
+            self.logger.error(f"Session recording disabled: {e}")
+            return None
 
-    def build_api_url(self) -> str:
-        """Получить URL для регистрации сервера"""
-        server_ip = self.config.get('SERVER_IP', 'localhost:8080')
-        return f"http://{server_ip}/api/servers/register"
+    def recording_name(self, session: Dict[str, str]) -> Optional[str]:
+        """Имя записи для графической сессии или None, если сессия не записывается"""
+        if self.bridge is None or self.bridge.recordings is None:
+            return None
+        for pattern in self.RECORD_SESSIONS:
+            if pattern in ('*', session['display']) or pattern.lower() == session['username'].lower():
+                return f"{session['username']}-{session['display'].lstrip(':')}"
+        return None
+
+    def create_vnc_session(self) -> VNCSession:
+        """Создать VNC-сессию с параметрами из конфигурации"""
+        return VNCSession(
+            self.logger,
+            self.vnc_config.get('VNC_BINARY', '/usr/bin/x11vnc'),
+            self.vnc_config.get('WEBSOCKIFY_BINARY', '/usr/bin/websockify'),
+            self.vnc_config.get('ADMIN_PASS', 'password'),
+            self.vnc_config.get('VIEW_ONLY_PASS', 'password'),
+            profile=self.vnc_profile,
+            binary_options=self.vnc_binary_options,
+            bridge=self.bridge
+        )
 
     def get_current_user(self) -> Optional[str]:
         """Получить имя пользователя активной сессии"""
@@ -64,6 +145,82 @@ class Agent:
             self.logger.error(f"Unexpected error: {e}")
             return None
 
+    def get_logind_sessions(self) -> List[Dict[str, str]]:
+        """Получить графические X11-сессии из systemd-logind"""
+        sessions = []
+        try:
+            ids = subprocess.run(
+                ["loginctl", "list-sessions", "--no-legend"],
+                check=True,
+                capture_output=True,
+                text=True
+            ).stdout.split('\n')
+        except (subprocess.CalledProcessError, OSError) as e:
+            self.logger.error(f"Unable to list logind sessions: {e}")
+            return sessions
+
+        for line in ids:
+            parts = line.split()
+            if not parts:
+                continue
+            try:
+                output = subprocess.run(
+                    ["loginctl", "show-session", parts[0],
+                     "-p", "Name", "-p", "Display", "-p", "Type", "-p", "State"],
+                    check=True,
+                    capture_output=True,
+                    text=True
+                ).stdout
+            except (subprocess.CalledProcessError, OSError) as e:
+                self.logger.warning(f"Unable to inspect session {parts[0]}: {e}")
+                continue
+
+            props = dict(row.split('=', 1) for row in output.splitlines() if '=' in row)
+            if (props.get('Type') == 'x11' and props.get('Display')
+                    and props.get('Name') and props.get('State') in ('active', 'online')):
+                sessions.append({
+                    'session': props['Display'],
+                    'username': props['Name'],
+                    'display': props['Display']
+                })
+        return sessions
+
+    def get_virtual_sessions(self) -> List[Dict[str, str]]:
+        """Получить сессии виртуальных X-серверов (Xvfb)"""
+        sessions = []
+        for proc in psutil.process_iter(['name', 'cmdline', 'username']):
+            try:
+                if proc.info['name'] not in self.VIRTUAL_X_SERVERS:
+                    continue
+                display = next((arg for arg in proc.info['cmdline'] or [] if arg.startswith(':')), None)
+                if display and proc.info['username']:
+                    sessions.append({
+                        'session': display,
+                        'username': proc.info['username'],
+                        'display': display
+                    })
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return sessions
+
+    def get_sessions(self) -> List[Dict[str, str]]:
+        """
+        Получить графические сессии, для которых нужно поднять VNC.
+        Returns:
+            Список словарей с ключами 'session', 'username' и 'display'
+        """
+        if not self.MULTI_SESSION:
+            username = self.get_current_user()
+            if not username:
+                return []
+            display = PortManager.get_current_display(username)
+            return [{'session': display, 'username': username, 'display': display}]
+
+        sessions = {}
+        for session in self.get_logind_sessions() + self.get_virtual_sessions():
+            sessions.setdefault(session['session'], session)
+        return list(sessions.values())
+
     def get_ip_address(self) -> Optional[str]:
         """Получить основной IPv4-адрес агента"""
         try:
@@ -88,66 +245,183 @@ class Agent:
             self.logger.error(f"Unable to check directory: {e}")
             return False
 
-    def register_agent(self, username, ip, ws_port) -> bool:
-        """Регистрация агента с информацией о портах"""
+    def start_session(self, session: Dict[str, str]) -> bool:
+        """Запуск VNC для одной графической сессии"""
+        username = session['username']
+        if not self.is_home_exist(username):
+            self.logger.warning(f"Home directory not found for {username}, session {session['session']} skipped")
+            return False
 
-        if not ip or not username:
-            self.logger.warning("Registration skipped - missing IP or username")
+        vnc_session = self.create_vnc_session()
+        try:
+            ports = PortManager.calculate_ports(self.vnc_config)
+        except Exception as e:
+            self.logger.error(f"VNC startup error: {e}")
             return False
 
-        result = self.server_register.register_server(
-            server_api_url=self.SERVER_API_URL,
-            ip=ip,
-            username=username,
-            websockify_port=ws_port,
-            auth_token=self.API_AUTH_TOKEN
-        )
+        self.logger.debug(f"Using display: {session['display']}")
+        if not vnc_session.start(username, session['display'], ports['vnc'], ports['web'],
+                                 recording=self.recording_name(session)):
+            self.logger.warning(f"VNC start failed for session {session['session']}")
+            return False
+
+        self.vnc_sessions[session['session']] = vnc_session
+        return True
 
-        if result is None:
+    def stop_session(self, session_id: str) -> None:
+        """Остановка VNC для графической сессии"""
+        vnc_session = self.vnc_sessions.pop(session_id, None)
+        if vnc_session:
+            vnc_session.stop()
+
+    def sync_sessions(self, sessions: List[Dict[str, str]]) -> bool:
+        """
+        Привести запущенные VNC-сессии в соответствие с найденными графическими сессиями.
+        Args:
+            sessions: Результат get_sessions
+        Returns:
+            True, если набор VNC-сессий изменился
+        """
+        changed = False
+        if sessions:
+            self.empty_scans = 0
+        elif self.vnc_sessions:
+            self.empty_scans += 1
+            if self.empty_scans < self.EMPTY_SCANS_LIMIT:
+                self.logger.warning("No graphical sessions found, keeping running sessions until the next scan")
+                return False
+            self.logger.info("No graphical sessions found again, stopping VNC and deregistering sessions")
+        current = {s['session']: s for s in sessions}
+
+        for session_id in list(self.vnc_sessions):
+            vnc_session = self.vnc_sessions[session_id]
+            session = current.get(session_id)
+            if session is None or session['username'].lower() != vnc_session.username.lower():
+                self.logger.info(f"Session {session_id} of {vnc_session.username} ended")
+                self.stop_session(session_id)
+                changed = True
+
+        for session_id, session in current.items():
+            if session_id not in self.vnc_sessions and self.start_session(session):
+                changed = True
+        return changed
+
+    def build_sessions_payload(self) -> List[Dict[str, Any]]:
+        """Данные запущенных сессий для регистрации"""
+        return [
+            {
+                'session': session_id,
+                'username': vnc_session.username,
+                'vnc_port': vnc_session.vnc_port,
+                'websockify_port': vnc_session.websockify_port,
+                'processes': vnc_session.stats()
+            }
+            for session_id, vnc_session in sorted(self.vnc_sessions.items())
+        ]
+
+    def register_agent(self, ip) -> bool:
+        """Постановка в очередь регистрации агента со всеми запущенными сессиями"""
+
+        if not ip:
+            self.logger.warning("Registration skipped - missing IP")
             return False
 
-        self.logger.debug(f"Registration result: {result}")
+        self.server_register.submit(
+            server_api_urls=self.SERVER_API_URLS,
+            ip=ip,
+            sessions=self.build_sessions_payload(),
+            auth_token=self.API_AUTH_TOKEN,
+            telemetry=self.collect_telemetry()
+        )
         return True
 
+    def collect_telemetry(self) -> Optional[Dict[str, Any]]:
+        """Замер нагрузки хоста и VNC-процессов (None, если замеры отключены или не удались)"""
+        if self.telemetry is None:
+            return None
+        try:
+            return self.telemetry.collect(self.vnc_sessions)
+        except Exception as e:
+            self.logger.error(f"Telemetry collection error: {e}")
+            return None
+
+    def heartbeat(self) -> None:
+        """Отправка замера нагрузки каждые TELEMETRY_INTERVAL секунд"""
+        if self.telemetry is None or not self.ip or time.monotonic() < self.next_heartbeat:
+            return
+        self.next_heartbeat = time.monotonic() + self.TELEMETRY_INTERVAL
+        telemetry = self.collect_telemetry()
+        if telemetry is not None:
+            self.server_register.send_heartbeat(self.TELEMETRY_API_URLS, self.ip, telemetry, self.API_AUTH_TOKEN)
+
+    def deliver_registration(self) -> None:
+        """Отправка регистрации из очереди, если подошло время очередной попытки"""
+        result = self.server_register.flush()
+        if result is not None:
+            self.logger.debug(f"Registration result: {result}")
+            self.logger.info(f"Agent successfully registered with {len(self.vnc_sessions)} session(s)")
+
+    def supervise(self) -> None:
+        """Проверка дочерних процессов всех сессий"""
+        for session_id, vnc_session in self.vnc_sessions.items():
+            try:
+                if vnc_session.supervise():
+                    self.logger.info(
+                        f"Ports of session {session_id} changed to VNC {vnc_session.vnc_port}, "
+                        f"WS {vnc_session.websockify_port}")
+                    self.pending_registration = True
+            except Exception as e:
+                self.logger.error(f"Supervision error for session {session_id}: {e}")
+
+    def wait(self, seconds: int) -> None:
+        """
+        Пауза основного цикла с проверкой дочерних процессов каждые SUPERVISE_INTERVAL секунд
+        и доставкой отложенной регистрации, как только подходит время попытки
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            step = min(self.SUPERVISE_INTERVAL, remaining)
+            if self.server_register.has_pending:
+                step = min(step, self.server_register.seconds_until_retry())
+            if self.telemetry is not None:
+                step = min(step, max(0.0, self.next_heartbeat - time.monotonic()))
+            time.sleep(step)
+            self.supervise()
+            if self.pending_registration and self.register_agent(self.ip):
+                self.pending_registration = False
+            self.deliver_registration()
+            self.heartbeat()
+
+    def log_process_stats(self) -> None:
+        """Вывод в лог перезапусков и времени работы дочерних процессов"""
+        for session_id, vnc_session in self.vnc_sessions.items():
+            stats = ", ".join(
+                f"{name}: {s['restarts']} restarts, up {s['uptime']}s" for name, s in vnc_session.stats().items()
+            )
+            self.logger.debug(f"Session {session_id} processes - {stats}")
+
     def run(self) -> None:
         """Основной цикл работы агента"""
-        self.logger.info("Starting agent with VNC management")
-        last_user = ""
+        self.logger.info(f"Starting agent with VNC management (multi-session: {self.MULTI_SESSION})")
         while True:
             try:
-                username = self.get_current_user()
-                ip = self.get_ip_address()
-                if username and ip and username.lower() != last_user.lower():
-                    if self.is_home_exist(username):
-                        self.vnc_session.stop()
-                        try:
-                            vnc_display = PortManager.get_current_display(username)
-                            ports = PortManager.calculate_ports(self.vnc_config)
-                            self.logger.debug(f"Using display: {vnc_display}")
-                            max_retries = 5  # Максимальное количество попыток запуска vnc
-                            for attempt in range(1, max_retries + 1):
-                                if self.vnc_session.start(username, vnc_display, ports['vnc'], ports['web']):
-                                    if self.register_agent(username, ip, ports['web']):
-                                        last_user = username.lower()
-                                        self.logger.info(f"Agent successfully registered for user {username}")
-                                        time.sleep(self.SCAN_INTERVAL)
-                                        break  # Успех, выходим из цикла
-                                    self.logger.warning("Registration failed, retrying...")
-                                else:
-                                    self.logger.warning(f"VNC start failed, attempt {attempt}/{max_retries}")
-                                # Ждем перед следующей попыткой (кроме случая успешного завершения)
-                                if attempt < max_retries:  # Не ждем после последней попытки
-                                    time.sleep(self.RETRY_INTERVAL)
-                            else:  # Этот блок выполнится, если цикл не был прерван break
-                                self.logger.error(f"Failed to start VNC after {max_retries} attempts")
-                                time.sleep(self.RETRY_INTERVAL)
-                        except Exception as e:
-                            self.logger.error(f"VNC startup error: {e}")
-                            time.sleep(self.RETRY_INTERVAL)
-                    else:
-                        time.sleep(self.RETRY_INTERVAL)
+                sessions = self.get_sessions()
+                self.ip = self.get_ip_address()
+                if self.sync_sessions(sessions):
+                    self.pending_registration = True
+
+                if self.pending_registration and self.register_agent(self.ip):
+                    self.pending_registration = False
+                self.deliver_registration()
+
+                self.log_process_stats()
+                if len(self.vnc_sessions) < len(sessions):
+                    self.wait(self.RETRY_INTERVAL)
                 else:
-                    time.sleep(self.SCAN_INTERVAL)
+                    self.wait(self.SCAN_INTERVAL)
             except Exception as e:
                 self.logger.exception(f"Critical error in agent loop: {e}")
                 time.sleep(self.RETRY_INTERVAL)
@@ -0,0 +1,555 @@
+import asyncio
+import hmac
+import json
+import mimetypes
+import os
+import struct
+import threading
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs, urlparse, unquote
+from .recording import RecordingStore
+from .websocket import (
+    OP_BINARY, OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, OP_TEXT, ws_accept_response, ws_frame_header, ws_unmask
+)
+
+
+# Размер переиспользуемого буфера чтения из VNC-сервера
+UPSTREAM_BUFFER_SIZE = 256 * 1024
+# Минимальное свободное место в буфере чтения: при записи сессии буфер заполняется кусками подряд
+UPSTREAM_MIN_READ = 64 * 1024
+# Максимальный размер заголовков HTTP-запроса и кадра от браузера
+MAX_REQUEST_SIZE = 64 * 1024
+MAX_CLIENT_FRAME = 1024 * 1024
+
+
+class ListenerStats:
+    """Счётчики трафика одного порта моста"""
+
+    __slots__ = ("clients", "connections", "bytes_down", "bytes_up")
+
+    def __init__(self):
+        self.clients = 0
+        self.connections = 0
+        self.bytes_down = 0
+        self.bytes_up = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class UpstreamProtocol(asyncio.BufferedProtocol):
+    """
+    Соединение с VNC-сервером: данные читаются в один переиспользуемый буфер.
+    Куски записываемой сессии остаются в буфере до потока записи: чтение продолжается за ними,
+    а заполненный буфер возвращается в пул записи и заменяется буфером из пула.
+    """
+
+    def __init__(self, client: "ClientProtocol"):
+        self.client = client
+        self.buffer = bytearray(UPSTREAM_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.view[self.pos:]
+
+    def buffer_updated(self, nbytes):
+        # Буфер переиспользуется только после полной отправки кадра клиенту:
+        # при любой задержке записи клиент приостанавливает чтение отсюда
+        chunk = self.view[self.pos:self.pos + nbytes]
+        self.client.send_frame(OP_BINARY, chunk)
+        recorder = self.client.recorder
+        if recorder is not None and recorder.server_data(chunk):
+            self.pos += nbytes
+            if len(self.buffer) - self.pos < UPSTREAM_MIN_READ:
+                self._swap_buffer(recorder.store.writer)
+
+    def _swap_buffer(self, writer) -> None:
+        writer.release_buffer(self.buffer)
+        self.buffer = writer.take_buffer(UPSTREAM_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+
+    def connection_lost(self, exc):
+        self.client.upstream_closed()
+
+    def pause_writing(self):
+        self.client.transport.pause_reading()
+
+    def resume_writing(self):
+        self.client.transport.resume_reading()
+
+
+class ClientProtocol(asyncio.Protocol):
+    """Соединение браузера: статические файлы noVNC или WebSocket-прокси к VNC"""
+
+    def __init__(self, bridge: "WebSocketBridge", listen_port: int):
+        self.bridge = bridge
+        self.listen_port = listen_port
+        # None - порт уже закрыт remove_listener, а соединение принято до закрытия сервера
+        self.stats = bridge.stats.get(listen_port)
+        self.transport = None
+        self.upstream: Optional[UpstreamProtocol] = None
+        self.recorder = None
+        self.data = bytearray()
+        self.websocket = False
+        self.connected = False
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.stats is None:
+            transport.close()
+            return
+        self.bridge.clients.setdefault(self.listen_port, set()).add(self)
+
+    def data_received(self, data):
+        self.data += data
+        if self.websocket:
+            self._parse_frames()
+        elif b"\r\n\r\n" in self.data:
+            self._handle_request()
+        elif len(self.data) > MAX_REQUEST_SIZE:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.bridge.clients.get(self.listen_port, set()).discard(self)
+        if self.websocket:
+            self.stats.clients -= 1
+        if self.upstream and self.upstream.transport:
+            self.upstream.transport.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # Обработка HTTP
+
+    def _handle_request(self):
+        head, _, rest = bytes(self.data).partition(b"\r\n\r\n")
+        self.data = bytearray(rest)
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            self._http_error(400, "Bad Request")
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("upgrade", "").lower() == "websocket":
+            self._accept_websocket(headers, target)
+        elif method in ("GET", "HEAD"):
+            self._serve_file(target, method == "HEAD")
+        else:
+            self._http_error(405, "Method Not Allowed")
+
+    def _http_error(self, code: int, reason: str):
+        body = reason.encode()
+        self.transport.write(
+            f"HTTP/1.1 {code} {reason}\r\nContent-Type: text/plain\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        self.transport.close()
+
+    def _serve_file(self, target: str, head_only: bool):
+        path = unquote(urlparse(target).path).lstrip("/") or "vnc.html"
+        content = self.bridge.read_static(path)
+        if content is None:
+            self._http_error(404, "Not Found")
+            return
+        self._http_response(mimetypes.guess_type(path)[0] or "application/octet-stream", content, head_only)
+
+    def _http_response(self, ctype: str, content: bytes, head_only: bool):
+        self.transport.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: {ctype}\r\nContent-Length: {len(content)}\r\n"
+            f"Connection: close\r\n\r\n".encode())
+        if not head_only:
+            self.transport.write(content)
+        self.transport.close()
+
+    # Обработка WebSocket
+
+    def _accept_websocket(self, headers: Dict[str, str], target: str):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            self._http_error(400, "Bad Request")
+            return
+        self.transport.write(ws_accept_response(key, headers))
+
+        self.websocket = True
+        self.stats.clients += 1
+        self.stats.connections += 1
+        # Запись в браузер сигнализирует о задержке при любом неотправленном байте
+        self.transport.set_write_buffer_limits(high=0, low=0)
+        self.transport.pause_reading()
+        self.bridge.loop.create_task(self._connect_upstream(target))
+
+    async def _connect_upstream(self, target: str):
+        loop = self.bridge.loop
+        vnc_port = self.bridge.listeners.get(self.listen_port)
+        # Запись создаётся до подключения: приветствие сервера может прийти раньше возврата из create_connection
+        self.recorder = self.bridge.open_recording(self.listen_port, self._send_upstream)
+        try:
+            if vnc_port is None:
+                raise ConnectionRefusedError("listener removed")
+            _, self.upstream = await loop.create_connection(
+                lambda: UpstreamProtocol(self), "127.0.0.1", vnc_port)
+        except OSError as e:
+            self.bridge.logger.warning(f"Bridge {self.listen_port}: VNC connection failed: {e}")
+            self.close(1011)
+            return
+        if self.transport.is_closing():
+            self.upstream.transport.close()
+            return
+        self.connected = True
+        self.transport.resume_reading()
+        if self.data:
+            self._parse_frames()
+
+    def _parse_frames(self):
+        if not self.connected:
+            return
+        data = self.data
+        offset = 0
+        while len(data) - offset >= 2:
+            b1, b2 = data[offset], data[offset + 1]
+            opcode = b1 & 0x0F
+            length = b2 & 0x7F
+            pos = offset + 2
+            if length == 126:
+                if len(data) - pos < 2:
+                    break
+                length = struct.unpack_from("!H", data, pos)[0]
+                pos += 2
+            elif length == 127:
+                if len(data) - pos < 8:
+                    break
+                length = struct.unpack_from("!Q", data, pos)[0]
+                pos += 8
+            if not b2 & 0x80 or length > MAX_CLIENT_FRAME:
+                self.close(1002)
+                return
+            if len(data) - pos < 4 + length:
+                break
+            mask = bytes(data[pos:pos + 4])
+            payload = ws_unmask(memoryview(data)[pos + 4:pos + 4 + length], mask)
+            offset = pos + 4 + length
+
+            if opcode in (OP_BINARY, OP_CONTINUATION):
+                self.stats.bytes_up += len(payload)
+                self.forward(payload)
+            elif opcode == OP_PING:
+                self.send_frame(OP_PONG, payload)
+            elif opcode == OP_CLOSE:
+                self.close(1000)
+                return
+            elif opcode == OP_TEXT:
+                # Текстовый (base64) протокол старых версий noVNC не поддерживается
+                self.close(1003)
+                return
+        del data[:offset]
+
+    def _send_upstream(self, data: bytes):
+        if self.upstream and self.upstream.transport:
+            self.upstream.transport.write(data)
+
+    def forward(self, payload: bytes):
+        """Данные браузера для VNC-сервера (у записываемой сессии - через фильтр записи)"""
+        if self.recorder is not None:
+            payload = self.recorder.client_data(payload)
+        if payload:
+            self.upstream.transport.write(payload)
+
+    def send_frame(self, opcode: int, payload):
+        if self.transport.is_closing():
+            return
+        self.transport.write(ws_frame_header(opcode, len(payload)))
+        self.transport.write(payload)
+        if opcode == OP_BINARY:
+            self.stats.bytes_down += len(payload)
+
+    def pause_writing(self):
+        if self.upstream and self.upstream.transport:
+            self.upstream.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.upstream and self.upstream.transport:
+            self.upstream.transport.resume_reading()
+
+    def upstream_closed(self):
+        self.close(1000)
+
+    def close(self, code: int):
+        if self.closing:
+            return
+        self.closing = True
+        if not self.transport.is_closing():
+            self.send_frame(OP_CLOSE, struct.pack("!H", code))
+            self.transport.close()
+
+
+class PlaybackProtocol(ClientProtocol):
+    """
+    Воспроизведение записей сессий: файлы noVNC, список записей /recordings и WebSocket
+    /playback?recording=<id>&t=<сек>&speed=<множитель>. Доступ проверяется параметром token,
+    поэтому зрителю предлагается RFB без пароля. Сообщения зрителя после рукопожатия не нужны и отбрасываются.
+    """
+
+    # Пауза (сек) перед повторным чтением идущей записи, воспроизведение которой догнало запись
+    FOLLOW_INTERVAL = 0.5
+
+    def __init__(self, bridge: "WebSocketBridge", listen_port: int):
+        super().__init__(bridge, listen_port)
+        self.incoming = bytearray()
+        self.received = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.handshaken = False
+        self.player: Optional[asyncio.Task] = None
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.player:
+            self.player.cancel()
+
+    def _authorized(self, target: str) -> bool:
+        token = parse_qs(urlparse(target).query).get("token", [""])[0]
+        return hmac.compare_digest(token.encode(), self.bridge.playback_token.encode())
+
+    def _serve_file(self, target: str, head_only: bool):
+        if unquote(urlparse(target).path).strip("/") != "recordings":
+            super()._serve_file(target, head_only)
+        elif not self._authorized(target):
+            self._http_error(403, "Forbidden")
+        else:
+            content = json.dumps(self.bridge.recordings.list()).encode()
+            self._http_response("application/json", content, head_only)
+
+    def _accept_websocket(self, headers: Dict[str, str], target: str):
+        if not self._authorized(target):
+            self._http_error(403, "Forbidden")
+            return
+        super()._accept_websocket(headers, target)
+
+    async def _connect_upstream(self, target: str):
+        params = parse_qs(urlparse(target).query)
+        try:
+            start = float(params.get("t", ["0"])[0])
+            speed = float(params.get("speed", ["1"])[0])
+        except ValueError:
+            start = speed = -1
+        reader = keyframe = None
+        if start >= 0 and speed > 0:
+            # Индекс и сегменты записи читаются с диска в пуле потоков, как и данные при воспроизведении
+            reader, keyframe = await self.bridge.loop.run_in_executor(
+                None, self._open_recording, params.get("recording", [""])[0], int(start * 1000))
+        if self.transport.is_closing():
+            return
+        if keyframe is None:
+            self.close(1008)
+            return
+        self.connected = True
+        self.transport.resume_reading()
+        if self.data:
+            self._parse_frames()
+        self.player = self.bridge.loop.create_task(self._play(reader, keyframe, int(start * 1000), speed))
+
+    def _open_recording(self, recording_id: str, start_ms: int):
+        """(чтение записи, ключевой кадр не позже start_ms); None вместо кадра - записи или кадров нет"""
+        reader = self.bridge.recordings.reader(recording_id)
+        return reader, reader.seek(start_ms) if reader else None
+
+    async def _play(self, reader, keyframe, start_ms: int, speed: float):
+        """Данные записи с ключевого кадра: до start_ms без пауз, дальше в темпе записи"""
+        loop = self.bridge.loop
+        await self._handshake(reader.server_init(keyframe[4], keyframe[5]))
+        # Файлы читаются в пуле потоков, чтобы чтение с диска не задерживало живые сессии моста
+        records = reader.server_data(keyframe)
+        began = loop.time()
+        while not self.closing:
+            item = await loop.run_in_executor(None, next, records, False)
+            if item is False:
+                break
+            if item is None:
+                if reader.meta["id"] not in self.bridge.recordings.active:
+                    break
+                await asyncio.sleep(self.FOLLOW_INTERVAL)
+                continue
+            ts, data = item
+            delay = began + (ts - start_ms) / 1000 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.writable.wait()
+            self.send_frame(OP_BINARY, data)
+        self.close(1000)
+
+    async def _read(self, size: int) -> bytes:
+        while len(self.incoming) < size:
+            self.received.clear()
+            await self.received.wait()
+        data = bytes(self.incoming[:size])
+        del self.incoming[:size]
+        return data
+
+    async def _handshake(self, server_init: bytes):
+        self.send_frame(OP_BINARY, b"RFB 003.008\n")
+        version = await self._read(12)
+        if version >= b"RFB 003.007\n":
+            self.send_frame(OP_BINARY, b"\x01\x01")  # один тип безопасности: None
+            await self._read(1)
+            if version >= b"RFB 003.008\n":
+                self.send_frame(OP_BINARY, b"\0\0\0\0")
+        else:
+            self.send_frame(OP_BINARY, struct.pack("!I", 1))
+        await self._read(1)  # ClientInit
+        self.send_frame(OP_BINARY, server_init)
+        self.handshaken = True
+
+    def forward(self, payload: bytes):
+        if not self.handshaken:
+            self.incoming += payload
+            self.received.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+class WebSocketBridge:
+    """
+    Встроенная замена websockify: один asyncio-цикл в отдельном потоке
+    обслуживает WebSocket-порты всех VNC-сессий хоста.
+    """
+
+    # Максимальный объём кешируемых статических файлов noVNC
+    STATIC_CACHE_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, logger, web_dir: str, recordings: Optional[RecordingStore] = None, playback_token: str = ""):
+        """
+        Args:
+            logger: Экземпляр Logger
+            web_dir: Каталог с файлами noVNC (vnc.html и др.)
+            recordings: Хранилище записей сессий или None, если запись не ведётся
+            playback_token: Токен доступа к порту воспроизведения записей
+        """
+        self.logger = logger
+        self.web_dir = os.path.realpath(web_dir)
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self.listeners: Dict[int, int] = {}  # порт WebSocket -> порт VNC
+        self.servers: Dict[int, asyncio.AbstractServer] = {}
+        self.stats: Dict[int, ListenerStats] = {}
+        self.clients: Dict[int, Set[ClientProtocol]] = {}
+        self.static_cache: Dict[str, bytes] = {}
+        self.static_cache_size = 0
+        self.recordings = recordings
+        self.playback_token = playback_token
+        self.recorded: Dict[int, str] = {}  # порт WebSocket -> имя записываемой сессии
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ws-bridge", daemon=True)
+        self.thread.start()
+        self.logger.info(f"WebSocket bridge started, serving noVNC from {self.web_dir}")
+
+    def read_static(self, path: str) -> Optional[bytes]:
+        """Чтение файла noVNC с кешированием; пути вне web_dir запрещены"""
+        content = self.static_cache.get(path)
+        if content is not None:
+            return content
+        full_path = os.path.realpath(os.path.join(self.web_dir, path))
+        if not full_path.startswith(self.web_dir + os.sep) or not os.path.isfile(full_path):
+            return None
+        try:
+            with open(full_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        if self.static_cache_size + len(content) <= self.STATIC_CACHE_LIMIT:
+            self.static_cache[path] = content
+            self.static_cache_size += len(content)
+        return content
+
+    def add_listener(self, listen_port: int, vnc_port: int, timeout: float = 5.0, record: Optional[str] = None) -> bool:
+        """Открыть WebSocket-порт, проксирующий на локальный VNC-порт (record - имя сессии для записи подключений)"""
+        self.start()
+
+        async def create():
+            server = await self.loop.create_server(
+                lambda: ClientProtocol(self, listen_port), host="", port=listen_port, reuse_address=True)
+            # Состояние порта заполняется только после успешного открытия: иначе его унаследует
+            # следующая сессия на этом порту. Подключения принимаются не раньше следующей итерации цикла
+            self.listeners[listen_port] = vnc_port
+            if record and self.recordings is not None:
+                self.recorded[listen_port] = record
+            self.stats[listen_port] = ListenerStats()
+            self.servers[listen_port] = server
+
+        future = asyncio.run_coroutine_threadsafe(create(), self.loop)
+        try:
+            future.result(timeout)
+            self.logger.info(f"Bridge listening on {listen_port} -> VNC {vnc_port}")
+            return True
+        except Exception as e:
+            future.cancel()
+            self.logger.error(f"Bridge failed to listen on {listen_port}: {e}")
+            return False
+
+    def remove_listener(self, listen_port: int, timeout: float = 5.0) -> None:
+        """Закрыть WebSocket-порт"""
+        async def close():
+            self.listeners.pop(listen_port, None)
+            self.recorded.pop(listen_port, None)
+            server = self.servers.pop(listen_port, None)
+            if server:
+                server.close()
+            for client in list(self.clients.pop(listen_port, ())):
+                client.close(1001)
+            self.stats.pop(listen_port, None)
+
+        try:
+            asyncio.run_coroutine_threadsafe(close(), self.loop).result(timeout)
+        except Exception as e:
+            self.logger.error(f"Bridge failed to close port {listen_port}: {e}")
+
+    def add_playback_listener(self, port: int, timeout: float = 5.0) -> bool:
+        """Открыть порт воспроизведения записей сессий"""
+        self.start()
+
+        async def create():
+            server = await self.loop.create_server(
+                lambda: PlaybackProtocol(self, port), host="", port=port, reuse_address=True)
+            self.stats[port] = ListenerStats()
+            self.servers[port] = server
+
+        future = asyncio.run_coroutine_threadsafe(create(), self.loop)
+        try:
+            future.result(timeout)
+            self.logger.info(f"Recording playback listening on {port}")
+            return True
+        except Exception as e:
+            future.cancel()
+            self.logger.error(f"Recording playback failed to listen on {port}: {e}")
+            return False
+
+    def open_recording(self, listen_port: int, send_upstream):
+        """Запись нового подключения к порту или None, если сессия порта не записывается"""
+        label = self.recorded.get(listen_port)
+        if label is None:
+            return None
+        return self.recordings.open(label, listen_port, send_upstream)
+
+    def is_listening(self, listen_port: int) -> bool:
+        server = self.servers.get(listen_port)
+        return bool(server and server.is_serving())
+
+    def get_stats(self, listen_port: int) -> Dict[str, int]:
+        stats = self.stats.get(listen_port)
+        return stats.to_dict() if stats else {}
@@ -0,0 +1,147 @@
+import re
+import subprocess
+from typing import Dict, Any, List, Optional, Set
+
+
+# Встроенные профили производительности x11vnc.
+#   xdamage  - опрос изменений экрана через расширение X DAMAGE
+#   shm      - чтение кадра через MIT-SHM
+#   ncache   - клиентский кеш окон (0 - выключен; noVNC его не поддерживает)
+#   threads  - отдельный поток кодирования для каждого клиента
+#   wait     - пауза между опросами экрана (мс)
+#   defer    - задержка отправки накопленных изменений (мс)
+#   scale    - максимальный масштаб кадра на стороне сервера (None - без масштабирования)
+VNC_PROFILES: Dict[str, Dict[str, Any]] = {
+    'grid-low': {
+        'xdamage': True, 'shm': True, 'ncache': 0, 'threads': False,
+        'wait': 100, 'defer': 100, 'scale': 0.5
+    },
+    'balanced': {
+        'xdamage': True, 'shm': True, 'ncache': 0, 'threads': True,
+        'wait': 30, 'defer': 30, 'scale': None
+    },
+    'interactive': {
+        'xdamage': True, 'shm': True, 'ncache': 0, 'threads': True,
+        'wait': 10, 'defer': 5, 'scale': None
+    },
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+
+def resolve_profile(vnc_config: Dict[str, Any], logger) -> Dict[str, Any]:
+    """
+    Выбор профиля по секции VNC конфигурации.
+    Профили из VNC.PROFILES дополняют или переопределяют встроенные.
+    Args:
+        vnc_config: секция VNC файла конфигурации
+        logger: Экземпляр Logger
+    Returns:
+        Параметры выбранного профиля
+    """
+    profiles = {name: dict(values) for name, values in VNC_PROFILES.items()}
+    for name, values in (vnc_config.get('PROFILES') or {}).items():
+        profiles.setdefault(name, dict(VNC_PROFILES[DEFAULT_PROFILE])).update(values or {})
+
+    name = vnc_config.get('PROFILE', DEFAULT_PROFILE)
+    if name not in profiles:
+        logger.warning(f"Unknown VNC profile '{name}', using '{DEFAULT_PROFILE}'")
+        name = DEFAULT_PROFILE
+    logger.info(f"Using VNC performance profile '{name}': {profiles[name]}")
+    return profiles[name]
+
+
+class X11Capabilities:
+    """Определение возможностей x11vnc и X-сервера"""
+
+    @staticmethod
+    def probe_binary(vnc_binary: str) -> Optional[Set[str]]:
+        """
+        Список опций, поддерживаемых установленным x11vnc.
+        Returns:
+            Множество опций вида '-ncache' или None, если определить не удалось
+        """
+        try:
+            output = subprocess.run(
+                [vnc_binary, '-opts'],
+                capture_output=True,
+                text=True,
+                timeout=10
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            return None
+        options = set(re.findall(r'^\s*(-[A-Za-z][\w-]*)', output, re.MULTILINE))
+        return options or None
+
+    @staticmethod
+    def probe_display(username: str, display: str) -> Optional[Set[str]]:
+        """
+        Расширения X-сервера на дисплее пользователя (через xdpyinfo).
+        Returns:
+            Множество имён расширений или None, если xdpyinfo недоступен
+        """
+        try:
+            output = subprocess.run(
+                ['sudo', '-u', str(username), 'env', f'DISPLAY={display}', 'xdpyinfo', '-queryExtensions'],
+                capture_output=True,
+                text=True,
+                check=True,
+                timeout=10
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+        extensions = set()
+        in_list = False
+        for line in output.splitlines():
+            if line.startswith('number of extensions'):
+                in_list = True
+                continue
+            if in_list:
+                if not line.startswith((' ', '\t')):
+                    break
+                extensions.add(line.split()[0])
+        return extensions
+
+
+def build_vnc_args(profile: Dict[str, Any], binary_options: Optional[Set[str]],
+                   extensions: Optional[Set[str]]) -> List[str]:
+    """
+    Аргументы x11vnc для профиля с учётом возможностей.
+    Неизвестные возможности (None) считаются доступными - x11vnc сам откатится при их отсутствии.
+    """
+    def supported(option: str) -> bool:
+        return binary_options is None or option in binary_options
+
+    def has_extension(name: str) -> bool:
+        return extensions is None or name in extensions
+
+    args = []
+    if profile.get('xdamage') and has_extension('DAMAGE'):
+        args.append('-xdamage')
+    elif supported('-noxdamage'):
+        args.append('-noxdamage')
+
+    if not profile.get('shm') or not has_extension('MIT-SHM'):
+        args.append('-noshm')
+
+    ncache = int(profile.get('ncache') or 0)
+    if ncache > 0 and supported('-ncache'):
+        args += ['-ncache', str(ncache)]
+
+    if profile.get('threads'):
+        if supported('-threads'):
+            args.append('-threads')
+    elif supported('-nothreads'):
+        args.append('-nothreads')
+
+    for option in ('wait', 'defer'):
+        value = profile.get(option)
+        if value is not None and supported(f'-{option}'):
+            args += [f'-{option}', str(int(value))]
+
+    scale = profile.get('scale')
+    if scale and float(scale) < 1 and supported('-scale'):
+        args += ['-scale', str(scale)]
+
+    return args
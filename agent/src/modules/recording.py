@@ -0,0 +1,864 @@
+import collections
+import itertools
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+# Формат записи: каталог <RECORDING_DIR>/<сессия>/<время>-<порт>-<номер>/ с файлами
+#   meta.json             - описание записи и ServerInit для воспроизведения
+#   segment-NNNNNN.rfbrec - сегменты: заголовок и записи (тип, мс от начала, длина, данные)
+#   index.bin             - ключевые кадры: записи фиксированного размера для поиска по времени
+SEGMENT_MAGIC = b"VNCREC01"
+SEGMENT_HEADER = struct.Struct("!8sIQ")     # сигнатура, номер сегмента, начало записи (мс epoch)
+RECORD_HEADER = struct.Struct("!BII")       # тип, мс от начала записи, длина данных
+INDEX_ENTRY = struct.Struct("!IIQIHH")      # мс, сегмент, смещение записи, смещение в данных, ширина, высота
+
+REC_SERVER = 0     # данные сервер -> клиент (как получены от VNC-сервера)
+REC_CLIENT = 1     # сообщения клиент -> сервер (ввод зрителя)
+REC_KEYFRAME = 2   # ключевой кадр, данные - INDEX_ENTRY (индекс можно восстановить по сегментам)
+REC_GAP = 3        # пропуск при переполнении очереди записи, данные - всего потерянных к этому моменту байт (!Q)
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.bin"
+SEGMENT_FILE = "segment-{:06d}.rfbrec"
+
+# Кодировки, которые разрешаются клиенту записываемой сессии. Tight, ZRLE и zlib-кодировки
+# сохраняют состояние zlib между кадрами, и воспроизведение с ключевого кадра было бы невозможно
+RECORDABLE_ENCODINGS = frozenset([
+    0, 1, 2, 5, -260,                    # Raw, CopyRect, RRE, Hextile, TightPNG
+    -223, -224, -232, -239, -240,        # DesktopSize, LastRect, PointerPos, Cursor, XCursor
+    -258, -261, -307, -308, -309,        # QEMU ExtendedKeyEvent и LED, DesktopName, ExtendedDesktopSize, xvp
+    -312, -313, -1063131698,             # Fence, ContinuousUpdates, ExtendedClipboard
+] + list(range(-32, -22)) + list(range(-256, -246)))  # уровни качества JPEG и сжатия
+
+# Размеры сообщений клиента с фиксированной длиной
+CLIENT_MESSAGE_SIZES = {0: 20, 3: 10, 4: 8, 5: 6, 150: 10, 250: 4}
+
+_READ, _SKIP, _MARK = 0, 1, 2
+_SAFE_NAME = re.compile(r"[^\w.-]")
+_RECORDING_ID = re.compile(r"^[\w.-]+/[\w.-]+$")
+
+
+class RfbServerStream:
+    """
+    Разбор потока RFB 3.8 от сервера без копирования данных: находит конец ServerInit,
+    начало каждого сообщения и обновления экрана, закрывающие весь экран (ключевые кадры).
+    Копируются только заголовки, данные прямоугольников пропускаются по длине.
+    """
+
+    def __init__(self, on_init: Callable[[int, bytes], None], on_message: Callable[[int], None],
+                 on_keyframe: Callable[[], None]):
+        """
+        Args:
+            on_init: Вызывается с позицией конца ServerInit в текущем куске и самим ServerInit
+            on_message: Вызывается с позицией начала сообщения в текущем куске
+            on_keyframe: Вызывается после обновления, закрывшего весь экран
+        """
+        self.on_init = on_init
+        self.on_message = on_message
+        self.on_keyframe = on_keyframe
+        # Выбранный клиентом тип безопасности и формат пикселей (задаются разбором потока клиента)
+        self.security: Optional[int] = None
+        self.pixel_format = b""
+        self.width = self.height = 0
+        self.error: Optional[str] = None
+        self.view = memoryview(b"")
+        self.pending = bytearray()
+        self._messages = self._parse()
+        self.request: Optional[Tuple[int, int]] = next(self._messages)
+
+    def feed(self, view: memoryview) -> None:
+        """Разбор очередного куска данных сервера"""
+        self.view = view
+        pos, end = 0, len(view)
+        while self.request is not None:
+            op, size = self.request
+            if op == _MARK:
+                if pos == end:
+                    return  # сообщение начнётся со следующего куска
+                self.on_message(pos)
+                self._next(None)
+            elif size == 0:
+                self._next(b"" if op == _READ else None, pos)
+            elif pos == end:
+                return
+            elif op == _SKIP:
+                step = min(size, end - pos)
+                pos += step
+                if step < size:
+                    self.request = (_SKIP, size - step)
+                else:
+                    self._next(None, pos)
+            else:
+                take = min(size - len(self.pending), end - pos)
+                self.pending += view[pos:pos + take]
+                pos += take
+                if len(self.pending) == size:
+                    data = bytes(self.pending)
+                    self.pending.clear()
+                    self._next(data, pos)
+
+    def _next(self, value, pos: int = 0) -> None:
+        self.pos = pos
+        try:
+            self.request = self._messages.send(value)
+        except (ValueError, StopIteration, struct.error) as e:
+            self.error = str(e) or "stream ended"
+            self.request = None
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        return max(self.pixel_format[0] // 8, 1) if self.pixel_format else 4
+
+    def _parse(self):
+        version = yield _READ, 12
+        if version != b"RFB 003.008\n":
+            raise ValueError(f"unsupported protocol version {version[:11]!r}")
+        count = (yield _READ, 1)[0]
+        if count == 0:
+            raise ValueError("connection refused by server")
+        yield _SKIP, count
+        # Выбор клиента известен к приходу следующих данных: сервер отвечает на него
+        first = yield _READ, 1
+        if self.security == 2:
+            yield _SKIP, 15  # остаток challenge VNC-аутентификации
+            result = yield _READ, 4
+        elif self.security == 1:
+            result = first + (yield _READ, 3)
+        else:
+            raise ValueError(f"unsupported security type {self.security}")
+        if result != b"\0\0\0\0":
+            raise ValueError("authentication failed")
+        head = yield _READ, 24
+        name = yield _READ, struct.unpack_from("!I", head, 20)[0]
+        self.width, self.height = struct.unpack_from("!HH", head)
+        self.pixel_format = head[4:20]
+        self.on_init(self.pos, head + name)
+
+        while True:
+            yield _MARK, 0
+            kind = (yield _READ, 1)[0]
+            if kind == 0:
+                yield from self._framebuffer_update()
+            elif kind == 1:  # SetColourMapEntries
+                yield _SKIP, 6 * struct.unpack_from("!H", (yield _READ, 5), 3)[0]
+            elif kind == 3:  # ServerCutText (отрицательная длина - расширенный буфер обмена)
+                yield _SKIP, abs(struct.unpack_from("!i", (yield _READ, 7), 3)[0])
+            elif kind == 248:  # ServerFence
+                yield _SKIP, (yield _READ, 8)[7]
+            elif kind == 250:  # xvp
+                yield _SKIP, 3
+            elif kind not in (2, 150):  # Bell, EndOfContinuousUpdates
+                raise ValueError(f"unknown server message {kind}")
+
+    def _framebuffer_update(self):
+        rects = struct.unpack_from("!H", (yield _READ, 3), 1)[0]
+        covered = 0
+        bpp = self.bytes_per_pixel
+        for _ in range(rects):
+            x, y, w, h, encoding = struct.unpack("!HHHHi", (yield _READ, 12))
+            if encoding == -224:  # LastRect
+                break
+            if encoding == 0:
+                yield _SKIP, w * h * bpp
+            elif encoding == 1:
+                yield _SKIP, 4
+            elif encoding == 2:
+                count = struct.unpack("!I", (yield _READ, 4))[0]
+                yield _SKIP, bpp + count * (bpp + 8)
+            elif encoding == 5:
+                yield from self._hextile(w, h, bpp)
+            elif encoding == -260:
+                yield from self._tight_png()
+            elif encoding == -239:
+                yield _SKIP, w * h * bpp + (w + 7) // 8 * h
+            elif encoding == -240:
+                yield _SKIP, 6 + (w + 7) // 8 * h * 2 if w * h else 0
+            elif encoding == -223:
+                self.width, self.height = w, h
+            elif encoding == -308:
+                yield _SKIP, 16 * (yield _READ, 4)[0]
+                if y == 0:
+                    self.width, self.height = w, h
+            elif encoding == -307:
+                yield _SKIP, struct.unpack("!I", (yield _READ, 4))[0]
+            elif encoding == -261:
+                yield _SKIP, 1
+            elif encoding not in (-232, -258):
+                raise ValueError(f"unknown encoding {encoding}")
+            if encoding in (0, 2, 5, -260):
+                covered += w * h
+        # Сервер не пересылает перекрывающиеся прямоугольники в одном обновлении
+        if covered >= self.width * self.height > 0:
+            self.on_keyframe()
+
+    def _hextile(self, w: int, h: int, bpp: int):
+        for ty in range(0, h, 16):
+            for tx in range(0, w, 16):
+                mask = (yield _READ, 1)[0]
+                if mask & 1:
+                    yield _SKIP, min(16, w - tx) * min(16, h - ty) * bpp
+                    continue
+                size = (bpp if mask & 2 else 0) + (bpp if mask & 4 else 0)
+                if mask & 8:
+                    yield _SKIP, size
+                    size = (yield _READ, 1)[0] * ((bpp if mask & 16 else 0) + 2)
+                yield _SKIP, size
+
+    def _tight_png(self):
+        control = (yield _READ, 1)[0] >> 4
+        if control == 8:  # заливка одним цветом
+            pf = self.pixel_format
+            yield _SKIP, 3 if pf and pf[0] == 32 and pf[1] == 24 and pf[3] else self.bytes_per_pixel
+            return
+        if control not in (9, 10):  # JPEG, PNG
+            raise ValueError(f"unexpected TightPNG control {control}")
+        length, shift = 0, 0
+        for _ in range(3):
+            byte = (yield _READ, 1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        yield _SKIP, length
+
+
+class RecordingWriter:
+    """
+    Поток записи файлов: цикл моста ставит операции с файлами записей в очередь и не ждёт диска.
+    Очередь принимает всё, а объём ожидающих данных сверяется с max_bytes: при переполнении
+    записывающий сам пропускает данные (см. SessionRecorder).
+    Данные сервера ставятся без копирования, срезами буферов чтения моста: мост берёт буферы
+    из пула и возвращает их через очередь, так что буфер снова попадает в пул только после записи
+    всех поставленных раньше данных.
+    """
+
+    def __init__(self, logger, max_bytes: int):
+        """
+        Args:
+            logger: Экземпляр Logger
+            max_bytes: Объём данных в очереди (байт), сверх которого очередь считается переполненной
+        """
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.queue: collections.deque = collections.deque()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.buffers: collections.deque = collections.deque()
+        self.thread = threading.Thread(target=self._run, name="recording-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, func: Callable, *args, size: int = 0) -> None:
+        """Постановка операции в очередь (size - объём её данных)"""
+        with self.condition:
+            self.pending += size
+            self.queue.append((func, args, size))
+            self.condition.notify()
+
+    def full(self) -> bool:
+        with self.condition:
+            return self.pending >= self.max_bytes
+
+    def take_buffer(self, size: int) -> bytearray:
+        """Буфер чтения из пула или новый"""
+        try:
+            buffer = self.buffers.pop()
+        except IndexError:
+            return bytearray(size)
+        return buffer if len(buffer) == size else bytearray(size)
+
+    def release_buffer(self, buffer: bytearray) -> None:
+        """Возврат буфера в пул после записи поставленных в очередь данных из него"""
+        self.put(self._pool_buffer, buffer)
+
+    def _pool_buffer(self, buffer: bytearray) -> None:
+        if len(self.buffers) * len(buffer) < self.max_bytes:
+            self.buffers.append(buffer)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                func, args, size = self.queue.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                self.logger.error(f"Recording writer error: {e}")
+            finally:
+                with self.condition:
+                    self.pending -= size
+
+
+class SessionRecorder:
+    """
+    Запись одного подключения к VNC-серверу. Мост передаёт сюда те же куски данных, что отправляет
+    браузеру: срезы буфера чтения без копирования уходят в очередь потока записи и пишутся в сегмент
+    одним writev вместе с заголовком записи. Если к началу очередного сообщения сервера очередь переполнена, сообщения
+    не записываются, пока она не освободится: пропуск приходится на границы сообщений, поэтому
+    записанный поток остаётся корректным RFB. Пропуск отмечается записью REC_GAP и в описании,
+    а у сервера сразу запрашивается ключевой кадр.
+    Раз в keyframe_interval секунд при изменениях экрана у сервера запрашивается полное обновление,
+    и его начало заносится в индекс, чтобы воспроизведение начиналось с любого момента.
+    Методы с суффиксом _file выполняются в потоке записи, остальные - в потоке цикла моста.
+    """
+
+    def __init__(self, store: "RecordingStore", recording_id: str, label: str, listen_port: int,
+                 send_upstream: Callable[[bytes], None]):
+        """
+        Args:
+            store: Хранилище записей
+            recording_id: Идентификатор записи ('<сессия>/<время>-<порт>-<номер>')
+            label: Имя записываемой сессии
+            listen_port: WebSocket-порт моста
+            send_upstream: Отправка данных VNC-серверу (запрос ключевых кадров)
+        """
+        self.store = store
+        self.id = recording_id
+        self.path = os.path.join(store.root, recording_id)
+        self.send_upstream = send_upstream
+        self.meta: Dict[str, Any] = {"id": recording_id, "session": label, "listen_port": listen_port}
+        self.server = RfbServerStream(self._on_init, self._on_message, self._on_keyframe)
+        self.client_state = "version"
+        self.client_buffer = bytearray()
+        self.client_ready = False
+        self.closed = False
+        self.started = False
+        self.started_at = 0.0
+        self.segment = 0
+        self.offset = 0
+        # Пропуск сообщений сервера до освобождения очереди, число пропусков и потерянных байт
+        self.gap = False
+        self.gaps = 0
+        self.dropped = 0
+        # Состояние файлов (поток записи): ошибка останавливает запись в цикле моста
+        self.segment_fd: Optional[int] = None
+        self.segment_path: Optional[str] = None
+        self.index_fd: Optional[int] = None
+        self.opened = False
+        self.size = 0
+        self.error: Optional[str] = None
+        # Начало последнего сообщения: (мс, сегмент, смещение записи, смещение в данных)
+        self.message: Optional[Tuple[int, int, int, int]] = None
+        # Запись текущего куска: сегмент, её смещение, начало записываемых данных в куске (None - не пишется).
+        # Место записи известно заранее, сама она ставится в очередь в конце куска или на пропуске
+        self.chunk: Tuple[int, int, int] = (0, 0, 0)
+        self.chunk_start: Optional[int] = None
+        self.chunk_keyframes: List[bytes] = []
+        self.retained = False
+        self.last_keyframe = 0.0
+        self.keyframe_requested = 0.0
+
+    def _ts(self) -> int:
+        return int((time.monotonic() - self.started_at) * 1000)
+
+    # Поток сервера
+
+    def server_data(self, view: memoryview) -> bool:
+        """
+        Данные от VNC-сервера, уже переданные браузеру.
+        Returns:
+            True - данные поставлены в очередь записи: мост не должен перезаписывать их в буфере
+            и возвращает буфер через store.writer.release_buffer
+        """
+        self.retained = False
+        if self.closed:
+            return False
+        if self.error is not None:
+            self._fail(self.error)
+            return False
+        if self.gap:
+            self.dropped += len(view)
+        elif self.started:
+            if self.server.request is None and self.store.writer.full():
+                # Границы сообщений больше не известны, пропуск испортил бы запись
+                self._fail("write queue full")
+                return False
+            self._begin_chunk(0)
+        if self.server.request is not None:
+            self.server.feed(view)
+            if self.server.error is not None:
+                self._stream_error()
+        self._end_chunk(view, len(view))
+        if self.started and self.client_ready and self.server.request is not None:
+            self._request_keyframe()
+        return self.retained
+
+    def _begin_chunk(self, start: int) -> None:
+        self._next_segment()
+        self.chunk = (self.segment, self.offset, start)
+        self.chunk_start = start
+
+    def _end_chunk(self, view: memoryview, end: int) -> None:
+        start, self.chunk_start = self.chunk_start, None
+        if start is not None and end > start:
+            self._write(REC_SERVER, view[start:end])
+            self.retained = True
+        for entry in self.chunk_keyframes:
+            self._write(REC_KEYFRAME, entry)
+        self.chunk_keyframes.clear()
+
+    def _on_init(self, pos: int, server_init: bytes) -> None:
+        self.started_at = self.last_keyframe = time.monotonic()
+        self.meta.update(started=time.time(), server_init=server_init.hex())
+        self.started = True
+        self.store.writer.put(self._start_file, dict(self.meta))
+        self._open_segment()
+        self._begin_chunk(pos)
+
+    def _on_message(self, pos: int) -> None:
+        if not self.started:
+            return
+        view = self.server.view
+        if not self.gap and self.store.writer.full():
+            # Предыдущие сообщения записаны целиком, с этого начинается пропуск
+            self._end_chunk(view, pos)
+            self.dropped += len(view) - pos
+            self.gap = True
+            self.gaps += 1
+            self.message = None
+            if self.gaps == 1:
+                self.store.logger.warning(f"Recording {self.id}: write queue full, server messages dropped")
+            return
+        if self.gap:
+            if self.store.writer.full():
+                return
+            # Экран после пропуска восстановит ключевой кадр, запрашиваемый сразу
+            self.dropped -= len(view) - pos
+            self._write(REC_GAP, struct.pack("!Q", self.dropped))
+            self.gap = False
+            self.last_keyframe = self.keyframe_requested = 0.0
+            self._begin_chunk(pos)
+        segment, offset, start = self.chunk
+        self.message = (self._ts(), segment, offset, pos - start)
+
+    def _on_keyframe(self) -> None:
+        if not self.started or self.message is None:
+            return
+        entry = INDEX_ENTRY.pack(*self.message, self.server.width, self.server.height)
+        self.store.writer.put(self._write_index_file, entry)
+        # Запись ключевого кадра идёт в сегменте после куска, в котором закончилось обновление
+        self.chunk_keyframes.append(entry)
+        self.last_keyframe = time.monotonic()
+        self.keyframe_requested = 0.0
+
+    def _request_keyframe(self) -> None:
+        now = time.monotonic()
+        if now - self.last_keyframe < self.store.keyframe_interval or \
+                now - self.keyframe_requested < self.store.keyframe_interval:
+            return
+        # Полное обновление видит и зритель: одно на интервал, только пока экран меняется
+        self.keyframe_requested = now
+        self.send_upstream(struct.pack("!BBHHHH", 3, 0, 0, 0, self.server.width, self.server.height))
+
+    def _stream_error(self) -> None:
+        if not self.started:
+            self._fail(f"handshake not recorded: {self.server.error}")
+        else:
+            # Данные пишутся дальше, новых ключевых кадров не будет
+            self.store.logger.warning(f"Recording {self.id}: keyframe indexing stopped: {self.server.error}")
+
+    # Поток клиента
+
+    def client_data(self, payload: bytes) -> bytes:
+        """
+        Данные браузера для VNC-сервера. Возвращает то, что нужно отправить серверу:
+        только целые сообщения, SetEncodings ограничивается кодировками без состояния между кадрами.
+        """
+        if self.error is not None and not self.closed:
+            self._fail(self.error)
+        if self.closed:
+            if not self.client_buffer:
+                return payload
+            payload, self.client_buffer = bytes(self.client_buffer) + payload, bytearray()
+            return payload
+        buffer = self.client_buffer
+        buffer += payload
+        out = bytearray()
+        pos = 0
+        try:
+            while True:
+                size = self._client_message_size(buffer, pos)
+                if size is None or len(buffer) - pos < size:
+                    break
+                out += self._client_message(bytes(buffer[pos:pos + size]))
+                pos += size
+        except ValueError as e:
+            out += buffer[pos:]
+            pos = len(buffer)
+            self._fail(f"client stream not recorded: {e}")
+        del buffer[:pos]
+        out = bytes(out)
+        if out and self.started and not self.closed and self.client_state == "normal":
+            if self.store.writer.full():
+                self.dropped += len(out)
+            else:
+                self._write(REC_CLIENT, out)
+        return out
+
+    def _client_message_size(self, buffer: bytearray, pos: int) -> Optional[int]:
+        available = len(buffer) - pos
+        state = self.client_state
+        if state != "normal":
+            return {"version": 12, "security": 1, "auth": 16, "init": 1}[state]
+        if available < 1:
+            return None
+        kind = buffer[pos]
+        if kind in CLIENT_MESSAGE_SIZES:
+            return CLIENT_MESSAGE_SIZES[kind]
+        header = {2: 4, 6: 8, 248: 9, 251: 8, 255: 2}.get(kind)
+        if header is None:
+            raise ValueError(f"unknown client message {kind}")
+        if available < header:
+            return None
+        if kind == 2:
+            return 4 + 4 * struct.unpack_from("!H", buffer, pos + 2)[0]
+        if kind == 6:
+            return 8 + abs(struct.unpack_from("!i", buffer, pos + 4)[0])
+        if kind == 248:
+            return 9 + buffer[pos + 8]
+        if kind == 251:
+            return 8 + 16 * buffer[pos + 6]
+        if buffer[pos + 1] == 0:  # QEMU ExtendedKeyEvent
+            return 12
+        raise ValueError(f"unknown QEMU client message {buffer[pos + 1]}")
+
+    def _client_message(self, message: bytes) -> bytes:
+        state = self.client_state
+        if state == "version":
+            self.client_state = "security"
+        elif state == "security":
+            self.server.security = message[0]
+            self.client_state = "auth" if message[0] == 2 else "init"
+        elif state == "auth":
+            self.client_state = "init"
+        elif state == "init":
+            self.client_state = "normal"
+        elif message[0] == 0:
+            self.server.pixel_format = message[4:20]
+            self.meta["pixel_format"] = message[4:20].hex()
+            if self.started:
+                self._save_meta()
+        elif message[0] == 2:
+            count = struct.unpack_from("!H", message, 2)[0]
+            encodings = [e for e in struct.unpack_from(f"!{count}i", message, 4) if e in RECORDABLE_ENCODINGS]
+            message = struct.pack(f"!BxH{len(encodings)}i", 2, len(encodings), *encodings)
+        elif message[0] == 3:
+            self.client_ready = True
+        return message
+
+    # Очередь записи (поток цикла моста): смещения записей известны до их записи на диск
+
+    def _open_segment(self) -> None:
+        header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, self.segment, int(self.meta["started"] * 1000))
+        self.store.writer.put(self._open_segment_file, self.segment, header)
+        self.offset = len(header)
+
+    def _next_segment(self) -> None:
+        if self.offset >= self.store.segment_size:
+            self.segment += 1
+            self._open_segment()
+
+    def _write(self, kind: int, data) -> None:
+        """Постановка записи в очередь (данные не копируются и не должны меняться до записи)"""
+        if self.closed:
+            return
+        self._next_segment()
+        header = RECORD_HEADER.pack(kind, self._ts(), len(data))
+        size = len(header) + len(data)
+        self.store.writer.put(self._write_file, header, data, size=size)
+        self.offset += size
+
+    def _save_meta(self) -> None:
+        self.store.writer.put(self._save_meta_file, dict(self.meta))
+
+    def _fail(self, reason: str) -> None:
+        self.store.logger.error(f"Recording {self.id} stopped: {reason}")
+        self.close()
+
+    def close(self) -> None:
+        """Завершение записи: в описание заносится длительность, файлы закрывает поток записи"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.started:
+            self.meta.update(ended=time.time(), duration_ms=self._ts())
+            if self.dropped:
+                self.meta.update(gaps=self.gaps, dropped_bytes=self.dropped)
+                self.store.logger.warning(
+                    f"Recording {self.id}: {self.dropped} bytes dropped in {self.gaps} gap(s), write queue full")
+        self.store.writer.put(self._close_file, dict(self.meta))
+
+    # Файлы записи (поток записи): после ошибки операции пропускаются до закрытия
+
+    def _start_file(self, meta: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self.index_fd = os.open(os.path.join(self.path, INDEX_FILE), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            self._save_meta_file(meta)
+        except OSError as e:
+            self.error = f"cannot start recording: {e}"
+            return
+        self.opened = True
+        self.store.logger.info(f"Recording {self.id} started")
+
+    def _open_segment_file(self, segment: int, header: bytes) -> None:
+        if self.error is not None:
+            return
+        if self.segment_fd is not None:
+            os.close(self.segment_fd)
+            self.segment_fd = None
+            self.store.open_segments.discard(self.segment_path)
+            self.store.closed_segment()
+        self.segment_path = os.path.join(self.path, SEGMENT_FILE.format(segment))
+        try:
+            self.segment_fd = os.open(self.segment_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o600)
+            self.store.open_segments.add(self.segment_path)
+            os.write(self.segment_fd, header)
+        except OSError as e:
+            self.error = f"cannot open segment: {e}"
+            return
+        self.size += len(header)
+
+    def _write_file(self, header: bytes, data) -> None:
+        if self.error is not None:
+            return
+        try:
+            written = os.writev(self.segment_fd, (header, data))
+            if written != len(header) + len(data):
+                raise OSError(f"short write {written}")
+        except OSError as e:
+            self.error = f"write failed: {e}"
+            return
+        self.size += written
+
+    def _write_index_file(self, entry: bytes) -> None:
+        if self.error is not None:
+            return
+        try:
+            os.write(self.index_fd, entry)
+        except OSError as e:
+            self.error = f"index write failed: {e}"
+
+    def _save_meta_file(self, meta: Dict[str, Any]) -> None:
+        path = os.path.join(self.path, META_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def _close_file(self, meta: Dict[str, Any]) -> None:
+        for fd in (self.segment_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.segment_fd = self.index_fd = None
+        self.store.open_segments.discard(self.segment_path)
+        if self.opened:
+            meta["size"] = self.size
+            try:
+                self._save_meta_file(meta)
+            except OSError as e:
+                self.store.logger.error(f"Recording {self.id}: metadata not saved: {e}")
+            self.store.logger.info(f"Recording {self.id} finished, {self.size} bytes")
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.store.finished(self)
+
+
+class RecordingReader:
+    """Чтение записи: ключевой кадр для момента времени и данные сервера начиная с него"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.keyframes = self._load_index()
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, SEGMENT_FILE.format(segment))
+
+    def _load_index(self) -> List[Tuple[int, int, int, int, int, int]]:
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Индекс восстанавливается по записям ключевых кадров в сегментах
+            data = b"".join(payload for kind, _, payload in self._scan() if kind == REC_KEYFRAME)
+        return [INDEX_ENTRY.unpack_from(data, pos) for pos in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+    def _scan(self) -> Iterator[Tuple[int, int, bytes]]:
+        segment = 0
+        while os.path.exists(self.segment_path(segment)):
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(SEGMENT_HEADER.size)
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    kind, ts, length = RECORD_HEADER.unpack(header)
+                    yield kind, ts, f.read(length)
+            segment += 1
+
+    def seek(self, ts_ms: int) -> Optional[Tuple[int, int, int, int, int, int]]:
+        """Последний ключевой кадр не позже ts_ms (или первый сохранившийся), None - кадров нет"""
+        available = [entry for entry in self.keyframes if os.path.exists(self.segment_path(entry[1]))]
+        earlier = [entry for entry in available if entry[0] <= ts_ms]
+        return earlier[-1] if earlier else (available[0] if available else None)
+
+    def server_init(self, width: int, height: int) -> bytes:
+        """ServerInit для зрителя записи: размер экрана ключевого кадра и формат пикселей записанного клиента"""
+        init = bytearray.fromhex(self.meta["server_init"])
+        struct.pack_into("!HH", init, 0, width, height)
+        if self.meta.get("pixel_format"):
+            init[4:20] = bytes.fromhex(self.meta["pixel_format"])
+        return bytes(init)
+
+    def server_data(self, keyframe: Tuple[int, int, int, int, int, int]) -> Iterator[Optional[Tuple[int, bytes]]]:
+        """
+        Данные сервера (мс, байты) начиная с ключевого кадра, по сегментам подряд.
+        В конце записанных данных выдаёт None: у идущей записи данные могут появиться позже.
+        """
+        _, segment, offset, skip, _, _ = keyframe
+        f = open(self.segment_path(segment), "rb")
+        try:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    following = self.segment_path(segment + 1)
+                    if os.path.exists(following):
+                        f.close()
+                        segment += 1
+                        f = open(following, "rb")
+                        if SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))[0] != SEGMENT_MAGIC:
+                            return
+                        continue
+                    f.seek(-len(header), os.SEEK_CUR)
+                    yield None
+                    continue
+                kind, ts, length = RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    f.seek(-len(header) - len(data), os.SEEK_CUR)
+                    yield None
+                    continue
+                if kind == REC_SERVER:
+                    yield ts, data[skip:] if skip else data
+                    skip = 0
+        finally:
+            f.close()
+
+
+class RecordingStore:
+    """
+    Каталог записей сессий: создание записей для подключений моста, список и чтение записей,
+    удаление старых сегментов при превышении общего объёма.
+    Записи создаются в потоке asyncio-цикла моста, файлы пишет и старые сегменты удаляет поток записи.
+    """
+
+    def __init__(self, logger, root: str, segment_size: int, keyframe_interval: float, max_size: int,
+                 queue_size: int = 32 * 1024 * 1024):
+        """
+        Args:
+            logger: Экземпляр Logger
+            root: Каталог записей
+            segment_size: Размер сегмента (байт), после которого начинается следующий
+            keyframe_interval: Интервал ключевых кадров (сек)
+            max_size: Общий объём записей (байт), сверх которого удаляются старые сегменты (0 - без ограничения)
+            queue_size: Объём данных (байт), ожидающих записи на диск, сверх которого данные пропускаются
+        """
+        self.logger = logger
+        self.root = os.path.realpath(root)
+        self.segment_size = segment_size
+        self.keyframe_interval = keyframe_interval
+        self.max_size = max_size
+        # Записи, файлы которых ещё не закрыты потоком записи
+        self.active: Dict[str, SessionRecorder] = {}
+        self.open_segments: Set[str] = set()
+        self._numbers = itertools.count(1)
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        self.writer = RecordingWriter(logger, queue_size)
+
+    def open(self, label: str, listen_port: int, send_upstream: Callable[[bytes], None]) -> SessionRecorder:
+        """Запись нового подключения к сессии label (файлы создаются после рукопожатия RFB)"""
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{listen_port}-{next(self._numbers)}"
+        recording_id = f"{_SAFE_NAME.sub('_', label)}/{name}"
+        recorder = SessionRecorder(self, recording_id, label, listen_port, send_upstream)
+        self.active[recording_id] = recorder
+        return recorder
+
+    def finished(self, recorder: SessionRecorder) -> None:
+        self.active.pop(recorder.id, None)
+        if recorder.opened:
+            self.enforce_limit()
+
+    def closed_segment(self) -> None:
+        self.enforce_limit()
+
+    def _segments(self) -> List[Tuple[float, str, int]]:
+        """Сегменты всех записей: (время изменения, путь, размер)"""
+        segments = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(".rfbrec"):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    segments.append((st.st_mtime, path, st.st_size))
+        return sorted(segments)
+
+    def enforce_limit(self) -> None:
+        """Удаление самых старых закрытых сегментов, пока объём записей превышает max_size"""
+        if self.max_size <= 0:
+            return
+        segments = self._segments()
+        total = sum(size for _, _, size in segments)
+        for _, path, size in segments:
+            if total <= self.max_size:
+                break
+            if path in self.open_segments:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.logger.error(f"Unable to remove recording segment {path}: {e}")
+                continue
+            total -= size
+            self.logger.info(f"Recording segment {path} removed, recordings size limit reached")
+            directory = os.path.dirname(path)
+            if not any(name.endswith(".rfbrec") for name in os.listdir(directory)):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Описания записей, новые первыми"""
+        recordings = []
+        for label in os.listdir(self.root):
+            directory = os.path.join(self.root, label)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                try:
+                    with open(os.path.join(directory, name, META_FILE)) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                meta.pop("server_init", None)
+                meta.pop("pixel_format", None)
+                meta["active"] = meta.get("id") in self.active
+                recordings.append(meta)
+        return sorted(recordings, key=lambda meta: meta.get("started", 0), reverse=True)
+
+    def reader(self, recording_id: str) -> Optional[RecordingReader]:
+        """Чтение записи по идентификатору или None, если записи нет"""
+        if not _RECORDING_ID.match(recording_id or "") or ".." in recording_id:
+            return None
+        try:
+            return RecordingReader(os.path.join(self.root, recording_id))
+        except (OSError, ValueError, KeyError):
+            return None
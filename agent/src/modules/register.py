@@ -1,39 +1,168 @@
+import random
+import time
 import requests
-from typing import Dict, Optional, Union
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, List, Optional, Union
 
 
 class ServerRegister:
     """Регистратор агента на сервере с логированием ошибок"""
 
-    def __init__(self, logger):
+    # Начальная задержка (сек) экспоненциального backoff между попытками регистрации
+    BACKOFF_BASE = 1
+
+    def __init__(self, logger, backoff_max: int = 60, timeout: int = 10):
+        """
+        Args:
+            logger: Экземпляр Logger
+            backoff_max: Верхняя граница задержки между попытками (сек)
+            timeout: Таймаут HTTP-запроса (сек)
+        """
         self.logger = logger
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        # Одна сессия с пулом соединений на всё время работы агента
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Последняя неотправленная регистрация: (urls, data, headers)
+        self.pending = None
+        # Узел API последней успешной регистрации, с него начинается следующая попытка
+        self.preferred = 0
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.retry_after: Optional[float] = None
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Разбор заголовка Retry-After (секунды или HTTP-дата)"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
 
-    def register_server(
+    def submit(
             self,
-            server_api_url: str,
+            server_api_urls: List[str],
             ip: str,
-            username: str,
-            websockify_port: Optional[int] = None,
+            sessions: List[Dict[str, Any]],
+            auth_token: Optional[str] = None,
+            telemetry: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Поставить регистрацию в очередь.
+        Хранится только последняя регистрация, она заменяет неотправленную предыдущую.
+        Регистрация отправляется на первый доступный из узлов API, узлы реплицируют её между собой.
+        """
+        data, headers = self._build_request(ip, sessions, auth_token)
+        if telemetry is not None:
+            data['telemetry'] = telemetry
+        self.pending = (server_api_urls, data, headers)
+
+    def send_heartbeat(
+            self,
+            server_api_urls: List[str],
+            ip: str,
+            telemetry: Dict[str, Any],
             auth_token: Optional[str] = None
-    ) -> Optional[Union[Dict, str]]:
-        self.logger.info(
-            f"Registering to {server_api_url} - "
-            f"User: {username}, "
-            f"WS: {websockify_port or 'N/A'}"
+    ) -> bool:
+        """
+        Отправка замера нагрузки на узел API последней успешной регистрации.
+        Одна попытка без очереди повторов: следующий heartbeat всё равно заменит замер.
+        """
+        headers = {'Authorization': f'Bearer {auth_token}'} if auth_token else {}
+        server_api_url = server_api_urls[self.preferred % len(server_api_urls)]
+        try:
+            response = self.session.post(server_api_url, json={'ip': ip, 'telemetry': telemetry},
+                                         headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            self.logger.debug(f"Heartbeat to {server_api_url} failed: {e}")
+            return False
+
+    @property
+    def has_pending(self) -> bool:
+        return self.pending is not None
+
+    def seconds_until_retry(self) -> float:
+        """Время до следующей попытки отправки очереди"""
+        return max(0.0, self.next_attempt - time.monotonic())
+
+    def flush(self) -> Optional[Union[Dict, str]]:
+        """
+        Отправить регистрацию из очереди, если подошло время попытки.
+        Returns:
+            Ответ сервера при успешной отправке, иначе None
+        """
+        if self.pending is None or self.seconds_until_retry() > 0:
+            return None
+
+        server_api_urls, data, headers = self.pending
+        result = self._send_any(server_api_urls, data, headers)
+        if result is not None:
+            self.pending = None
+            self.failures = 0
+            self.next_attempt = 0.0
+            return result
+
+        self.failures += 1
+        # Full jitter: случайная задержка от 0 до экспоненциальной границы
+        delay = random.uniform(0, min(self.backoff_max, self.BACKOFF_BASE * 2 ** self.failures))
+        if self.retry_after is not None:
+            delay = max(delay, self.retry_after)
+        self.next_attempt = time.monotonic() + delay
+        self.logger.warning(f"Registration failed ({self.failures} in a row), next attempt in {delay:.1f}s")
+        return None
+
+    def _build_request(self, ip: str, sessions: List[Dict[str, Any]], auth_token: Optional[str]):
+        summary = ", ".join(
+            f"{s['session']} (User: {s['username']}, WS: {s.get('websockify_port') or 'N/A'})"
+            for s in sessions
         )
+        self.logger.info(f"Registration queued - Sessions: {summary or 'none'}")
 
         data = {
             'ip': ip,
-            'username': username,
-            'websockify_port': websockify_port
+            'sessions': sessions
         }
 
         headers = {}
         if auth_token:
             headers['Authorization'] = f'Bearer {auth_token}'
+        return data, headers
+
+    def _send_any(self, server_api_urls: List[str], data: Dict[str, Any],
+                  headers: Dict[str, str]) -> Optional[Union[Dict, str]]:
+        """Отправка на узлы API по очереди, начиная с последнего успешного"""
+        retry_after = None
+        for offset in range(len(server_api_urls)):
+            index = (self.preferred + offset) % len(server_api_urls)
+            result = self._send(server_api_urls[index], data, headers)
+            if result is not None:
+                self.preferred = index
+                return result
+            if self.retry_after is not None:
+                retry_after = max(retry_after or 0.0, self.retry_after)
+        self.retry_after = retry_after
+        return None
+
+    def _send(self, server_api_url: str, data: Dict[str, Any], headers: Dict[str, str]) -> Optional[Union[Dict, str]]:
+        self.logger.info(f"Registering to {server_api_url}")
+        self.retry_after = None
 
         try:
-            response = requests.post(server_api_url, json=data, headers=headers, timeout=10)
+            response = self.session.post(server_api_url, json=data, headers=headers, timeout=self.timeout)
             response.raise_for_status()
 
             if not response.text.strip():
@@ -49,6 +178,7 @@ class ServerRegister:
         except requests.Timeout:
             self.logger.error("Registration timeout")
         except requests.HTTPError as e:
+            self.retry_after = self.parse_retry_after(e.response.headers.get('Retry-After'))
             self.logger.error(f"HTTP error {e.response.status_code}: {e.response.text}")
         except requests.RequestException as e:
             self.logger.error(f"Network error: {str(e)}")
@@ -0,0 +1,108 @@
+import os
+import time
+import psutil
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+
+class TelemetryCollector:
+    """
+    Компактный замер нагрузки хоста для API-сервера: CPU и память хоста, CPU и RSS x11vnc и websockify,
+    число подключённых клиентов и исходящий трафик.
+    Замер не блокирует: загрузка CPU и трафик считаются как разница с предыдущим замером,
+    поэтому для только что запущенного процесса первый замер CPU равен нулю.
+    Трафик к браузерам известен только встроенному мосту: с отдельным websockify он не сообщается (None),
+    потому что счётчики сетевых интерфейсов включают весь трафик хоста.
+    """
+
+    def __init__(self, bridge=None):
+        """
+        Args:
+            bridge: Встроенный мост WebSocket (клиенты и трафик берутся из его счётчиков) или None
+        """
+        self.bridge = bridge
+        # Объекты psutil по pid: cpu_percent считает загрузку с предыдущего вызова для того же объекта
+        self._processes: Dict[int, psutil.Process] = {}
+        # Предыдущий замер исходящего трафика: (время, отправлено байт)
+        self._sent: Optional[Tuple[float, int]] = None
+        psutil.cpu_percent(interval=None)
+
+    def _tree_usage(self, pid: int, seen: Set[int], children: bool = True) -> Tuple[float, int]:
+        """CPU (%) и RSS (байт) процесса вместе с дочерними (websockify обслуживает клиентов в дочерних процессах)"""
+        cpu, rss = 0.0, 0
+        try:
+            root = self._process(pid)
+            tree = [root] + (root.children(recursive=True) if children else [])
+        except psutil.Error:
+            return cpu, rss
+        for proc in tree:
+            try:
+                proc = self._process(proc.pid)
+                cpu += proc.cpu_percent(interval=None)
+                rss += proc.memory_info().rss
+                seen.add(proc.pid)
+            except psutil.Error:
+                self._processes.pop(proc.pid, None)
+        return cpu, rss
+
+    def _process(self, pid: int) -> psutil.Process:
+        proc = self._processes.get(pid)
+        if proc is None or not proc.is_running():
+            proc = self._processes[pid] = psutil.Process(pid)
+        return proc
+
+    def _bytes_sent(self, listen_ports: Iterable[int]) -> int:
+        return sum(self.bridge.get_stats(port).get('bytes_down', 0) for port in listen_ports)
+
+    def _clients(self, listen_ports: Set[int]) -> int:
+        if self.bridge is not None:
+            return sum(self.bridge.get_stats(port).get('clients', 0) for port in listen_ports)
+        try:
+            connections = psutil.net_connections(kind='tcp')
+        except psutil.Error:
+            return 0
+        return sum(1 for c in connections
+                   if c.status == psutil.CONN_ESTABLISHED and c.laddr and c.laddr.port in listen_ports)
+
+    def collect(self, vnc_sessions: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Замер нагрузки.
+        Args:
+            vnc_sessions: Запущенные VNC-сессии агента (значения процессов суммируются по сессиям)
+        """
+        seen: Set[int] = set()
+        usage = {'vnc': [0.0, 0], 'websockify': [0.0, 0]}
+        listen_ports = set()
+        for vnc_session in vnc_sessions.values():
+            for name, child in vnc_session.children.items():
+                if name == 'websockify':
+                    listen_ports.add(child.port)
+                if child.proc is not None and child.proc.poll() is None:
+                    cpu, rss = self._tree_usage(child.proc.pid, seen)
+                    usage[name][0] += cpu
+                    usage[name][1] += rss
+        if self.bridge is not None:
+            # Встроенный мост работает в процессе агента (x11vnc - его дочерние процессы, они уже учтены)
+            usage['websockify'][0], usage['websockify'][1] = self._tree_usage(os.getpid(), seen, children=False)
+
+        # Завершившиеся процессы больше не отслеживаются
+        for pid in set(self._processes) - seen:
+            del self._processes[pid]
+
+        tx_bps = None
+        if self.bridge is not None:
+            now, sent = time.monotonic(), self._bytes_sent(listen_ports)
+            tx_bps = 0.0
+            if self._sent is not None and sent >= self._sent[1] and now > self._sent[0]:
+                tx_bps = (sent - self._sent[1]) / (now - self._sent[0])
+            self._sent = (now, sent)
+
+        return {
+            'cpu': psutil.cpu_percent(interval=None),
+            'mem': psutil.virtual_memory().percent,
+            'vnc_cpu': round(usage['vnc'][0], 1),
+            'vnc_rss': usage['vnc'][1],
+            'ws_cpu': round(usage['websockify'][0], 1),
+            'ws_rss': usage['websockify'][1],
+            'clients': self._clients(listen_ports),
+            'tx_bps': round(tx_bps) if tx_bps is not None else None,
+        }
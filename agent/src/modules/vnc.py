@@ -1,9 +1,12 @@
 import subprocess
-import socket
+import threading
+import time
 import re
 import os
 import psutil
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Set
+from .profiles import X11Capabilities, build_vnc_args
+from .bridge import WebSocketBridge
 
 
 class PortManager:
@@ -47,10 +50,48 @@ class PortManager:
         except Exception as e:
             raise RuntimeError(f"Cannot determine display: {e}")
 
+    # Порты, выданные calculate_ports, но ещё не занятые дочерним процессом
+    _reserved: Set[int] = set()
+    _reserved_lock = threading.Lock()
+
+    # Таблицы сокетов ядра и состояние LISTEN (0x0A)
+    PROC_NET_TABLES = ('/proc/net/tcp', '/proc/net/tcp6')
+    TCP_LISTEN = '0A'
+
+    @staticmethod
+    def get_listening_ports() -> Set[int]:
+        """
+        Получение множества прослушиваемых TCP-портов за одно чтение таблицы ядра.
+        Returns:
+            Множество номеров портов в состоянии LISTEN
+        """
+        ports = set()
+        found = False
+        for table in PortManager.PROC_NET_TABLES:
+            try:
+                with open(table, 'r') as f:
+                    next(f, None)  # Заголовок таблицы
+                    for line in f:
+                        fields = line.split(None, 4)
+                        if len(fields) > 3 and fields[3] == PortManager.TCP_LISTEN:
+                            ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+                found = True
+            except OSError:
+                continue
+        if found:
+            return ports
+
+        # Fallback для систем без /proc
+        return {
+            conn.laddr.port
+            for conn in psutil.net_connections(kind='tcp')
+            if conn.status == psutil.CONN_LISTEN and conn.laddr
+        }
+
     @staticmethod
     def calculate_ports(vnc_config: Dict[str, Any]) -> Dict[str, int]:
         """
-        Вычисление свободных портов
+        Выделение первой свободной пары портов с резервированием до запуска процессов
         Args:
             vnc_config: словарь файла конфигурации
         Returns:
@@ -58,77 +99,217 @@ class PortManager:
         """
         MAX_PORT_ATTEMPTS = 100
 
-        def find_available_ports(base_port: int, web_port: int, increment: int = 0) -> Dict[str, int]:
-            return {
-                'vnc': base_port + increment,
-                'web': web_port + increment
-            }
-
         try:
-            base_vnc_port = vnc_config.get('VNC_PORT', 5900)
-            base_web_port = vnc_config.get('WEBSOCKIFY_PORT', 6080)
-            increment = 0
-            while increment < MAX_PORT_ATTEMPTS:
-                ports = find_available_ports(base_vnc_port, base_web_port, increment)
-                if (PortManager.is_port_available(ports['vnc']) and
-                        PortManager.is_port_available(ports['web'])):
-                    return ports
-                increment += 1
-            raise RuntimeError(f"Could not find available ports after {MAX_PORT_ATTEMPTS} attempts")
-        except ValueError as e:
+            base_vnc_port = int(vnc_config.get('VNC_PORT', 5900))
+            base_web_port = int(vnc_config.get('WEBSOCKIFY_PORT', 6080))
+        except (TypeError, ValueError) as e:
             raise ValueError(f"Error: {e}")
 
+        with PortManager._reserved_lock:
+            busy = PortManager.get_listening_ports() | PortManager._reserved
+            for increment in range(MAX_PORT_ATTEMPTS):
+                ports = {
+                    'vnc': base_vnc_port + increment,
+                    'web': base_web_port + increment
+                }
+                if ports['vnc'] not in busy and ports['web'] not in busy:
+                    PortManager._reserved.update(ports.values())
+                    return ports
+        raise RuntimeError(f"Could not find available ports after {MAX_PORT_ATTEMPTS} attempts")
+
+    @staticmethod
+    def allocate_port(base_port: int) -> int:
+        """
+        Выделение одного свободного порта начиная с base_port с резервированием
+        Args:
+            base_port: Начальное значение порта
+        Returns:
+            Номер свободного порта
+        """
+        MAX_PORT_ATTEMPTS = 100
+
+        with PortManager._reserved_lock:
+            busy = PortManager.get_listening_ports() | PortManager._reserved
+            for port in range(base_port, base_port + MAX_PORT_ATTEMPTS):
+                if port not in busy:
+                    PortManager._reserved.add(port)
+                    return port
+        raise RuntimeError(f"Could not find available port after {MAX_PORT_ATTEMPTS} attempts")
+
+    @staticmethod
+    def release_ports(*ports: int) -> None:
+        """Снятие резервирования с портов после запуска или остановки процессов"""
+        with PortManager._reserved_lock:
+            PortManager._reserved.difference_update(ports)
+
+    @staticmethod
+    def wait_for_bind(port: int, proc: subprocess.Popen, timeout: float = 5.0) -> bool:
+        """
+        Ожидание, пока дочерний процесс начнёт слушать порт
+        Args:
+            port: Ожидаемый порт
+            proc: Запущенный процесс
+            timeout: Максимальное время ожидания в секундах
+        Returns:
+            True, если порт занят процессом до истечения таймаута
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if port in PortManager.get_listening_ports():
+                return True
+            if proc.poll() is not None:
+                return False
+            time.sleep(0.1)
+        return False
+
     @staticmethod
     def is_port_available(port: int) -> bool:
         """Проверка занятости порта"""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            return s.connect_ex(('localhost', port)) != 0
+        return port not in PortManager.get_listening_ports()
+
+
+class ChildProcess:
+    """Дочерний процесс VNC-сессии со статистикой перезапусков"""
+
+    def __init__(self, name: str, port: int):
+        self.name = name
+        self.port = port
+        self.proc: Optional[subprocess.Popen] = None
+        self.started_at: Optional[float] = None
+        self.restarts = 0
+        self.failures = 0  # Подряд идущие сбои для расчёта задержки
+        self.next_restart = 0.0
+        self.unbound_checks = 0
+
+    @property
+    def uptime(self) -> int:
+        """Время работы текущего экземпляра процесса в секундах"""
+        if self.started_at is None:
+            return 0
+        return int(time.monotonic() - self.started_at)
+
+    def stats(self) -> Dict[str, int]:
+        return {'port': self.port, 'restarts': self.restarts, 'uptime': self.uptime}
 
 
 class VNCSession:
     """Класс управления сессией VNC"""
 
+    # Начальная и максимальная задержка перед перезапуском упавшего процесса (сек)
+    RESTART_BACKOFF_BASE = 2
+    RESTART_BACKOFF_MAX = 300
+    # Время работы, после которого процесс считается стабильным и задержка сбрасывается
+    STABLE_UPTIME = 60
+    # Сколько проверок подряд живой процесс может не слушать свой порт
+    UNBOUND_CHECKS_LIMIT = 3
+
     def __init__(self, logger, vnc_binary: str, websockify_binary: str,
-                 passwd: str, vo_passwd: str):
+                 passwd: str, vo_passwd: str, profile: Optional[Dict[str, Any]] = None,
+                 binary_options: Optional[Set[str]] = None, bridge: Optional[WebSocketBridge] = None):
         self.logger = logger
         self.vnc_binary = vnc_binary
         self.websockify_binary = websockify_binary
         self.passwd = passwd
         self.vo_passwd = vo_passwd
-        self.processes = []
+        self.profile = profile or {}
+        self.binary_options = binary_options
+        # Встроенный WebSocket-мост вместо отдельного процесса websockify
+        self.bridge = bridge
+        self.vnc_args: List[str] = []
+        self.children: Dict[str, ChildProcess] = {}
+        self.username = None
+        self.display = None
+        # Имя сессии для записи подключений встроенным мостом (None - не записывается)
+        self.recording: Optional[str] = None
 
-    def start(self, username: str, vnc_display: str, vnc_port: int, websockify_port: int) -> bool:
-        """Запуск vnc и websockify"""
-        try:
-            vnc_cmd = [
-                'sudo', '-u', str(username), 'env',
+    @property
+    def vnc_port(self) -> Optional[int]:
+        child = self.children.get('vnc')
+        return child.port if child else None
+
+    @property
+    def websockify_port(self) -> Optional[int]:
+        child = self.children.get('websockify')
+        return child.port if child else None
+
+    def _build_command(self, name: str) -> List[str]:
+        """Командная строка для дочернего процесса"""
+        if name == 'vnc':
+            return [
+                'sudo', '-u', str(self.username), 'env',
                 self.vnc_binary,
-                '-display', str(vnc_display),
-                '-rfbport', str(vnc_port),
+                '-display', str(self.display),
+                '-rfbport', str(self.vnc_port),
                 '-passwd', str(self.passwd),
                 '-viewpasswd', str(self.vo_passwd),
                 '-forever',
                 '-shared'
-            ]
+            ] + self.vnc_args
+        return [
+            self.websockify_binary,
+            '--listen', str(self.websockify_port),
+            '--vnc', f"localhost:{self.vnc_port}"
+        ]
+
+    def _uses_bridge(self, child: ChildProcess) -> bool:
+        return self.bridge is not None and child.name == 'websockify'
+
+    def _spawn(self, child: ChildProcess) -> bool:
+        """Запуск дочернего процесса и ожидание открытия порта"""
+        child.started_at = time.monotonic()
+        child.unbound_checks = 0
+        if self._uses_bridge(child):
+            return self.bridge.add_listener(child.port, self.vnc_port, record=self.recording)
+        child.proc = subprocess.Popen(self._build_command(child.name))
+        return PortManager.wait_for_bind(child.port, child.proc)
 
-            vnc_proc = subprocess.Popen(vnc_cmd)
-            self.processes.append(vnc_proc)
+    def _terminate(self, child: ChildProcess) -> None:
+        """Остановка дочернего процесса с обязательным сбором его статуса"""
+        if self._uses_bridge(child):
+            self.bridge.remove_listener(child.port)
+            child.started_at = None
+            return
+        proc = child.proc
+        if proc is None:
+            return
+        try:
+            if proc.poll() is None:  # Проверяем, работает ли процесс
+                proc.terminate()
+                proc.wait(timeout=5)
+        except (psutil.NoSuchProcess, subprocess.TimeoutExpired):
+            try:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait(timeout=5)
+            except Exception as e:
+                self.logger.error(f"Error killing process: {e}")
+        except Exception as e:
+            self.logger.error(f"Unexpected error stopping process: {e}")
+        child.proc = None
+        child.started_at = None
 
-            if not PortManager.is_port_available(vnc_port):
+    def start(self, username: str, vnc_display: str, vnc_port: int, websockify_port: int,
+              recording: Optional[str] = None) -> bool:
+        """Запуск vnc и websockify (recording - имя сессии, если её подключения записываются)"""
+        try:
+            self.username = username
+            self.display = vnc_display
+            self.recording = recording
+            if self.profile:
+                extensions = X11Capabilities.probe_display(username, vnc_display)
+                self.vnc_args = build_vnc_args(self.profile, self.binary_options, extensions)
+                self.logger.debug(f"x11vnc options for {vnc_display}: {' '.join(self.vnc_args) or 'default'}")
+            self.children = {
+                'vnc': ChildProcess('vnc', vnc_port),
+                'websockify': ChildProcess('websockify', websockify_port)
+            }
+
+            if not self._spawn(self.children['vnc']):
                 self.logger.error(f"Failed to start VNC session on port {vnc_port}")
                 self.stop()
                 return False
 
-            ws_cmd = [
-                self.websockify_binary,
-                '--listen', str(websockify_port),
-                '--vnc', f"localhost:{vnc_port}"
-            ]
-
-            ws_proc = subprocess.Popen(ws_cmd)
-            self.processes.append(ws_proc)
-
-            if not PortManager.is_port_available(websockify_port):
+            if not self._spawn(self.children['websockify']):
                 self.logger.error(f"Failed to start Websockify on port {websockify_port}")
                 self.stop()
                 return False
@@ -140,21 +321,105 @@ class VNCSession:
             self.logger.error(f"Failed to start VNC session: {e}")
             self.stop()
             return False
+        finally:
+            PortManager.release_ports(vnc_port, websockify_port)
+
+    def _check_child(self, child: ChildProcess, listening: Set[int]) -> Optional[str]:
+        """
+        Проверка состояния дочернего процесса.
+        Returns:
+            Причина сбоя или None, если процесс исправен
+        """
+        if self._uses_bridge(child):
+            return None if self.bridge.is_listening(child.port) else "bridge listener is down"
+        if child.proc is None:
+            return "is not running"
+        code = child.proc.poll()  # poll() также собирает статус завершившегося процесса
+        if code is not None:
+            return f"exited with code {code}"
+        if child.port not in listening:
+            child.unbound_checks += 1
+            if child.unbound_checks >= self.UNBOUND_CHECKS_LIMIT:
+                return f"is not listening on port {child.port}"
+            return None
+        child.unbound_checks = 0
+        return None
+
+    def _restart_child(self, child: ChildProcess, crashed: bool = True) -> bool:
+        """
+        Перезапуск одного дочернего процесса, при занятом порте выделяется новый
+        Args:
+            child: Дочерний процесс
+            crashed: False - исправный процесс перезапускается вслед за VNC (сбоем не считается)
+        """
+        previous_uptime = child.uptime
+        self._terminate(child)
+        if crashed:
+            child.restarts += 1
+            child.failures += 1
+        delay = min(self.RESTART_BACKOFF_BASE * 2 ** max(child.failures - 1, 0), self.RESTART_BACKOFF_MAX)
+        child.next_restart = time.monotonic() + delay
+
+        # Порт моста освобождается remove_listener синхронно и принадлежит сессии: проверка нужна только процессам
+        if not self._uses_bridge(child) and child.port in PortManager.get_listening_ports():
+            old_port = child.port
+            child.port = PortManager.allocate_port(old_port)
+            self.logger.warning(f"Port {old_port} of {child.name} is taken, moving to {child.port}")
+        try:
+            ok = self._spawn(child)
+        finally:
+            PortManager.release_ports(child.port)
+
+        if ok:
+            self.logger.info(
+                f"Restarted {child.name} for {self.username} on port {child.port} "
+                f"(restarts: {child.restarts}, previous uptime: {previous_uptime}s)")
+        else:
+            self.logger.error(
+                f"Restart of {child.name} for {self.username} failed, next attempt in {delay}s "
+                f"(restarts: {child.restarts})")
+        return ok
+
+    def supervise(self) -> bool:
+        """
+        Проверка дочерних процессов и перезапуск только упавших.
+        Returns:
+            True, если изменился порт websockify или VNC и требуется повторная регистрация
+        """
+        if not self.children:
+            return False
+
+        listening = PortManager.get_listening_ports()
+        ports = (self.vnc_port, self.websockify_port)
+        now = time.monotonic()
+
+        for name in ('vnc', 'websockify'):
+            child = self.children[name]
+            reason = self._check_child(child, listening)
+            if reason is None:
+                if child.failures and child.uptime >= self.STABLE_UPTIME:
+                    child.failures = 0
+                continue
+            if now < child.next_restart:
+                continue
+
+            self.logger.warning(f"{name} for {self.username} {reason}")
+            old_vnc_port = self.vnc_port
+            if self._restart_child(child) and name == 'vnc' and self.vnc_port != old_vnc_port:
+                # websockify проксирует на старый порт VNC и тоже должен быть перезапущен
+                self._restart_child(self.children['websockify'], crashed=False)
+
+        return (self.vnc_port, self.websockify_port) != ports
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Количество перезапусков и время работы дочерних процессов"""
+        return {name: child.stats() for name, child in self.children.items()}
 
     def stop(self) -> None:
         """Остановить сессии"""
-        for proc in self.processes[:]:  # Используем копию списка для безопасной итерации
-            try:
-                if proc.poll() is None:  # Проверяем, работает ли процесс
-                    proc.terminate()
-                    proc.wait(timeout=5)
-            except (psutil.NoSuchProcess, subprocess.TimeoutExpired):
-                try:
-                    if proc.poll() is None:
-                        proc.kill()
-                except Exception as e:
-                    self.logger.error(f"Error killing process: {e}")
-            except Exception as e:
-                self.logger.error(f"Unexpected error stopping process: {e}")
-        self.processes.clear()
+        for child in self.children.values():
+            self._terminate(child)
+        self.children = {}
+        self.username = None
+        self.display = None
         self.logger.info("Stopped VNC session.")
@@ -0,0 +1 @@
+../../../api-server/modules/websocket.py
\ No newline at end of file
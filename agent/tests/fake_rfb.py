@@ -0,0 +1,210 @@
+import base64
+import os
+import socket
+import struct
+import threading
+import time
+from typing import List
+
+# Размер экрана тестового VNC-сервера
+WIDTH, HEIGHT = 320, 200
+# Формат пикселей ServerInit: 32 бита, глубина 24, little-endian truecolor
+PIXEL_FORMAT = struct.pack("!BBBBHHHBBB3x", 32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+class FakeRFBServer:
+    """
+    Тестовый VNC-сервер RFB 3.8 с VNC-аутентификацией (пароль не проверяется).
+    На полный запрос обновления отвечает ключевым кадром из двух прямоугольников TightPNG на весь экран,
+    на инкрементальный - прямоугольниками Raw и Hextile 16x16, иногда с Bell и ServerCutText.
+    """
+
+    def __init__(self, port: int, keyframe_size: int = 3000, update_delay: float = 0.01):
+        """
+        Args:
+            port: Порт на 127.0.0.1
+            keyframe_size: Размер данных PNG в полном обновлении (байт)
+            update_delay: Задержка ответа на инкрементальный запрос (сек)
+        """
+        self.port = port
+        self.keyframe_size = keyframe_size
+        self.update_delay = update_delay
+        # Полученные от клиентов SetEncodings, запросы обновлений (флаг incremental) и ClientCutText
+        self.encodings: List[List[int]] = []
+        self.requests: List[int] = []
+        self.cut_text: List[bytes] = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(16)
+        threading.Thread(target=self._accept, name="fake-rfb", daemon=True).start()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def keyframe(self) -> bytes:
+        png = os.urandom(self.keyframe_size)
+        size = len(png)
+        compact = bytes([size & 0x7F | 0x80, (size >> 7) & 0x7F | 0x80, size >> 14])
+        return (struct.pack("!BxH", 0, 3)
+                + struct.pack("!HHHHi", 0, 0, WIDTH, HEIGHT // 2, -260) + b"\x80\x01\x02\x03"
+                + struct.pack("!HHHHi", 0, HEIGHT // 2, WIDTH, HEIGHT // 2, -260) + b"\xa0" + compact + png
+                + struct.pack("!HHHHi", 0, 0, 0, 0, -224))
+
+    def _serve(self, conn: socket.socket) -> None:
+        try:
+            conn.sendall(b"RFB 003.008\n")
+            _recv_exactly(conn, 12)
+            conn.sendall(b"\x01\x02")
+            _recv_exactly(conn, 1)
+            conn.sendall(os.urandom(16))
+            _recv_exactly(conn, 16)
+            conn.sendall(b"\0\0\0\0")
+            _recv_exactly(conn, 1)
+            conn.sendall(struct.pack("!HH", WIDTH, HEIGHT) + PIXEL_FORMAT + struct.pack("!I", 4) + b"fake")
+            updates = 0
+            while True:
+                kind = _recv_exactly(conn, 1)[0]
+                if kind == 0:
+                    _recv_exactly(conn, 19)
+                elif kind == 2:
+                    count = struct.unpack("!xH", _recv_exactly(conn, 3))[0]
+                    self.encodings.append(list(struct.unpack(f"!{count}i", _recv_exactly(conn, 4 * count))))
+                elif kind == 3:
+                    incremental = _recv_exactly(conn, 9)[0]
+                    self.requests.append(incremental)
+                    updates += 1
+                    if not incremental:
+                        conn.sendall(self.keyframe())
+                        continue
+                    time.sleep(self.update_delay)
+                    message = (struct.pack("!BxH", 0, 2)
+                               + struct.pack("!HHHHi", 8, 8, 16, 16, 0) + os.urandom(16 * 16 * 4)
+                               + struct.pack("!HHHHi", 30, 30, 16, 16, 5) + b"\x01" + os.urandom(16 * 16 * 4))
+                    if updates % 7 == 0:
+                        message += b"\x02" + struct.pack("!B3xi", 3, 5) + b"hello"
+                    conn.sendall(message)
+                elif kind == 4:
+                    _recv_exactly(conn, 7)
+                elif kind == 5:
+                    _recv_exactly(conn, 5)
+                elif kind == 6:
+                    self.cut_text.append(_recv_exactly(conn, abs(struct.unpack("!3xi", _recv_exactly(conn, 7))[0])))
+                else:
+                    raise ValueError(f"unexpected client message {kind}")
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+
+class WebSocketClient:
+    """Простой блокирующий клиент WebSocket (бинарные кадры) для тестов моста и воспроизведения"""
+
+    def __init__(self, port: int, path: str = "/websockify", timeout: float = 10):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall(
+            f"GET {path} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Protocol: binary\r\n\r\n".encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = self.sock.recv(1)
+            if not chunk:
+                break
+            head += chunk
+        self.status = head.split(b"\r\n")[0]
+        self.buffer = b""
+        self.data = bytearray()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send(self, payload: bytes) -> None:
+        mask = os.urandom(4)
+        size = len(payload)
+        if size < 126:
+            header = struct.pack("!BB", 0x82, 0x80 | size)
+        else:
+            header = struct.pack("!BBH", 0x82, 0x80 | 126, size)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def _recv(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(1 << 20)
+            if not chunk:
+                raise EOFError
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def frame(self) -> bytes:
+        """Данные очередного кадра; EOFError - соединение или WebSocket закрыты"""
+        first, second = self._recv(2)
+        size = second & 0x7F
+        if size == 126:
+            size = struct.unpack("!H", self._recv(2))[0]
+        elif size == 127:
+            size = struct.unpack("!Q", self._recv(8))[0]
+        payload = self._recv(size)
+        if first & 0x0F == 8:
+            raise EOFError(payload)
+        return payload
+
+    def read(self, size: int) -> bytes:
+        while len(self.data) < size:
+            self.data += self.frame()
+        data = bytes(self.data[:size])
+        del self.data[:size]
+        return data
+
+    def read_all(self) -> bytes:
+        """Всё до закрытия соединения (вместе с уже прочитанным остатком)"""
+        try:
+            while True:
+                self.data += self.frame()
+        except (EOFError, OSError):
+            pass
+        return bytes(self.data)
+
+    def rfb_handshake(self) -> bytes:
+        """Рукопожатие RFB 3.8 зрителя, возвращает ServerInit"""
+        assert self.read(12) == b"RFB 003.008\n"
+        self.send(b"RFB 003.008\n")
+        types = self.read(self.read(1)[0])
+        if 2 in types:
+            self.send(b"\x02")
+            self.read(16)
+            self.send(os.urandom(16))
+        else:
+            self.send(b"\x01")
+        assert self.read(4) == b"\0\0\0\0", "authentication failed"
+        self.send(b"\x01")
+        head = self.read(24)
+        return head + self.read(struct.unpack_from("!I", head, 20)[0])
+
@@ -0,0 +1,215 @@
+"""
+Запись и воспроизведение сессий без VNC-сервера: мост подключается к тестовому FakeRFBServer,
+запись читается из index.bin и сегментов и воспроизводится через порт воспроизведения.
+Запуск: python -m unittest discover -s agent/tests
+"""
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_rfb import HEIGHT, WIDTH, FakeRFBServer, WebSocketClient, free_port  # noqa: E402
+from modules.bridge import WebSocketBridge  # noqa: E402
+from modules.recording import (  # noqa: E402
+    INDEX_FILE, REC_GAP, RecordingReader, RecordingStore, RfbServerStream
+)
+
+TOKEN = "token"
+
+
+class ListLogger:
+    def __init__(self):
+        self.lines = []
+
+    def info(self, message):
+        self.lines.append(("INFO", message))
+
+    def debug(self, message):
+        self.lines.append(("DEBUG", message))
+
+    def warning(self, message):
+        self.lines.append(("WARNING", message))
+
+    def error(self, message):
+        self.lines.append(("ERROR", message))
+
+    def problems(self):
+        return [line for line in self.lines if line[0] in ("WARNING", "ERROR")]
+
+
+def view_live(port: int, seconds: float) -> bytes:
+    """Зритель записываемой сессии: запросы обновлений, ввод и буфер обмена; возвращает данные сервера"""
+    client = WebSocketClient(port)
+    client.rfb_handshake()
+    client.send(struct.pack("!B3xBBBBHHHBBB3x", 0, 32, 24, 0, 1, 255, 255, 255, 0, 8, 16))
+    client.send(struct.pack("!BxH10i", 2, 10, 7, 16, -260, 1, 5, 0, -223, -224, -314, -239))
+    client.send(struct.pack("!BBHHHH", 3, 0, 0, 0, WIDTH, HEIGHT))
+    stop = time.monotonic() + seconds
+
+    def pump():
+        sent = 0
+        while time.monotonic() < stop:
+            sent += 1
+            try:
+                if sent % 11 == 0:
+                    # ClientCutText, разбитый на два кадра WebSocket
+                    cut = struct.pack("!B3xi", 6, 3) + b"abc"
+                    client.send(cut[:4])
+                    client.send(cut[4:])
+                    continue
+                message = struct.pack("!BBHHHH", 3, 1, 0, 0, WIDTH, HEIGHT)
+                if sent % 5 == 0:
+                    message += struct.pack("!BBxxI", 4, 1, 0x61)
+                client.send(message)
+            except OSError:
+                return
+            time.sleep(0.02)
+        client.sock.shutdown(socket.SHUT_WR)
+
+    threading.Thread(target=pump, daemon=True).start()
+    data = client.read_all()
+    client.close()
+    return data
+
+
+def play(port: int, query: str):
+    """Воспроизведение записи: (ServerInit, данные сервера, длительность) или (статус, None, None)"""
+    client = WebSocketClient(port, "/playback?" + query)
+    if b" 101 " not in client.status:
+        client.close()
+        return client.status, None, None
+    server_init = client.rfb_handshake()
+    started = time.monotonic()
+    data = client.read_all()
+    client.close()
+    return server_init, data, time.monotonic() - started
+
+
+def server_data(reader: RecordingReader, keyframe) -> bytes:
+    data = b""
+    for item in reader.server_data(keyframe):
+        if item is None:
+            break
+        data += item[1]
+    return data
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="recordings-")
+        self.web_dir = tempfile.mkdtemp(prefix="novnc-")
+        with open(os.path.join(self.web_dir, "vnc.html"), "w") as f:
+            f.write("<html></html>")
+        self.logger = ListLogger()
+        self.vnc_port, self.recorded_port, self.plain_port, self.playback_port = (free_port() for _ in range(4))
+        self.fake = FakeRFBServer(self.vnc_port)
+
+    def tearDown(self):
+        for port in (self.recorded_port, self.plain_port):
+            self.bridge.remove_listener(port)
+        self.fake.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.web_dir, ignore_errors=True)
+
+    def start_bridge(self, **store_options):
+        options = dict(segment_size=20000, keyframe_interval=0.5, max_size=0)
+        options.update(store_options)
+        self.store = RecordingStore(self.logger, self.root, **options)
+        self.bridge = WebSocketBridge(self.logger, self.web_dir, recordings=self.store, playback_token=TOKEN)
+        self.assertTrue(self.bridge.add_listener(self.recorded_port, self.vnc_port, record="alice"))
+        self.assertTrue(self.bridge.add_listener(self.plain_port, self.vnc_port))
+        self.assertTrue(self.bridge.add_playback_listener(self.playback_port))
+
+    def finished_recording(self):
+        deadline = time.monotonic() + 10
+        while self.store.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(self.store.active)
+        recordings = self.store.list()
+        self.assertEqual(len(recordings), 1)
+        return recordings[0]
+
+    def test_round_trip(self):
+        self.start_bridge()
+        stream = view_live(self.recorded_port, 3.0)
+        meta = self.finished_recording()
+        self.assertGreater(meta["size"], len(stream))
+        self.assertNotIn("gaps", meta)
+
+        # Записанному зрителю не разрешаются кодировки с состоянием zlib между кадрами
+        self.assertEqual(self.fake.encodings[0], [-260, 1, 5, 0, -223, -224, -239])
+        self.assertEqual(self.fake.cut_text[0], b"abc")
+
+        path = os.path.join(self.root, meta["id"])
+        self.assertIn(INDEX_FILE, os.listdir(path))
+        self.assertGreater(len([name for name in os.listdir(path) if name.endswith(".rfbrec")]), 1)
+        reader = self.store.reader(meta["id"])
+        self.assertGreaterEqual(len(reader.keyframes), 4)
+
+        # После ServerInit записано всё, что получил зритель; каждый ключевой кадр - начало полного обновления
+        self.assertEqual(server_data(reader, reader.keyframes[0]), stream)
+        for keyframe in reader.keyframes:
+            data = server_data(reader, keyframe)
+            self.assertTrue(stream.endswith(data))
+            self.assertEqual(data[:4], b"\x00\x00\x00\x03")
+            self.assertEqual(struct.unpack_from("!HHHHi", data, 4), (0, 0, WIDTH, HEIGHT // 2, -260))
+
+        # Индекс восстанавливается по записям ключевых кадров в сегментах
+        os.remove(os.path.join(path, INDEX_FILE))
+        self.assertEqual(RecordingReader(path).keyframes, reader.keyframes)
+
+        server_init, data, took = play(self.playback_port, f"recording={meta['id']}&t=0&speed=4&token={TOKEN}")
+        self.assertEqual(struct.unpack_from("!HH", server_init), (WIDTH, HEIGHT))
+        self.assertEqual(data, stream)
+        self.assertLess(took, 3.0 / 4 + 0.5)
+
+        server_init, data, took = play(self.playback_port, f"recording={meta['id']}&t=2&token={TOKEN}")
+        self.assertTrue(stream.endswith(data))
+        self.assertEqual(data[:4], b"\x00\x00\x00\x03")
+
+        self.assertEqual(play(self.playback_port, f"recording={meta['id']}")[0], b"HTTP/1.1 403 Forbidden")
+        self.assertEqual(self.logger.problems(), [])
+
+    def test_unrecorded_port(self):
+        self.start_bridge()
+        view_live(self.plain_port, 0.3)
+        self.assertEqual(self.store.list(), [])
+        self.assertEqual(self.fake.encodings[0][:3], [7, 16, -260])
+
+    def test_queue_overflow(self):
+        self.start_bridge(keyframe_interval=0.2, queue_size=64 * 1024)
+        self.fake.keyframe_size = 200 * 1024
+        # Поток записи занят: очередь переполняется, и записываемые сообщения пропускаются
+        release = threading.Event()
+        self.store.writer.put(release.wait, 10)
+        threading.Timer(1.0, release.set).start()
+        stream = view_live(self.recorded_port, 2.5)
+        meta = self.finished_recording()
+        self.assertGreater(meta["gaps"], 0)
+        self.assertGreater(meta["dropped_bytes"], 0)
+
+        reader = self.store.reader(meta["id"])
+        self.assertTrue(any(kind == REC_GAP for kind, _, _ in reader._scan()))
+        self.assertTrue(reader.keyframes)
+        # Пропуски приходятся на границы сообщений: данные с любого ключевого кадра разбираются без ошибок
+        for keyframe in reader.keyframes:
+            parser = RfbServerStream(lambda pos, init: None, lambda pos: None, lambda: None)
+            parser.security = 1
+            parser.feed(memoryview(b"RFB 003.008\n\x01\x01\0\0\0\0" + reader.server_init(keyframe[4], keyframe[5])))
+            data = server_data(reader, keyframe)
+            parser.feed(memoryview(data))
+            self.assertIsNone(parser.error)
+            self.assertLess(len(data), len(stream))
+
+
+if __name__ == "__main__":
+    unittest.main()
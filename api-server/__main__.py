@@ -1,7 +1,23 @@
+import os
+import socket
 import sys
 from pathlib import Path
+from typing import Optional
 from modules.logger import ServerLogger
-from modules.config import API_SERVER_PORT, API_AUTH_TOKEN, METRICS_UPDATE_INTERVAL, LOG_WHEN, LOG_INTERVAL, LOG_COUNT
+from modules.config import (
+    API_SERVER_PORT, API_AUTH_TOKEN, API_WORKERS, METRICS_UPDATE_INTERVAL, LOG_WHEN, LOG_INTERVAL, LOG_COUNT,
+    NODE_ID, REPLICATION_PEERS, REPLICATION_INTERVAL, REGISTRY_SNAPSHOT, TELEMETRY_MAX_HOSTS, TELEMETRY_RING,
+    RATE_LIMIT_RPS, RATE_LIMIT_BURST, MAX_CONCURRENT_WRITES, READ_PRIORITY_THRESHOLD,
+    VIEW_ONLY_PASS, GATEWAY_PORT, GATEWAY_IDLE_TIMEOUT,
+    THUMBNAIL_INTERVAL, THUMBNAIL_WIDTH, THUMBNAIL_FORMAT, THUMBNAIL_CONCURRENCY
+)
+from modules.limiter import AdmissionController, SharedAdmissionController
+from modules.gateway import VNCGateway
+from modules.thumbnails import ThumbnailService, ThumbnailStore
+from modules.workers import PreforkSupervisor
+from modules.replication import ChangeLog, Replicator
+from modules.lists import HostLists
+from modules.telemetry import TelemetryStore
 from modules.api import (
     ServerRepository,
     ServerManager,
@@ -10,6 +26,112 @@ from modules.api import (
 )
 
 
+def serve(logger: ServerLogger, servers_file: Path, snapshot_file: Path, changes_file: Path, lists_file: Path,
+          telemetry_file: Path, limiter_file: Path, thumbnails_dir: Path, worker: Optional[int] = None) -> None:
+    """
+    Запуск HTTP-сервера в текущем процессе.
+    Args:
+        worker: Номер воркера в режиме нескольких процессов, None - единственный процесс
+    """
+    port = int(API_SERVER_PORT)
+    use_snapshot = str(REGISTRY_SNAPSHOT).lower() == "true"
+    repository = ServerRepository(str(servers_file), logger, str(snapshot_file) if use_snapshot else None)
+    repository.preload()
+
+    # Журнал изменений ведётся, только если есть другие узлы для репликации
+    peers = [peer.strip() for peer in str(REPLICATION_PEERS).split(",") if peer.strip()]
+    changelog = None
+    if peers:
+        changelog = ChangeLog(str(changes_file), str(NODE_ID) or f"{socket.gethostname()}:{port}")
+    lists = HostLists(str(lists_file), logger, changelog)
+    if changelog:
+        with repository.write_lock():
+            changelog.seed(repository.snapshot(), lists.get_all())
+
+    # Кольца замеров агентов в общем для воркеров файле
+    telemetry = None
+    if int(TELEMETRY_MAX_HOSTS) > 0:
+        telemetry = TelemetryStore(str(telemetry_file), logger, int(TELEMETRY_MAX_HOSTS), int(TELEMETRY_RING))
+
+    manager = ServerManager(repository, logger.metrics, changelog, lists, telemetry)
+    auth_token = str(API_AUTH_TOKEN)
+    limits = dict(
+        metrics=logger.metrics,
+        rate=float(RATE_LIMIT_RPS),
+        burst=int(RATE_LIMIT_BURST),
+        max_concurrent_writes=int(MAX_CONCURRENT_WRITES),
+        read_priority_threshold=int(READ_PRIORITY_THRESHOLD)
+    )
+    if worker is None:
+        admission = AdmissionController(**limits)
+    else:
+        # Лимиты общие для всех воркеров, а не по отдельности на каждый
+        admission = SharedAdmissionController(str(limiter_file), worker, int(API_WORKERS), **limits)
+
+    # Запуск сервера
+    server = ServerHTTPServer(
+        manager=manager,
+        metrics=logger.metrics,
+        server_address=("", port),
+        auth_token=auth_token,
+        RequestHandlerClass=ServerRequestHandler,
+        admission=admission,
+        reuse_port=worker is not None
+    )
+    if worker is not None:
+        server.register_metrics("worker", lambda: {"index": worker, "pid": os.getpid()})
+    if telemetry is not None:
+        server.register_metrics("telemetry", telemetry.summary)
+
+    # Репликация, шлюз и снимки экранов работают в одном процессе: единственном или воркере 0
+    background = not worker
+
+    # Получение изменений реестра от других узлов
+    if peers and background:
+        replicator = Replicator(logger, manager, peers, float(REPLICATION_INTERVAL))
+        replicator.start()
+        server.register_metrics("replication", replicator.get_stats)
+
+    # Запуск шлюза VNC для режима просмотра
+    if int(GATEWAY_PORT) and background:
+        gateway = VNCGateway(
+            logger=logger,
+            manager=manager,
+            port=int(GATEWAY_PORT),
+            password=str(VIEW_ONLY_PASS),
+            idle_timeout=float(GATEWAY_IDLE_TIMEOUT)
+        )
+        gateway.start()
+        server.register_metrics("gateway", gateway.get_stats)
+
+    # Запуск снимков экранов хостов для плиток
+    if float(THUMBNAIL_INTERVAL) > 0:
+        # Остальные воркеры отдают миниатюры из общего каталога
+        store = ThumbnailStore(str(thumbnails_dir)) if worker is not None else None
+        if background:
+            thumbnails = ThumbnailService(
+                logger=logger,
+                manager=manager,
+                password=str(VIEW_ONLY_PASS),
+                interval=float(THUMBNAIL_INTERVAL),
+                max_width=int(THUMBNAIL_WIDTH),
+                image_format=str(THUMBNAIL_FORMAT),
+                concurrency=int(THUMBNAIL_CONCURRENCY),
+                store=store
+            )
+            thumbnails.start()
+            server.thumbnails = thumbnails
+            server.register_metrics("thumbnails", thumbnails.get_stats)
+        else:
+            server.thumbnails = store
+
+    if worker is None:
+        logger.info(f"Starting server on port {port}")
+    else:
+        logger.info(f"Starting server on port {port} (worker {worker}, pid {os.getpid()})")
+    server.serve_forever()
+
+
 def main():
     # Конфигурация путей
     BASE_DIR = Path(__file__).parent
@@ -17,6 +139,12 @@ def main():
     LOG_DIR = DATA_DIR / "log"
     LOG_FILE = LOG_DIR / "server.log"
     SERVERS_FILE = DATA_DIR / "servers.json"
+    SNAPSHOT_FILE = DATA_DIR / "servers.snap"
+    CHANGES_FILE = DATA_DIR / "changes.jsonl"
+    LISTS_FILE = DATA_DIR / "lists.json"
+    TELEMETRY_FILE = DATA_DIR / "telemetry.bin"
+    LIMITER_FILE = DATA_DIR / "limiter.bin"
+    THUMBNAILS_DIR = DATA_DIR / "thumbnails"
 
     # Инициализация стартового логгера
     logger = ServerLogger(str(LOG_FILE), level='INFO')
@@ -39,31 +167,38 @@ def main():
                 when=str(LOG_WHEN),
                 interval=int(LOG_INTERVAL),
                 count=int(LOG_COUNT))
-            metrics_thread = logger.start_metrics_reporter(int(METRICS_UPDATE_INTERVAL))
         except Exception as e:
             logger.critical(f"Failed to configure logger: {e}")
             sys.exit(1)
 
-        # Инициализация компонентов сервера
-        repository = ServerRepository(str(SERVERS_FILE), logger)
-        manager = ServerManager(repository, logger.metrics)
-        port = int(API_SERVER_PORT)
-        auth_token = str(API_AUTH_TOKEN)
-
-        # Запуск сервера
-        server = ServerHTTPServer(
-            manager=manager,
-            metrics=logger.metrics,
-            server_address=("", port),
-            auth_token=auth_token,
-            RequestHandlerClass=ServerRequestHandler
-        )
-
-        logger.info(f"Starting server on port {port}")
         logger.info(f"Servers data file: {SERVERS_FILE}")
         logger.info(f"Log file: {LOG_FILE}")
 
-        server.serve_forever()
+        workers = int(API_WORKERS)
+        if workers <= 1:
+            metrics_thread = logger.start_metrics_reporter(int(METRICS_UPDATE_INTERVAL))
+            serve(logger, SERVERS_FILE, SNAPSHOT_FILE, CHANGES_FILE, LISTS_FILE, TELEMETRY_FILE, LIMITER_FILE,
+                  THUMBNAILS_DIR)
+            return
+
+        def run_worker(index: int) -> None:
+            # Отдельный файл лога на воркер: ротация одного файла из нескольких процессов небезопасна
+            worker_logger = ServerLogger(
+                str(LOG_DIR / f"server-{index}.log"),
+                level='DEBUG',
+                fmt=ServerLogger.DEFAULT_FORMAT,
+                when=str(LOG_WHEN),
+                interval=int(LOG_INTERVAL),
+                count=int(LOG_COUNT))
+            worker_logger.start_metrics_reporter(int(METRICS_UPDATE_INTERVAL))
+            serve(worker_logger, SERVERS_FILE, SNAPSHOT_FILE, CHANGES_FILE, LISTS_FILE, TELEMETRY_FILE, LIMITER_FILE,
+                  THUMBNAILS_DIR, worker=index)
+
+        # Воркеры распределяют запросы по ядрам, лишние только переключают контекст (benchmarks/api_workers.py)
+        if workers > (os.cpu_count() or 1):
+            logger.warning(f"API_WORKERS={workers} exceeds the number of CPUs ({os.cpu_count()})")
+        logger.info(f"Starting {workers} worker processes")
+        PreforkSupervisor(logger, workers, run_worker).run()
 
     except KeyboardInterrupt:
         logger.info("Server shutdown by user request")
@@ -1,68 +1,719 @@
+import os
+import sys
+import gzip
+import time
 import json
+import fcntl
+import socket
+import threading
 import urllib.request
-from urllib.parse import urlparse, parse_qs
-from typing import List, Dict, Any, Optional
+from bisect import bisect_right
+from collections import deque
+from collections.abc import MutableMapping
+from urllib.parse import urlparse, parse_qs, unquote
+from typing import List, Dict, Any, Optional, Callable, Tuple, Iterator, Iterable, Set
+from contextlib import contextmanager
+from operator import itemgetter
+from socketserver import ThreadingMixIn
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from .logger import ServerLogger, ConnectionMetrics
+from .limiter import AdmissionController
+from .replication import ChangeLog
+from .query import ServerQuery, Reachability, RegistryIndex, SORT_KEYS, project
+from .search import SearchIndex
+from .lists import HostLists
+from .snapshot import read_snapshot, write_snapshot
+from .telemetry import TelemetryStore
+
+
+# Отсутствующее поле записи хоста
+_MISSING = object()
+
+# Общие экземпляры номеров портов: у большинства хостов они совпадают
+_PORTS: Dict[int, int] = {}
+
+# Поля процесса в сведениях агента, которые хранятся кортежем
+_PROCESS_FIELDS = ("port", "restarts", "uptime")
+
+# Строки октетов для обратного преобразования IPv4 из числа
+_OCTETS = tuple(str(i) for i in range(256))
+
+# Строка в JSON (как в json.dumps с ensure_ascii)
+_encode_str = json.encoder.encode_basestring_ascii
+
+# JSON обычной записи агента (без поля excluded и закрывающей скобки) и процесса из кортежа
+_AGENT_JSON = ('{"ip": "%s.%s.%s.%s", "session": %s, "username": %s, "vnc_port": %d, "websockify_port": %d, '
+               '"processes": {%s}')
+_PROCESS_JSON = '%s: {"port": %d, "restarts": %d, "uptime": %d}'
+
+
+def _intern_str(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def _intern_port(value: Any) -> Any:
+    return _PORTS.setdefault(value, value) if type(value) is int else value
+
+
+def _pack_ip(ip: Any) -> Any:
+    """IPv4 - число, остальные значения хранятся как есть (IPv6, нестандартная запись)"""
+    if type(ip) is str:
+        try:
+            packed = socket.inet_pton(socket.AF_INET, ip)
+        except OSError:
+            return ip
+        if socket.inet_ntop(socket.AF_INET, packed) == ip:
+            return int.from_bytes(packed, "big")
+    return ip
+
+
+def _pack_processes(processes: Any) -> Any:
+    """Сведения о процессах {имя: {port, restarts, uptime}} с целыми значениями - кортежами, иной формат - как есть"""
+    if type(processes) is not dict:
+        return processes
+    packed = []
+    for name, stats in processes.items():
+        if type(stats) is not dict or tuple(stats) != _PROCESS_FIELDS:
+            return processes
+        values = tuple(stats.values())
+        if not all(type(v) is int for v in values):
+            return processes
+        packed.append((sys.intern(name), *(_intern_port(v) for v in values)))
+    return tuple(packed)
+
+
+def _encode_value(value: Any) -> str:
+    """Значение поля в JSON: частые типы без json.dumps"""
+    kind = type(value)
+    if kind is str:
+        return _encode_str(value)
+    if kind is int:
+        return int.__repr__(value)
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    return json.dumps(value, default=_json_default)
+
+
+# Поля записи хоста: слот и преобразование значения при записи, в порядке ключей JSON
+_FIELDS = {
+    "ip": ("_ip", _pack_ip),
+    "session": ("_session", _intern_str),
+    "username": ("_username", _intern_str),
+    "vnc_port": ("_vnc_port", _intern_port),
+    "websockify_port": ("_websockify_port", _intern_port),
+    "processes": ("_processes", _pack_processes),
+    "excluded": ("_excluded", lambda value: value),
+}
+
+
+class HostRecord(MutableMapping):
+    """
+    Компактная запись хоста в реестре.
+    Поля агента лежат в слотах вместо словаря: IPv4 хранится числом, имя пользователя и сессия
+    интернированы, сведения о процессах - кортежами. Запись ведёт себя как словарь с прежними
+    ключами и сериализуется в тот же JSON; неизвестные поля хранятся в отдельном словаре.
+    """
+
+    __slots__ = tuple(slot for slot, _ in _FIELDS.values()) + ("_extra",)
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        data = dict(data or {})
+        for key, (slot, pack) in _FIELDS.items():
+            value = data.pop(key, _MISSING)
+            setattr(self, slot, value if value is _MISSING else pack(value))
+        self._extra = data or None
+
+    @property
+    def ip_number(self) -> Optional[int]:
+        """IPv4 числом (None для иных адресов)"""
+        return self._ip if type(self._ip) is int else None
+
+    def _value(self, key: str) -> Any:
+        if key == "ip":
+            ip = self._ip
+            if type(ip) is int:
+                return ".".join((_OCTETS[ip >> 24], _OCTETS[ip >> 16 & 255], _OCTETS[ip >> 8 & 255], _OCTETS[ip & 255]))
+            return ip
+        if key == "session":
+            return self._session
+        if key == "username":
+            return self._username
+        if key == "excluded":
+            return self._excluded
+        if key == "vnc_port":
+            return self._vnc_port
+        if key == "websockify_port":
+            return self._websockify_port
+        if key == "processes":
+            processes = self._processes
+            if type(processes) is tuple:
+                return {name: dict(zip(_PROCESS_FIELDS, stats)) for name, *stats in processes}
+            return processes
+        return self._extra.get(key, _MISSING) if self._extra else _MISSING
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._value(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._value(key)
+        return default if value is _MISSING else value
+
+    def __contains__(self, key: object) -> bool:
+        return type(key) is str and self._value(key) is not _MISSING
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        field = _FIELDS.get(key)
+        if field is not None:
+            setattr(self, field[0], field[1](value))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        field = _FIELDS.get(key)
+        if field is not None:
+            setattr(self, field[0], _MISSING)
+        else:
+            del self._extra[key]
+
+    def __iter__(self) -> Iterator[str]:
+        for key, (slot, _) in _FIELDS.items():
+            if getattr(self, slot) is not _MISSING:
+                yield key
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, HostRecord):
+            return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Запись в прежнем виде словаря (для JSON)"""
+        return {key: self._value(key) for key in self}
+
+    def __repr__(self) -> str:
+        return f"HostRecord({self.to_dict()!r})"
+
+    def to_json(self, fields: Optional[Tuple[str, ...]] = None) -> str:
+        """
+        JSON записи прямо из слотов, без промежуточного словаря.
+        Совпадает с json.dumps(to_dict()) или, если заданы поля, с json.dumps записи из project.
+        """
+        ip, session, username = self._ip, self._session, self._username
+        vnc_port, websockify_port, processes = self._vnc_port, self._websockify_port, self._processes
+        if (fields is None and self._extra is None and type(ip) is int and type(session) is str
+                and type(username) is str and type(vnc_port) is int and type(websockify_port) is int
+                and type(processes) is tuple):
+            # Обычная запись агента - одним шаблоном
+            text = _AGENT_JSON % (
+                _OCTETS[ip >> 24], _OCTETS[ip >> 16 & 255], _OCTETS[ip >> 8 & 255], _OCTETS[ip & 255],
+                _encode_str(session), _encode_str(username), vnc_port, websockify_port,
+                ", ".join([_PROCESS_JSON % (_encode_str(name), *stats) for name, *stats in processes]))
+            if self._excluded is _MISSING:
+                return text + "}"
+            return f'{text}, "excluded": {_encode_value(self._excluded)}}}'
+
+        parts = []
+        for key in (self if fields is None else fields):
+            field = _FIELDS.get(key)
+            value = getattr(self, field[0]) if field else self._extra.get(key, _MISSING) if self._extra else _MISSING
+            if value is _MISSING:
+                if key != "excluded" or fields is None:
+                    continue
+                value = False
+            if key == "ip" and type(value) is int:
+                value = self._value("ip")
+            elif key == "processes" and type(value) is tuple:
+                parts.append('"processes": {' + ", ".join([_PROCESS_JSON % (_encode_str(name), *stats)
+                                                           for name, *stats in value]) + "}")
+                continue
+            parts.append(f"{_encode_str(key)}: {_encode_value(value)}")
+        return "{" + ", ".join(parts) + "}"
+
+    def state(self) -> tuple:
+        """Значения слотов для бинарного снимка реестра (отсутствующее поле - Ellipsis)"""
+        return tuple(... if value is _MISSING else value for value in (
+            self._ip, self._session, self._username, self._vnc_port, self._websockify_port,
+            self._processes, self._excluded, self._extra))
+
+    def copy(self) -> "HostRecord":
+        """Копия для изменения: записи реестра общие для читателей и сами не изменяются"""
+        record = HostRecord.from_state(self.state())
+        record._extra = dict(self._extra) if self._extra else None
+        return record
+
+    @classmethod
+    def from_state(cls, state: tuple) -> "HostRecord":
+        """Запись из значений слотов без повторной упаковки полей (строки уже интернированы marshal)"""
+        ip, session, username, vnc_port, websockify_port, processes, excluded, extra = state
+        record = cls.__new__(cls)
+        record._ip = _MISSING if ip is ... else ip
+        record._session = _MISSING if session is ... else session
+        record._username = _MISSING if username is ... else username
+        record._vnc_port = _MISSING if vnc_port is ... else _intern_port(vnc_port)
+        record._websockify_port = _MISSING if websockify_port is ... else _intern_port(websockify_port)
+        record._processes = _MISSING if processes is ... else processes
+        record._excluded = _MISSING if excluded is ... else excluded
+        record._extra = extra
+        return record
+
+
+def _key_list(key) -> Optional[List[int]]:
+    """Ключ файла в заголовке журнала реестра (JSON)"""
+    return list(key) if key else None
+
+
+def _json_default(value: Any) -> Any:
+    """Сериализация записей хостов в json.dumps"""
+    if isinstance(value, HostRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
 
 class ServerRepository:
-    """Класс для работы с хранилищем данных сервера"""
+    """
+    Класс для работы с хранилищем данных сервера.
+    Реестр на диске - файл servers.json (и его бинарный снимок) и журнал изменений servers.json.journal:
+    изменение IP дописывается в журнал одной строкой и применяется к записям в памяти, а файл реестра
+    переписывается целиком, только когда журнал сжимается в фоновом потоке.
+    Файлы общие для всех процессов API-сервера: изменения сериализуются блокировкой flock,
+    а процесс дочитывает новые строки журнала, только если файлы изменились.
+    """
+
+    # Журнал сжимается в файл реестра, когда в нём больше COMPACT_LINES строк и больше COMPACT_RATIO от числа IP
+    COMPACT_LINES = 1000
+    COMPACT_RATIO = 0.1
+    # Число последних версий, для которых известны изменившиеся IP
+    CHANGES_KEPT = 1024
 
-    def __init__(self, servers_file: str, logger: ServerLogger):
+    def __init__(self, servers_file: str, logger: ServerLogger, snapshot_file: Optional[str] = None):
         """
         Args:
             servers_file: Путь к файлу с данными серверов
             logger: Экземпляр ServerLogger для логирования
+            snapshot_file: Путь к бинарному снимку реестра рядом с JSON (None - только JSON)
         """
         self.servers_file = servers_file
+        self.snapshot_file = snapshot_file
+        self.journal_file = f"{servers_file}.journal"
+        self.lock_file = f"{servers_file}.lock"
         self.logger = logger
 
-    def load_servers(self) -> List[Dict[str, Any]]:
-        """Загрузка списка серверов из файла"""
+        # Блокировка записи: RLock между потоками процесса, flock между процессами
+        self._write_lock = threading.RLock()
+        self._lock_fd: Optional[int] = None
+        self._lock_depth = 0
+
+        # Записи в памяти по IP в порядке реестра (под блокировкой записи), ключи файла реестра и журнала,
+        # из которых они прочитаны, позиция и число прочитанных строк журнала
+        self._hosts: Dict[str, List[HostRecord]] = {}
+        self._state: Optional[Tuple[Any, Optional[int]]] = None
+        self._journal_offset = 0
+        self._journal_lines = 0
+        self._compacting = False
+
+        # Список записей для читателей, собирается при первом чтении новой версии
+        self._snapshot_lock = threading.Lock()
+        self._snapshot: Optional[List[HostRecord]] = None
+        self.version = 0
+
+        # IP, изменившиеся в последних версиях, для обновления индексов по изменениям:
+        # (версия, IP) и версия, до которой изменения неизвестны (реестр прочитан целиком)
+        self._changes = deque(maxlen=self.CHANGES_KEPT)
+        self._changes_base = 0
+        self._dirty: Optional[Set[str]] = set()
+
+    @contextmanager
+    def write_lock(self):
+        """Монопольная блокировка реестра на время read-modify-write (повторно входимая)"""
+        with self._write_lock:
+            if self._lock_depth == 0:
+                self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    os.close(self._lock_fd)  # Закрытие дескриптора снимает flock
+                    self._lock_fd = None
+
+    def _file_key(self):
+        try:
+            st = os.stat(self.servers_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _journal_stat(self) -> Tuple[Optional[int], int]:
+        try:
+            st = os.stat(self.journal_file)
+        except FileNotFoundError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def snapshot(self) -> List[HostRecord]:
+        """
+        Текущий список серверов для чтения.
+        Новые строки журнала дочитываются, только если файлы изменил другой процесс.
+        Возвращаемый список общий для всех читателей и не должен изменяться.
+        """
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self) -> Tuple[int, List[HostRecord]]:
+        """Текущий список серверов и номер его версии (растёт при каждом изменении реестра в процессе)"""
+        key = self._file_key()
+        ino, size = self._journal_stat()
+        with self._snapshot_lock:
+            if self._snapshot is not None and (key, ino) == self._state and size == self._journal_offset:
+                return self.version, self._snapshot
+        with self.write_lock():
+            self._catch_up()
+            return self.version, self._current()
+
+    def _current(self) -> List[HostRecord]:
+        """Список записей текущей версии (под блокировкой записи)"""
+        with self._snapshot_lock:
+            if self._snapshot is None:
+                self._snapshot = [server for servers in self._hosts.values() for server in servers]
+            return self._snapshot
+
+    def _publish(self) -> None:
+        """Новая версия реестра после изменения записей в памяти"""
+        with self._snapshot_lock:
+            self._snapshot = None
+            self.version += 1
+            if self._dirty is None:
+                self._changes.clear()
+                self._changes_base = self.version
+            else:
+                self._changes.append((self.version, self._dirty))
+            self._dirty = set()
+
+    def changes_since(self, version: int) -> Optional[Dict[str, List[HostRecord]]]:
+        """
+        Текущие записи IP, изменившихся после версии version (пустой список - IP удалён).
+        Записи могут быть новее текущей версии: повторное применение изменения ничего не меняет.
+        Returns:
+            None, если изменения неизвестны (реестр перечитан целиком или версия слишком старая)
+        """
+        with self._snapshot_lock:
+            if version < self._changes_base:
+                return None
+            if version < self.version and (not self._changes or self._changes[0][0] > version + 1):
+                return None
+            changed = set()
+            for changed_version, ips in self._changes:
+                if changed_version > version:
+                    changed |= ips
+            return {ip: self._hosts.get(ip, []) for ip in changed}
+
+    def preload(self) -> None:
+        """
+        Чтение реестра при запуске, до приёма запросов.
+        Если бинарного снимка нет или он устарел (файл JSON изменили вручную), снимок создаётся заново.
+        """
+        start = time.perf_counter()
+        with self.write_lock():
+            key = self._file_key()
+            servers, from_snapshot = self._read(key)
+            if key and self.snapshot_file and not from_snapshot:
+                self._write_snapshot(self.snapshot_file, servers, key)
+            self._reset(key, servers)
+            self._replay()
+            self._publish()
+            count, changes = len(servers), self._journal_lines
+        source = self.snapshot_file if from_snapshot else self.servers_file
+        self.logger.info(f"Registry loaded: {count} hosts from {source} and {changes} journal changes "
+                         f"in {time.perf_counter() - start:.2f}s")
+
+    def _reset(self, key, servers: List[HostRecord]) -> None:
+        """Записи в памяти из файла реестра, журнал будет прочитан с начала"""
+        hosts: Dict[str, List[HostRecord]] = {}
+        for server in servers:
+            hosts.setdefault(server["ip"], []).append(server)
+        self._hosts = hosts
+        self._state = (key, self._journal_stat()[0])
+        self._journal_offset = self._journal_lines = 0
+        self._dirty = None
+
+    def _catch_up(self) -> None:
+        """Применение изменений других процессов: новых строк журнала или сжатого журнала (под блокировкой записи)"""
+        key = self._file_key()
+        ino, size = self._journal_stat()
+        if (key, ino) != self._state:
+            if self._continues(key, ino):
+                # Новый журнал продолжает прочитанный: его строки применяются к записям в памяти повторно
+                self._state = (key, ino)
+                self._journal_offset = self._journal_lines = 0
+            else:
+                servers, _ = self._read(key)
+                self._reset(key, servers)
+        elif size == self._journal_offset:
+            return
+        self._replay()
+        self._publish()
+
+    def _continues(self, key, ino: Optional[int]) -> bool:
+        """
+        Журнал ino создан поверх реестра в памяти: заведён для того же файла реестра
+        или сжат другим процессом из уже прочитанной части прежнего журнала.
+        """
+        if self._state is None or ino is None:
+            return False
+        try:
+            with open(self.journal_file, "rb") as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError):
+            return False
+        if header.get("base") != _key_list(key):
+            return False
+        source = header.get("from")
+        if source is None:
+            return self._state == (key, None)
+        return (source[:2] == [_key_list(self._state[0]), self._state[1]]
+                and self._journal_offset >= source[2])
+
+    def _replay(self) -> None:
+        """Применение строк журнала после прочитанной позиции (под блокировкой записи)"""
+        if self._state[1] is None:
+            return
+        try:
+            with open(self.journal_file, "rb") as f:
+                f.seek(self._journal_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Строка ещё дописывается
+                    change = json.loads(line)
+                    if "ip" in change:
+                        self._apply(change["ip"], [HostRecord(entry) for entry in change["entries"]],
+                                    change.get("move_to_end", False))
+                        self._journal_lines += 1
+                    self._journal_offset += len(line)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to read {self.journal_file}: {e}")
+
+    def _apply(self, ip: str, entries: List[HostRecord], move_to_end: bool) -> None:
+        if self._dirty is not None:
+            self._dirty.add(ip)
+        if move_to_end or not entries:
+            self._hosts.pop(ip, None)
+        if entries:
+            self._hosts[ip] = entries
+
+    def entries(self, ips: Iterable[str]) -> Dict[str, List[HostRecord]]:
+        """
+        Текущие записи IP (только существующих) для изменения через update.
+        Вызывается под блокировкой записи; записи общие с читателями и изменяются только в копиях.
+        """
+        self._catch_up()
+        return {ip: self._hosts[ip] for ip in ips if ip in self._hosts}
+
+    def update(self, changes: Dict[str, List[HostRecord]], move_to_end: bool = False) -> bool:
+        """
+        Замена записей IP (пустой список - удаление): строка журнала на каждый IP и изменение записей в памяти.
+        Вызывается под блокировкой записи.
+        Args:
+            changes: Новые записи по IP
+            move_to_end: Перенести записи в конец реестра (регистрация), иначе они остаются на прежнем месте
+        """
+        extra = {"move_to_end": True} if move_to_end else {}
+        data = "".join(json.dumps({"ip": ip, "entries": entries, **extra}, default=_json_default) + "\n"
+                       for ip, entries in changes.items()).encode()
+        try:
+            self._catch_up()
+            if self._state[1] is None:
+                self._start_journal({"base": _key_list(self._state[0]), "from": None}, b"")
+            with open(self.journal_file, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            self.logger.error(f"Failed to save to {self.journal_file}: {e}")
+            return False
+        self._journal_offset += len(data)
+        self._journal_lines += len(changes)
+        for ip, entries in changes.items():
+            self._apply(ip, entries, move_to_end)
+        self._publish()
+
+        if not self._compacting and self._journal_lines > max(self.COMPACT_LINES, self.COMPACT_RATIO * len(self._hosts)):
+            self._compacting = True
+            threading.Thread(target=self._compact, args=(self._current(), self._state, self._journal_offset),
+                             name="registry-compact", daemon=True).start()
+        return True
+
+    def _start_journal(self, header: Dict[str, Any], tail: bytes) -> None:
+        """Замена журнала новым: заголовок и перенесённые строки (под блокировкой записи)"""
+        head = (json.dumps(header) + "\n").encode()
+        tmp_file = f"{self.journal_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(head + tail)
+        os.replace(tmp_file, self.journal_file)
+        self._state = (self._state[0], self._journal_stat()[0])
+        self._journal_offset = len(head) + len(tail)
+        self._journal_lines = tail.count(b"\n")
+
+    def _compact(self, servers: List[HostRecord], state, offset: int) -> None:
+        """
+        Сжатие журнала: реестр версии state/offset записывается в новый файл реестра без блокировки,
+        затем под блокировкой файлы заменяются, а строки, дописанные за это время, переносятся в новый журнал.
+        """
+        start = time.perf_counter()
+        # Свои временные файлы: журнал может одновременно сжимать и другой процесс
+        tmp_file = f"{self.servers_file}.{os.getpid()}.tmp"
+        snapshot_tmp = f"{self.snapshot_file}.{os.getpid()}.next" if self.snapshot_file else None
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(servers, f, indent=4, default=_json_default)
+            st = os.stat(tmp_file)
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)  # Переименование не меняет ключ файла
+            if snapshot_tmp:
+                self._write_snapshot(snapshot_tmp, servers, key)
+            with self.write_lock():
+                self._catch_up()
+                if self._state != state:
+                    self.logger.info("Registry journal was compacted by another process")
+                    return
+                with open(self.journal_file, "rb") as f:
+                    f.seek(offset)
+                    tail = f.read(self._journal_offset - offset)
+                os.replace(tmp_file, self.servers_file)
+                if snapshot_tmp and os.path.exists(snapshot_tmp):
+                    os.replace(snapshot_tmp, self.snapshot_file)
+                self._state = (key, self._state[1])
+                self._start_journal({"base": _key_list(key), "from": [_key_list(state[0]), state[1], offset]}, tail)
+            self.logger.info(f"Registry journal compacted: {len(servers)} hosts written to {self.servers_file} "
+                             f"in {time.perf_counter() - start:.2f}s")
+        except OSError as e:
+            self.logger.error(f"Failed to save to {self.servers_file}: {e}")
+        finally:
+            self._compacting = False
+            for path in (tmp_file, snapshot_tmp):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def _read(self, key) -> Tuple[List[HostRecord], bool]:
+        """
+        Чтение файла реестра: из бинарного снимка, если он сделан для текущего файла JSON, иначе из JSON.
+        Returns:
+            (записи, прочитаны ли они из снимка)
+        """
+        if key and self.snapshot_file:
+            try:
+                servers = read_snapshot(self.snapshot_file, key, HostRecord.from_state)
+                if servers is not None:
+                    return servers, True
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Registry snapshot ignored: {e}")
         try:
             with open(self.servers_file, "r") as f:
-                return json.load(f)
+                return [HostRecord(server) for server in json.load(f)], False
         except FileNotFoundError:
-            return []
+            return [], False
         except json.JSONDecodeError as e:
             self.logger.error(f"JSON decode error in {self.servers_file}: {e}")
-            return []
+            return [], False
 
-    def save_servers(self, servers: List[Dict[str, Any]]) -> bool:
-        """Сохранение списка серверов в файл"""
+    def _write_snapshot(self, path: str, servers: List[HostRecord], key) -> None:
         try:
-            with open(self.servers_file, "w") as f:
-                json.dump(servers, f, indent=4)
-            return True
-        except IOError as e:
-            self.logger.error(f"Failed to save to {self.servers_file}: {e}")
-            return False
+            write_snapshot(path, key, (server.state() for server in servers), len(servers))
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Failed to write registry snapshot {path}: {e}")
 
 
 class ServerManager:
     """Класс для управления серверами"""
 
-    def __init__(self, repository: ServerRepository, metrics: ConnectionMetrics):
+    def __init__(self, repository: ServerRepository, metrics: ConnectionMetrics,
+                 changelog: Optional[ChangeLog] = None, lists: Optional[HostLists] = None,
+                 telemetry: Optional[TelemetryStore] = None):
         """
         Args:
             repository: Экземпляр ServerRepository
             metrics: Экземпляр ConnectionMetrics для сбора статистики
+            changelog: Журнал изменений для репликации на другие узлы (None - без репликации)
+            lists: Именованные списки хостов (None - списки не поддерживаются)
+            telemetry: Замеры нагрузки хостов от агентов (None - не сохраняются)
         """
         self.repository = repository
         self.metrics = metrics
+        self.changelog = changelog
+        self.lists = lists
+        self.telemetry = telemetry
         self.logger = repository.logger
 
+        # Закодированные ответы GET /api/servers: (include_excluded, поля, gzip) -> (версия реестра, тело)
+        self._bodies: Dict[Tuple[bool, Optional[Tuple[str, ...]], bool], Tuple[int, bytes]] = {}
+        self._bodies_lock = threading.Lock()
+        # Индексы для запросов с фильтрами и версия реестра, которой они соответствуют
+        self._index: Optional[RegistryIndex] = None
+        self._index_version = -1
+        self._index_lock = threading.Lock()
+        # Последний результат проверки доступности по IP (в пределах процесса)
+        self.reachability = Reachability()
+        # Поисковый индекс по пользователям и IP и версия реестра, которой он соответствует
+        self.search_index = SearchIndex()
+        self._search_version = -1
+        self._search_lock = threading.Lock()
+
+    def _save(self, changes: Dict[str, List[HostRecord]], revisions: Optional[Dict[str, List]] = None,
+              move_to_end: bool = False) -> bool:
+        """Сохранение новых записей IP в реестр и в журнал репликации (под блокировкой записи)"""
+        if not self.repository.update(changes, move_to_end):
+            return False
+        if self.changelog:
+            try:
+                self.changelog.record([server for entries in changes.values() for server in entries],
+                                      changes, revisions)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Failed to record changes for replication: {e}")
+        return True
+
     def register_server(self, server_data: Dict[str, Any]) -> bool:
-        """Регистрация нового сервера"""
+        """
+        Регистрация сервера.
+        Принимает либо одну запись хоста, либо {"ip": ..., "sessions": [...]}
+        со всеми графическими сессиями хоста, которые заменяют прежние записи этого IP.
+        Замер нагрузки в поле telemetry сохраняется отдельно от реестра.
+        """
         try:
-            servers = self.repository.load_servers()
-            servers = [s for s in servers if s["ip"] != server_data["ip"]]
-            servers.append(server_data)
-            if self.repository.save_servers(servers):
-                self.metrics.increment("register_success")
-                self.logger.info(f"Server registered: {server_data.get('ip', 'unknown')}")
-                return True
+            telemetry = server_data.pop("telemetry", None)
+            if telemetry is not None:
+                try:
+                    self.record_telemetry(server_data["ip"], telemetry)
+                except ValueError as e:
+                    self.logger.warning(f"Telemetry of {server_data['ip']} ignored: {e}")
+            if "sessions" in server_data:
+                entries = [HostRecord({"ip": server_data["ip"], **session}) for session in server_data["sessions"]]
+            else:
+                entries = [HostRecord(server_data)]
+            with self.repository.write_lock():
+                if self._save({server_data["ip"]: entries}, move_to_end=True):
+                    self.metrics.increment("register_success")
+                    # Пользователи в сообщении - для отбора записей лога по имени (modules.logquery --user)
+                    usernames = sorted({s.get("username") for s in server_data.get("sessions", [server_data])
+                                        if s.get("username")})
+                    self.logger.info(f"Server registered: {server_data.get('ip', 'unknown')}"
+                                     + (f" ({', '.join(usernames)})" if usernames else ""))
+                    return True
             self.metrics.increment("register_failed")
             self.logger.error(f"Failed to save server registration: {server_data.get('ip', 'unknown')}")
             return False
@@ -73,71 +724,83 @@ class ServerManager:
 
     def exclude_server(self, ip: str) -> bool:
         """Исключение сервера по IP"""
+        return self.exclude_servers([ip])
+
+    def exclude_servers(self, ips: List[str]) -> bool:
+        """Исключение серверов по списку IP с одним сохранением"""
         try:
-            servers = self.repository.load_servers()
-            server_found = False
-            for server in servers:
-                if server["ip"] == ip:
-                    server["excluded"] = True
-                    server_found = True
+            with self.repository.write_lock():
+                targets = set(ips)
+                changes = {ip: [server.copy() for server in entries]
+                           for ip, entries in self.repository.entries(targets).items()}
+                found = set(changes)
+                for ip, entries in changes.items():
+                    for server in entries:
+                        server["excluded"] = True
                     self.logger.info(f"Server marked as excluded: {ip}")
-                    break
 
-            if not server_found:
-                self.logger.warning(f"Server not found for exclusion: {ip}")
-                self.metrics.increment("exclude_not_found")
-                return False
+                for ip in targets - found:
+                    self.logger.warning(f"Server not found for exclusion: {ip}")
+                    self.metrics.increment("exclude_not_found")
+                if not found:
+                    return False
 
-            if self.repository.save_servers(servers):
-                self.metrics.increment("exclude_success")
-                return True
-            else:
-                self.metrics.increment("exclude_failed")
-                self.logger.error(f"Failed to save exclusion for server: {ip}")
-                return False
+                if self._save(changes):
+                    self.metrics.increment("exclude_success")
+                    return True
+                else:
+                    self.metrics.increment("exclude_failed")
+                    self.logger.error(f"Failed to save exclusion for servers: {sorted(found)}")
+                    return False
 
         except Exception as e:
             self.metrics.increment("exclude_error")
-            self.logger.error(f"Exclusion error for {ip}: {e}")
+            self.logger.error(f"Exclusion error for {ips}: {e}")
             return False
 
     def include_server(self, ip: str) -> bool:
         """Включение сервера по IP"""
+        return self.include_servers([ip])
+
+    def include_servers(self, ips: List[str]) -> bool:
+        """Включение серверов по списку IP с одним сохранением"""
         try:
-            servers = self.repository.load_servers()
-            server_found = False
-            for server in servers:
-                if server["ip"] == ip:
-                    if "excluded" in server:
-                        del server["excluded"]
-                        server_found = True
-                        self.logger.info(f"Server included back: {ip}")
-                    else:
-                        self.logger.info(f"Server was not excluded: {ip}")
-                        server_found = True
-                    break
-
-            if not server_found:
-                self.logger.warning(f"Server not found for inclusion: {ip}")
-                self.metrics.increment("include_not_found")
-                return False
-            if self.repository.save_servers(servers):
-                self.metrics.increment("include_success")
-                return True
-            else:
-                self.metrics.increment("include_failed")
-                self.logger.error(f"Failed to save inclusion for server: {ip}")
-                return False
+            with self.repository.write_lock():
+                targets = set(ips)
+                changes = {ip: [server.copy() for server in entries]
+                           for ip, entries in self.repository.entries(targets).items()}
+                found = set(changes)
+                for ip, entries in changes.items():
+                    for server in entries:
+                        if "excluded" in server:
+                            del server["excluded"]
+                            self.logger.info(f"Server included back: {ip}")
+                        else:
+                            self.logger.info(f"Server was not excluded: {ip}")
+
+                for ip in targets - found:
+                    self.logger.warning(f"Server not found for inclusion: {ip}")
+                    self.metrics.increment("include_not_found")
+                if not found:
+                    return False
+
+                if self._save(changes):
+                    self.metrics.increment("include_success")
+                    return True
+                else:
+                    self.metrics.increment("include_failed")
+                    self.logger.error(f"Failed to save inclusion for servers: {sorted(found)}")
+                    return False
 
         except Exception as e:
             self.metrics.increment("include_error")
-            self.logger.error(f"Inclusion error for {ip}: {e}")
+            self.logger.error(f"Inclusion error for {ips}: {e}")
             return False
 
     def get_servers(self, include_excluded: bool = False) -> List[Dict[str, Any]]:
         """Возвращает список серверов"""
         try:
-            servers = self.repository.load_servers()
+            servers = self.repository.snapshot()
             if not include_excluded:
                 servers = [s for s in servers if not s.get("excluded", False)]
             self.metrics.increment("get_servers_success")
@@ -148,11 +811,135 @@ class ServerManager:
             self.logger.error(f"Get servers error: {e}")
             return []
 
+    def get_servers_body(self, include_excluded: bool = False, compressed: bool = False,
+                         fields: Optional[Tuple[str, ...]] = None) -> bytes:
+        """
+        Список серверов в JSON (и gzip), закодированный один раз на версию реестра.
+        После изменения реестра тело кодируется заново при первом запросе.
+        """
+        version, servers = self.repository.versioned_snapshot()
+        key = (include_excluded, fields, compressed)
+        cached = self._bodies.get(key)
+        if cached is None or cached[0] != version:
+            with self._bodies_lock:
+                cached = self._bodies.get(key)
+                if cached is None or cached[0] != version:
+                    plain = self._bodies.get((include_excluded, fields, False))
+                    if plain is None or plain[0] != version:
+                        if not include_excluded:
+                            servers = [s for s in servers if not s.get("excluded", False)]
+                        plain = (version, ("[" + ", ".join(s.to_json(fields) for s in servers) + "]").encode())
+                        self._bodies[(include_excluded, fields, False)] = plain
+                        self.logger.debug(f"Encoded {len(servers)} servers "
+                                          f"(include_excluded={include_excluded}, version {version})")
+                    cached = (version, gzip.compress(plain[1], mtime=0)) if compressed else plain
+                    self._bodies[key] = cached
+        self.metrics.increment("get_servers_success")
+        return cached[1]
+
+    def query_servers(self, query: ServerQuery) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Выборка с фильтрами и постраничной выдачей по индексам текущей версии реестра.
+        Returns:
+            (записи страницы, курсор следующей страницы или None)
+        """
+        members = None
+        if query.list is not None:
+            if self.lists is None:
+                raise ValueError("Lists are disabled")
+            # Шард может не хранить ни одного IP списка - тогда выборка пуста
+            members = self.lists.get_members(query.list) or []
+
+        version, servers = self.repository.versioned_snapshot()
+        latest = self.telemetry.latest if self.telemetry is not None else None
+        # Индекс изменяется на месте, поэтому выборка идёт под той же блокировкой
+        with self._index_lock:
+            if self._index_version != version:
+                changes = self.repository.changes_since(self._index_version) if self._index is not None else None
+                if changes is None or len(changes) > RegistryIndex.REBUILD_THRESHOLD:
+                    self._index = RegistryIndex(servers)
+                    self.logger.debug(f"Indexed {len(servers)} servers (version {version})")
+                else:
+                    for ip, entries in changes.items():
+                        self._index.update(ip, entries)
+                self._index_version = version
+            result = self._index.select(query, self.reachability, members, latest)
+        self.metrics.increment("query_servers_success")
+        return result
+
+    def record_telemetry(self, ip: str, telemetry: Dict[str, Any]) -> bool:
+        """
+        Сохранение замера нагрузки хоста (регистрация или heartbeat агента).
+        Returns:
+            False, если замеры не сохраняются или для хоста нет места
+        Raises:
+            ValueError: Некорректный замер
+        """
+        if self.telemetry is None:
+            return False
+        if not isinstance(ip, str) or not ip:
+            raise ValueError("ip must be a string")
+        if not isinstance(telemetry, dict):
+            raise ValueError("Telemetry must be an object")
+        recorded = self.telemetry.record(ip, telemetry)
+        self.metrics.increment("telemetry_success" if recorded else "telemetry_dropped")
+        return recorded
+
+    def search_servers(self, text: str, field: str, mode: str,
+                       query: ServerQuery) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Поиск по пользователям и IP (префикс или подстрока, без учёта регистра).
+        Args:
+            text: Искомая строка
+            field: any | username | ip
+            mode: prefix | substring
+            query: Отбор исключённых, сортировка, курсор, лимит и поля ответа
+        Returns:
+            (страница найденных записей, курсор следующей страницы или None)
+        Raises:
+            ValueError: Некорректный запрос
+        """
+        version, servers = self.repository.versioned_snapshot()
+        with self._search_lock:
+            if self._search_version != version:
+                # Индекс догоняет реестр по IP, изменившимся после его версии (через сколько угодно версий);
+                # если эти изменения неизвестны, индекс строится заново по снимку
+                changes = self.repository.changes_since(self._search_version) if self._search_version >= 0 else None
+                if changes is None:
+                    self.search_index = SearchIndex()
+                    self.search_index.sync(servers)
+                    self.logger.debug(f"Search index rebuilt: {len(servers)} servers (version {version})")
+                else:
+                    for ip, entries in changes.items():
+                        self.search_index.update(ip, entries)
+                    self.search_index.commit()
+                self._search_version = version
+            found = self.search_index.search(text, field, mode)
+
+        if query.excluded is not None:
+            found = [s for s in found if s.get("excluded", False) == query.excluded]
+        elif not query.include_excluded:
+            found = [s for s in found if not s.get("excluded", False)]
+        sort_key = SORT_KEYS[query.sort or "ip"]
+        pairs = sorted(((sort_key(s), s) for s in found), key=itemgetter(0))
+        keys = [k for k, _ in pairs]
+        try:
+            start = bisect_right(keys, query.cursor) if query.cursor is not None else 0
+        except TypeError:
+            raise ValueError("Cursor does not match the sort key")
+        end = len(pairs) if query.limit is None else min(start + query.limit, len(pairs))
+        next_cursor = ServerQuery.encode_cursor(keys[end - 1]) if end < len(pairs) else None
+        self.metrics.increment("search_success")
+        return project([s for _, s in pairs[start:end]], query.fields), next_cursor
+
+    def record_reachability(self, ip: str, reachable: bool) -> None:
+        """Запоминание результата проверки доступности для фильтра reachable"""
+        self.reachability.record(ip, reachable)
+
     def get_server_by_ip(self, ip: str) -> Optional[Dict[str, Any]]:
         """Получение сервера по IP"""
         try:
-            servers = self.repository.load_servers()
-            for server in servers:
+            for server in self.repository.snapshot():
                 if server["ip"] == ip:
                     return server
             return None
@@ -163,37 +950,71 @@ class ServerManager:
     def remove_server(self, ip: str) -> bool:
         """Полное удаление сервера по IP"""
         try:
-            servers = self.repository.load_servers()
-            initial_count = len(servers)
-            servers = [s for s in servers if s["ip"] != ip]
-
-            if len(servers) == initial_count:
-                self.logger.warning(f"Server not found for removal: {ip}")
-                self.metrics.increment("remove_not_found")
-                return False
-
-            if self.repository.save_servers(servers):
-                self.metrics.increment("remove_success")
-                self.logger.info(f"Server removed: {ip}")
-                return True
-            else:
-                self.metrics.increment("remove_failed")
-                self.logger.error(f"Failed to save after server removal: {ip}")
-                return False
+            with self.repository.write_lock():
+                if not self.repository.entries([ip]):
+                    self.logger.warning(f"Server not found for removal: {ip}")
+                    self.metrics.increment("remove_not_found")
+                    return False
+
+                if self._save({ip: []}):
+                    self.metrics.increment("remove_success")
+                    self.logger.info(f"Server removed: {ip}")
+                    return True
+                else:
+                    self.metrics.increment("remove_failed")
+                    self.logger.error(f"Failed to save after server removal: {ip}")
+                    return False
 
         except Exception as e:
             self.metrics.increment("remove_error")
             self.logger.error(f"Remove server error for {ip}: {e}")
             return False
 
+    def apply_changes(self, changes: List[Dict[str, Any]]) -> int:
+        """
+        Применение изменений, полученных от другого узла: записи IP и списки хостов заменяются,
+        если ревизия изменения новее локальной.
+        Returns:
+            Число применённых изменений
+        """
+        applied = 0
+        list_changes = [change for change in changes if "list" in change]
+        if list_changes and self.lists is not None:
+            applied = self.lists.apply_changes(list_changes)
+        changes = [change for change in changes if "list" not in change]
+        if not changes:
+            return applied
+
+        with self.repository.write_lock():
+            newest: Dict[str, Dict[str, Any]] = {}
+            for change in changes:
+                current = newest.get(change["ip"])
+                if current is None or change["rev"] > current["rev"]:
+                    newest[change["ip"]] = change
+            for ip in list(newest):
+                local = self.changelog.revision(ip)
+                if local is not None and newest[ip]["rev"] <= local:
+                    del newest[ip]
+            if not newest:
+                return applied
+
+            changes = {ip: [HostRecord(entry) for entry in change["entries"]] for ip, change in newest.items()}
+            if not self._save(changes, {ip: change["rev"] for ip, change in newest.items()}, move_to_end=True):
+                self.metrics.increment("replication_failed")
+                return applied
+            self.metrics.increment("replication_success")
+            return applied + len(newest)
+
 
 class ServerRequestHandler(BaseHTTPRequestHandler):
     """Обработчик HTTP-запросов"""
 
-    def __init__(self, manager: ServerManager, metrics: ConnectionMetrics, auth_token, *args, **kwargs):
+    def __init__(self, manager: ServerManager, metrics: ConnectionMetrics, auth_token,
+                 admission: AdmissionController, *args, **kwargs):
         self.manager = manager
         self.metrics = metrics
         self.auth_token = auth_token
+        self.admission = admission
         self.logger = manager.logger
         super().__init__(*args, **kwargs)
 
@@ -205,24 +1026,149 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
             if "closed file" not in str(e):
                 self.logger.error(f"Connection error: {e}")
 
-    def _send_response(self, code: int, content: Optional[Dict] = None) -> None:
+    def _send_response(self, code: int, content: Optional[Dict] = None,
+                       headers: Optional[Dict[str, str]] = None) -> None:
         """Отправление HTTP-ответа"""
+        if content is None:
+            content = {"status": "ok"}
+        self._send_body(code, json.dumps(content, default=_json_default).encode(), headers)
+
+    def _send_body(self, code: int, body: bytes, headers: Optional[Dict[str, str]] = None) -> None:
+        """
+        Отправление готового тела JSON-ответа.
+        wfile не буферизуется (wbufsize = 0), поэтому кешированное тело уходит в sendall без копирования.
+        """
         try:
             self.send_response(code)
             self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
             self.send_header("Access-Control-Allow-Origin", "*")
             self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
             self.send_header("Access-Control-Allow-Headers", "Content-Type")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
             self.end_headers()
-            if content is None:
-                content = {"status": "ok"}
-            self.wfile.write(json.dumps(content).encode())
+            self.wfile.write(body)
         except (ConnectionError, BrokenPipeError):
             self.metrics.increment("connection_closed_during_response")
 
+    def _send_thumbnail(self) -> None:
+        """Миниатюра экрана хоста: /api/thumbnails/<ip>[/<session>], с поддержкой If-None-Match"""
+        path = unquote(urlparse(self.path).path)[len("/api/thumbnails/"):]
+        ip, _, session = path.partition("/")
+        thumbnail = self.server.thumbnails.get(ip, session) if self.server.thumbnails else None
+        if thumbnail is None:
+            self._send_response(404, {"error": "Not Found"})
+            return
+        try:
+            if self.headers.get("If-None-Match") == thumbnail.etag:
+                self.send_response(304)
+                self.send_header("ETag", thumbnail.etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-type", thumbnail.content_type)
+            self.send_header("Content-Length", str(len(thumbnail.body)))
+            self.send_header("ETag", thumbnail.etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(thumbnail.body)
+        except (ConnectionError, BrokenPipeError):
+            self.metrics.increment("connection_closed_during_response")
+
+    def _send_replication(self) -> None:
+        """Журнал изменений для других узлов: /api/replication/changes?epoch=&since=&limit= и /snapshot"""
+        changelog = self.manager.changelog
+        parsed = urlparse(self.path)
+        if changelog is None:
+            self._send_response(404, {"error": "Replication disabled"})
+        elif parsed.path == "/api/replication/snapshot":
+            self._send_response(200, changelog.snapshot())
+        elif parsed.path == "/api/replication/changes":
+            params = parse_qs(parsed.query)
+            try:
+                since = int(params.get("since", ["0"])[0])
+                limit = int(params.get("limit", ["1000"])[0])
+            except ValueError:
+                self._send_response(400, {"error": "Invalid since/limit"})
+                return
+            self._send_response(200, changelog.changes(params.get("epoch", [None])[0], since, limit))
+        else:
+            self._send_response(404, {"error": "Not Found"})
+
+    def _send_search(self) -> None:
+        """Поиск: /api/servers/search?q=&field=any|username|ip&mode=prefix|substring (+ параметры /api/servers)"""
+        params = parse_qs(urlparse(self.path).query)
+        try:
+            query = ServerQuery(params)
+            servers, next_cursor = self.manager.search_servers(
+                params.get("q", [""])[0], params.get("field", ["any"])[0], params.get("mode", ["prefix"])[0], query)
+        except ValueError as e:
+            self._send_response(400, {"error": str(e)})
+            return
+        headers = {}
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
+        self._send_response(200, servers, headers)
+
+    def _send_lists(self) -> None:
+        """Списки хостов: /api/lists (все), ?counts=true (размеры), ?ip= (списки этого IP)"""
+        lists = self.manager.lists
+        if lists is None:
+            self._send_response(404, {"error": "Lists disabled"})
+            return
+        params = parse_qs(urlparse(self.path).query)
+        if "ip" in params:
+            self._send_response(200, lists.lists_of(params["ip"][0]))
+        elif params.get("counts", ["false"])[0].lower() == "true":
+            self._send_response(200, lists.counts())
+        else:
+            self._send_response(200, lists.get_all())
+
     def do_GET(self) -> None:
         """Обрабатка GET-запросов"""
+        with self.admission.read():
+            self._handle_get()
+
+    def _handle_get(self) -> None:
         try:
+            if self.path.startswith("/api/metrics"):
+                self._send_response(200, {name: source() for name, source in self.server.metric_sources.items()})
+                return
+
+            if self.path.startswith("/api/thumbnails/"):
+                self._send_thumbnail()
+                return
+
+            if self.path.startswith("/api/replication/"):
+                self._send_replication()
+                return
+
+            if self.path.startswith("/api/lists"):
+                self._send_lists()
+                return
+
+            if self.path.startswith("/api/servers/search"):
+                self._send_search()
+                return
+
+            if self.path.startswith("/api/servers/telemetry"):
+                qs = parse_qs(urlparse(self.path).query)
+                ip = qs.get("ip", [None])[0]
+                if self.manager.telemetry is None:
+                    self._send_response(404, {"error": "Telemetry is disabled"})
+                elif "ips" in qs:
+                    # Последние замеры нескольких хостов: {ip: замер или null}
+                    ips = [ip for ip in qs["ips"][0].split(",") if ip]
+                    self._send_response(200, {ip: self.manager.telemetry.latest(ip) for ip in ips})
+                elif not ip:
+                    self._send_response(400, {"error": "ip is required"})
+                else:
+                    self._send_response(200, {"ip": ip, "samples": self.manager.telemetry.history(ip)})
+                return
+
             if self.path.startswith("/api/servers/check"):
                 try:
                     qs = parse_qs(urlparse(self.path).query)
@@ -243,6 +1189,7 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
                     except Exception as e:
                         self.logger.warning(f"HTTP check failed for {ip}:{port} → {e}")
                         reachable = False
+                    self.manager.record_reachability(ip, reachable)
                     self._send_response(200, {"ip": ip, "reachable": reachable})
                 except Exception as e:
                     self.logger.error(f"Error in /check handler: {e}")
@@ -250,11 +1197,30 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
                 return
 
             if self.path.startswith("/api/servers"):
-                query = urlparse(self.path).query
-                params = parse_qs(query)
-                include_excluded = params.get('include_excluded', ['false'])[0].lower() == 'true'
-                servers = self.manager.get_servers(include_excluded)
-                self._send_response(200, servers)
+                try:
+                    query = ServerQuery(parse_qs(urlparse(self.path).query))
+                except ValueError as e:
+                    self._send_response(400, {"error": str(e)})
+                    return
+                compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+                headers = {"Vary": "Accept-Encoding"}
+                if query.is_plain:
+                    body = self.manager.get_servers_body(query.include_excluded, compressed, query.fields)
+                else:
+                    try:
+                        servers, next_cursor = self.manager.query_servers(query)
+                    except ValueError as e:
+                        self._send_response(400, {"error": str(e)})
+                        return
+                    body = json.dumps(servers, default=_json_default).encode()
+                    if compressed:
+                        body = gzip.compress(body, mtime=0)
+                    if next_cursor:
+                        headers["X-Next-Cursor"] = next_cursor
+                        headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
+                if compressed:
+                    headers["Content-Encoding"] = "gzip"
+                self._send_body(200, body, headers)
             else:
                 self._send_response(404, {"error": "Not Found"})
 
@@ -263,7 +1229,17 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
             self._send_response(500, {"error": str(e)})
 
     def do_POST(self) -> None:
-        """Обрабатка POST-запросов"""
+        """Обрабатка POST-запросов с контролем допуска"""
+        retry_after = self.admission.try_acquire_write(self.client_address[0])
+        if retry_after is not None:
+            self._send_response(429, {"error": "Too Many Requests"}, {"Retry-After": str(retry_after)})
+            return
+        try:
+            self._handle_post()
+        finally:
+            self.admission.release_write()
+
+    def _handle_post(self) -> None:
         try:
 
             auth_header = self.headers.get("Authorization", "")
@@ -278,11 +1254,28 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
                 success = self.manager.register_server(post_data)
                 self._send_response(200 if success else 500)
             elif self.path == "/api/servers/exclude":
-                success = self.manager.exclude_server(post_data["ip"])
+                success = self.manager.exclude_servers(post_data.get("ips") or [post_data["ip"]])
                 self._send_response(200 if success else 500)
             elif self.path == "/api/servers/include":
-                success = self.manager.include_server(post_data["ip"])
+                success = self.manager.include_servers(post_data.get("ips") or [post_data["ip"]])
                 self._send_response(200 if success else 500)
+            elif self.path == "/api/servers/telemetry" and self.manager.telemetry is not None:
+                # Heartbeat агента: {"ip": ..., "telemetry": {...}}, реестр не перезаписывается
+                try:
+                    recorded = self.manager.record_telemetry(post_data["ip"], post_data.get("telemetry") or {})
+                except (KeyError, ValueError) as e:
+                    self._send_response(400, {"error": f"Invalid telemetry: {e}"})
+                    return
+                self._send_response(200, {"status": "ok" if recorded else "dropped"})
+            elif self.path == "/api/lists" and self.manager.lists is not None:
+                # {"action": "add" | "remove", "list_name": ..., "servers": [IP, ...]}
+                name, ips = post_data.get("list_name"), post_data.get("servers") or []
+                if not name or post_data.get("action") not in ("add", "remove"):
+                    self._send_response(400, {"error": "list_name and action add|remove are required"})
+                elif post_data["action"] == "add":
+                    self._send_response(200, {"status": "ok", "added": self.manager.lists.add(name, ips)})
+                else:
+                    self._send_response(200, {"status": "ok", "removed": self.manager.lists.remove(name, ips)})
             else:
                 self._send_response(404, {"error": "Not Found"})
         except json.JSONDecodeError as e:
@@ -300,23 +1293,43 @@ class ServerRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
 
-class ServerHTTPServer(HTTPServer):
-    """HTTP сервер с поддержкой метрик и логирования"""
+class ServerHTTPServer(ThreadingMixIn, HTTPServer):
+    """Многопоточный HTTP сервер с поддержкой метрик и логирования"""
+
+    daemon_threads = True
 
-    def __init__(self, manager: ServerManager, metrics: ConnectionMetrics, server_address: tuple, auth_token, RequestHandlerClass):
+    def __init__(self, manager: ServerManager, metrics: ConnectionMetrics, server_address: tuple, auth_token,
+                 RequestHandlerClass, admission: AdmissionController, reuse_port: bool = False):
         """
         Args:
             manager: Экземпляр ServerManager
             metrics: Экземпляр ConnectionMetrics
             server_address: (host, port) для привязки сервера
             RequestHandlerClass: Класс для обработки запросов
+            admission: Экземпляр AdmissionController для запросов на запись
+            reuse_port: SO_REUSEPORT - несколько процессов принимают соединения на одном порту
         """
         self.manager = manager
         self.metrics = metrics
         self.auth_token = auth_token
+        self.admission = admission
+        self.reuse_port = reuse_port
         self.logger = manager.logger
+        # Источники данных /api/metrics: имя раздела -> функция без аргументов
+        self.metric_sources: Dict[str, Callable[[], Dict]] = {"limiter": admission.stats}
+        # Экземпляр ThumbnailService, если снимки экранов включены
+        self.thumbnails = None
         super().__init__(server_address, RequestHandlerClass)
 
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def register_metrics(self, name: str, source: Callable[[], Dict]) -> None:
+        """Добавление раздела в ответ /api/metrics"""
+        self.metric_sources[name] = source
+
     def finish_request(self, request, client_address) -> None:
         """Создание обработчика запросов с обработкой ошибок"""
         try:
@@ -324,6 +1337,7 @@ class ServerHTTPServer(HTTPServer):
                 manager=self.manager,
                 metrics=self.metrics,
                 auth_token=self.auth_token,
+                admission=self.admission,
                 request=request,
                 client_address=client_address,
                 server=self
@@ -3,9 +3,63 @@ import os
 # The port of api-server
 API_SERVER_PORT = os.getenv("API_SERVER_PORT", "8080")
 
+# Number of server processes sharing the port (SO_REUSEPORT), 1 - single process
+API_WORKERS = os.getenv("API_WORKERS", "1")
+
+# Identifier of this node in registry revisions, empty - hostname:port
+NODE_ID = os.getenv("NODE_ID", "")
+
+# Comma-separated addresses (host:port) of other api-server nodes to replicate the registry with, empty - single node
+REPLICATION_PEERS = os.getenv("REPLICATION_PEERS", "")
+
+# Interval (in seconds) between pulls of the peers' change logs
+REPLICATION_INTERVAL = os.getenv("REPLICATION_INTERVAL", "2")
+
+# Keep a binary snapshot of the registry next to servers.json for fast startup: 'true' or 'false'
+REGISTRY_SNAPSHOT = os.getenv("REGISTRY_SNAPSHOT", "true")
+
+# Maximum number of hosts with stored agent telemetry (CPU, memory, viewers, traffic), 0 - telemetry disabled
+TELEMETRY_MAX_HOSTS = os.getenv("TELEMETRY_MAX_HOSTS", "65536")
+
+# Number of latest telemetry samples kept per host
+TELEMETRY_RING = os.getenv("TELEMETRY_RING", "20")
+
 # Agent token for validations
 API_AUTH_TOKEN = os.getenv("API_AUTH_TOKEN", "moneyprintergobrrr")
 
+# Allowed write requests per second from a single client IP
+RATE_LIMIT_RPS = os.getenv("RATE_LIMIT_RPS", "5")
+
+# Burst size of write requests from a single client IP
+RATE_LIMIT_BURST = os.getenv("RATE_LIMIT_BURST", "20")
+
+# Maximum number of write requests processed at the same time
+MAX_CONCURRENT_WRITES = os.getenv("MAX_CONCURRENT_WRITES", "4")
+
+# Number of active read requests at which write requests are rejected
+READ_PRIORITY_THRESHOLD = os.getenv("READ_PRIORITY_THRESHOLD", "32")
+
+# View-only VNC password of the agents (gateway and thumbnails), also required from gateway viewers
+VIEW_ONLY_PASS = os.getenv("VIEW_ONLY_PASS", "password")
+
+# Port of the view-only VNC gateway (WebSocket), 0 - gateway disabled
+GATEWAY_PORT = os.getenv("GATEWAY_PORT", "0")
+
+# Seconds to keep a host connection open after its last viewer left
+GATEWAY_IDLE_TIMEOUT = os.getenv("GATEWAY_IDLE_TIMEOUT", "30")
+
+# Interval (in seconds) between host screen thumbnails, 0 - thumbnails disabled
+THUMBNAIL_INTERVAL = os.getenv("THUMBNAIL_INTERVAL", "0")
+
+# Maximum thumbnail width in pixels
+THUMBNAIL_WIDTH = os.getenv("THUMBNAIL_WIDTH", "320")
+
+# Thumbnail format: 'png' or 'jpeg' (jpeg requires Pillow)
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "png")
+
+# Number of hosts captured at the same time
+THUMBNAIL_CONCURRENCY = os.getenv("THUMBNAIL_CONCURRENCY", "8")
+
 # The interval (in seconds) between metrics updates.
 # Example: 300 seconds = 5 minutes
 METRICS_UPDATE_INTERVAL = os.getenv("METRICS_UPDATE_INTERVAL", "60")
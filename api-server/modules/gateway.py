@@ -0,0 +1,423 @@
+import asyncio
+import os
+import struct
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
+from .logger import ServerLogger
+from .rfb import (
+    PIXEL_FORMAT, ENCODING_DESKTOP_SIZE, SECURITY_NONE, SECURITY_VNC,
+    Rect, RectEncoder, RFBClient, RFBError, vnc_auth_response
+)
+from .websocket import (
+    OP_BINARY, OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, ws_accept_response, ws_frame_header, ws_unmask
+)
+
+
+MAX_REQUEST_SIZE = 64 * 1024
+MAX_CLIENT_FRAME = 1024 * 1024
+
+
+class ViewerClosed(Exception):
+    """Зритель отключился или нарушил протокол"""
+
+
+class Viewer:
+    """
+    Браузер, подключённый к шлюзу в режиме только просмотра.
+    Вместо очереди сообщений хранится накопленная область изменений:
+    пока клиент не готов принять данные, новые изменения объединяются с неотправленными,
+    а промежуточные состояния кадра пропускаются.
+    """
+
+    # Число прямоугольников, после которого область изменений сводится к охватывающему
+    MAX_DAMAGE_RECTS = 16
+
+    def __init__(self, gateway: "VNCGateway", reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.gateway = gateway
+        self.reader = reader
+        self.writer = writer
+        self.stream: Optional["HostStream"] = None
+        self.rfb_buffer = bytearray()
+        self.damage: List[Rect] = []
+        self.resized = False
+        self.update_requested = False
+        self.desktop_size = False
+        self.encoder = RectEncoder()
+        # Кодировки из последнего SetEncodings, ещё не переданные кодировщику
+        self.encodings: Optional[Tuple[int, ...]] = None
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    @property
+    def peer(self) -> str:
+        peer = self.writer.get_extra_info("peername")
+        return peer[0] if peer else "unknown"
+
+    # WebSocket
+
+    async def handshake(self) -> str:
+        """
+        HTTP Upgrade до WebSocket.
+        Returns:
+            Путь запроса
+        """
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise ViewerClosed("bad request")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            _, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise ViewerClosed("bad request line")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        key = headers.get("sec-websocket-key")
+        if headers.get("upgrade", "").lower() != "websocket" or not key:
+            self.writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            raise ViewerClosed("not a websocket request")
+
+        self.writer.write(ws_accept_response(key, headers))
+        return target.split("?", 1)[0]
+
+    def send(self, *parts: bytes) -> None:
+        """Отправка одного бинарного кадра WebSocket из нескольких частей"""
+        if self.writer.is_closing():
+            return
+        length = sum(len(part) for part in parts)
+        self.writer.write(ws_frame_header(OP_BINARY, length))
+        self.writer.writelines(parts)
+        self.gateway.stats["bytes_down"] += length
+
+    async def _read_frame(self) -> bytes:
+        """Чтение данных очередного бинарного кадра (управляющие кадры обрабатываются здесь же)"""
+        while True:
+            try:
+                b1, b2 = await self.reader.readexactly(2)
+                length = b2 & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+                if not b2 & 0x80 or length > MAX_CLIENT_FRAME:
+                    raise ViewerClosed("protocol error")
+                mask = await self.reader.readexactly(4)
+                payload = ws_unmask(await self.reader.readexactly(length), mask)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                raise ViewerClosed("connection lost")
+
+            opcode = b1 & 0x0F
+            if opcode in (OP_BINARY, OP_CONTINUATION):
+                return payload
+            if opcode == OP_PING:
+                self.writer.write(ws_frame_header(OP_PONG, len(payload)) + payload)
+            elif opcode == OP_CLOSE:
+                raise ViewerClosed("closed by client")
+            else:
+                raise ViewerClosed("text frames are not supported")
+
+    async def recv(self, n: int) -> bytes:
+        """Чтение ровно n байт потока RFB независимо от разбиения на кадры WebSocket"""
+        while len(self.rfb_buffer) < n:
+            self.rfb_buffer += await self._read_frame()
+        data = bytes(self.rfb_buffer[:n])
+        del self.rfb_buffer[:n]
+        return data
+
+    def close(self, code: int = 1000) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if not self.writer.is_closing():
+            self.writer.write(ws_frame_header(OP_CLOSE, 2) + struct.pack("!H", code))
+            self.writer.close()
+
+    # RFB (сторона сервера)
+
+    async def authenticate(self, password: str) -> None:
+        self.send(b"RFB 003.008\n")
+        await self.recv(12)
+        if password:
+            self.send(bytes([1, SECURITY_VNC]))
+            if (await self.recv(1))[0] != SECURITY_VNC:
+                raise ViewerClosed("unsupported security type")
+            challenge = os.urandom(16)
+            self.send(challenge)
+            if await self.recv(16) != vnc_auth_response(password, challenge):
+                reason = b"Authentication failed"
+                self.send(struct.pack("!II", 1, len(reason)), reason)
+                raise ViewerClosed("authentication failed")
+        else:
+            self.send(bytes([1, SECURITY_NONE]))
+            await self.recv(1)
+        self.send(struct.pack("!I", 0))
+        await self.recv(1)  # ClientInit: флаг shared не имеет значения, шлюз всегда разделяемый
+
+    def server_init(self) -> None:
+        fb = self.stream.client.framebuffer
+        name = f"{self.stream.client.name} (view-only gateway)".encode()
+        self.send(struct.pack("!HH", fb.width, fb.height), PIXEL_FORMAT, struct.pack("!I", len(name)), name)
+
+    async def read_messages(self) -> None:
+        """Обработка сообщений клиента; ввод с клавиатуры и мыши игнорируется"""
+        while True:
+            msg_type = (await self.recv(1))[0]
+            if msg_type == 0:  # SetPixelFormat
+                pixel_format = (await self.recv(19))[3:16]
+                if pixel_format != PIXEL_FORMAT[:13]:
+                    raise ViewerClosed("unsupported pixel format")
+            elif msg_type == 2:  # SetEncodings
+                count = struct.unpack("!xH", await self.recv(3))[0]
+                encodings = struct.unpack(f"!{count}i", await self.recv(count * 4))
+                self.desktop_size = ENCODING_DESKTOP_SIZE in encodings
+                self.encodings = encodings
+            elif msg_type == 3:  # FramebufferUpdateRequest
+                incremental = (await self.recv(9))[0]
+                if not incremental:
+                    fb = self.stream.client.framebuffer
+                    self.add_damage([(0, 0, fb.width, fb.height)])
+                self.update_requested = True
+                self.wakeup.set()
+            elif msg_type == 4:  # KeyEvent
+                await self.recv(7)
+            elif msg_type == 5:  # PointerEvent
+                await self.recv(5)
+            elif msg_type == 6:  # ClientCutText
+                length = struct.unpack("!3xI", await self.recv(7))[0]
+                await self.recv(length)
+            else:
+                raise ViewerClosed(f"unsupported client message {msg_type}")
+
+    def add_damage(self, rects: List[Rect], resized: bool = False) -> None:
+        """Добавление изменённых областей к ещё не отправленным"""
+        if self.damage:
+            self.gateway.stats["updates_coalesced"] += 1
+        self.resized = self.resized or resized
+        self.damage.extend(rects)
+        if len(self.damage) > self.MAX_DAMAGE_RECTS:
+            x1 = min(r[0] for r in self.damage)
+            y1 = min(r[1] for r in self.damage)
+            x2 = max(r[0] + r[2] for r in self.damage)
+            y2 = max(r[1] + r[3] for r in self.damage)
+            self.damage = [(x1, y1, x2 - x1, y2 - y1)]
+        self.wakeup.set()
+
+    async def send_updates(self) -> None:
+        """Отправка накопленных изменений по запросу клиента из текущего кадра"""
+        while not self.closed:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.closed or not self.update_requested or not (self.damage or self.resized):
+                continue
+
+            fb = self.stream.client.framebuffer
+            parts = []
+            rect_count = 0
+            if self.resized:
+                if not self.desktop_size:
+                    raise ViewerClosed("desktop resize is not supported by client")
+                parts.append(struct.pack("!HHHHi", 0, 0, fb.width, fb.height, ENCODING_DESKTOP_SIZE))
+                rect_count += 1
+                self.damage = [(0, 0, fb.width, fb.height)]
+            rects = []
+            for x, y, w, h in self.damage:
+                # Прямоугольники обрезаются по кадру: размер мог измениться после их накопления
+                w, h = min(w, fb.width - x), min(h, fb.height - y)
+                if w > 0 and h > 0:
+                    rects.append((x, y, w, h, fb.get(x, y, w, h)))
+            self.damage = []
+            self.resized = False
+            self.update_requested = False
+
+            if self.encodings is not None:
+                # Кодировщик перенастраивается только между обновлениями, пока он не занят в пуле потоков
+                self.encoder.configure(self.encodings)
+                self.encodings = None
+            # Пиксели уже скопированы из кадра, сжатие (zlib и JPEG отпускают GIL) идёт в пуле потоков
+            count, encoded = await asyncio.get_running_loop().run_in_executor(None, self.encoder.encode, rects)
+            self.send(struct.pack("!BxH", 0, rect_count + count), *parts, *encoded)
+            self.gateway.stats["updates_sent"] += 1
+            # Пока буфер отправки медленного клиента не освободится, изменения копятся в damage
+            await self.writer.drain()
+
+
+class HostStream:
+    """Одно соединение с VNC-сервером хоста, общее для всех зрителей"""
+
+    def __init__(self, gateway: "VNCGateway", key: Tuple[str, str], vnc_port: int):
+        self.gateway = gateway
+        self.key = key
+        self.client = RFBClient(key[0], vnc_port, gateway.password)
+        self.viewers: Set[Viewer] = set()
+        self.ready = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self.idle_handle: Optional[asyncio.TimerHandle] = None
+        self.bytes_received = 0
+
+    async def run(self) -> None:
+        logger = self.gateway.logger
+        try:
+            await self.client.connect(shared=True)
+            await self.client.request_update(incremental=False)
+            await self._apply(await self.client.read_update())
+            logger.info(f"Gateway connected to {self.key[0]}:{self.client.port} ({self.key[1] or 'default'})")
+            self.ready.set_result(True)
+            while True:
+                await self.client.request_update(incremental=True)
+                await self._apply(await self.client.read_update())
+        except asyncio.CancelledError:
+            pass
+        except (OSError, RFBError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            if not self.ready.done():
+                self.ready.set_exception(RFBError(str(e)))
+            logger.warning(f"Gateway upstream {self.key[0]}:{self.client.port} closed: {e}")
+        finally:
+            if not self.ready.done():
+                # Закрыт по простою до подключения: ожидающие зрители не должны ждать вечно
+                self.ready.set_exception(RFBError("upstream closed"))
+            self.gateway.streams.pop(self.key, None)
+            for viewer in list(self.viewers):
+                viewer.close(1011)
+            await self.client.close()
+
+    async def _apply(self, rects: List[Rect]) -> None:
+        self.gateway.stats["bytes_upstream"] += self.client.bytes_received - self.bytes_received
+        self.bytes_received = self.client.bytes_received
+        for viewer in self.viewers:
+            viewer.add_damage(rects, self.client.resized)
+
+    def attach(self, viewer: Viewer) -> None:
+        if self.idle_handle:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        self.viewers.add(viewer)
+
+    def detach(self, viewer: Viewer) -> None:
+        self.viewers.discard(viewer)
+        if not self.viewers and self.task:
+            # Соединение держится ещё некоторое время на случай переподключения зрителя
+            self.idle_handle = asyncio.get_running_loop().call_later(self.gateway.idle_timeout, self.task.cancel)
+
+
+class VNCGateway:
+    """
+    Центральный шлюз VNC: одно соединение с каждым хостом (view-only пароль)
+    и раздача его кадра любому числу браузеров по WebSocket.
+    Путь WebSocket: /<ip> или /<ip>/<session>.
+    """
+
+    def __init__(self, logger: ServerLogger, manager, port: int, password: str, idle_timeout: float = 30.0):
+        """
+        Args:
+            logger: Экземпляр ServerLogger
+            manager: Экземпляр ServerManager для поиска VNC-порта хоста
+            port: Порт WebSocket шлюза
+            password: View-only пароль VNC хостов, он же пароль для зрителей
+            idle_timeout: Время удержания соединения с хостом без зрителей (сек)
+        """
+        self.logger = logger
+        self.manager = manager
+        self.port = port
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self.streams: Dict[Tuple[str, str], HostStream] = {}
+        self.viewers: Set[Viewer] = set()
+        self.stats = {"connections": 0, "bytes_upstream": 0, "bytes_down": 0,
+                      "updates_sent": 0, "updates_coalesced": 0}
+
+    def start(self) -> None:
+        """Запуск цикла шлюза в отдельном потоке"""
+        async def listen():
+            await asyncio.start_server(self._handle, host="", port=self.port,
+                                       reuse_address=True, limit=MAX_REQUEST_SIZE)
+
+        self.thread = threading.Thread(target=self.loop.run_forever, name="vnc-gateway", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(listen(), self.loop).result()
+        self.logger.info(f"VNC gateway listening on port {self.port}")
+
+    def _find_vnc_port(self, ip: str, session: str) -> Optional[int]:
+        for server in self.manager.get_servers(include_excluded=True):
+            if server.get("ip") == ip and (not session or server.get("session") == session):
+                return server.get("vnc_port")
+        return None
+
+    async def _get_stream(self, viewer: Viewer, ip: str, session: str) -> HostStream:
+        """Поток хоста с подключённым зрителем; зритель подключается до готовности потока"""
+        key = (ip, session)
+        stream = self.streams.get(key)
+        if stream is None:
+            vnc_port = await self.loop.run_in_executor(None, self._find_vnc_port, ip, session)
+            if not vnc_port:
+                raise RFBError(f"no VNC port registered for {ip} {session}".rstrip())
+            stream = self.streams.get(key)
+            if stream is None:
+                stream = self.streams[key] = HostStream(self, key, int(vnc_port))
+                stream.task = self.loop.create_task(stream.run())
+        # Пока поток подключается, зритель удерживает его от закрытия по простою
+        stream.attach(viewer)
+        ready = False
+        try:
+            await asyncio.shield(stream.ready)
+            ready = True
+        finally:
+            if not ready:
+                # Хост недоступен или зритель отключился раньше: поток без зрителей закроется по простою
+                stream.detach(viewer)
+        return stream
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        viewer = Viewer(self, reader, writer)
+        sender = None
+        try:
+            path = await viewer.handshake()
+            ip, _, session = unquote(path).strip("/").partition("/")
+            # Соединение с хостом открывается только для зрителя, прошедшего аутентификацию
+            await viewer.authenticate(self.password)
+            self.stats["connections"] += 1
+            try:
+                stream = await self._get_stream(viewer, ip, session)
+            except RFBError as e:
+                self.logger.warning(f"Gateway viewer {viewer.peer} -> {ip}: {e}")
+                viewer.close(1011)
+                return
+
+            viewer.stream = stream
+            viewer.server_init()
+            self.viewers.add(viewer)
+            sender = self.loop.create_task(viewer.send_updates())
+            reading = self.loop.create_task(viewer.read_messages())
+            done, _ = await asyncio.wait({sender, reading}, return_when=asyncio.FIRST_COMPLETED)
+            reading.cancel()
+            for task in done:
+                task.result()
+        except ViewerClosed as e:
+            self.logger.debug(f"Gateway viewer {viewer.peer} disconnected: {e}")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if sender:
+                sender.cancel()
+            self.viewers.discard(viewer)
+            if viewer.stream:
+                viewer.stream.detach(viewer)
+            viewer.close()
+
+    def get_stats(self) -> Dict[str, object]:
+        """Состояние шлюза для /api/metrics"""
+        return {
+            **self.stats,
+            "upstreams": len(self.streams),
+            "viewers": len(self.viewers),
+            "hosts": {
+                f"{ip}/{session}" if session else ip: len(stream.viewers)
+                for (ip, session), stream in list(self.streams.items())
+            }
+        }
@@ -0,0 +1,307 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from .logger import ConnectionMetrics
+
+# Общий файл лимитера воркеров: заголовок (сигнатура, число воркеров и bucket'ов), счётчики каждого воркера
+# (активные чтения и записи, затем итоги в порядке _TOTALS) и bucket'ы клиентов (IP, токены, время обновления)
+_TOTALS = ("admitted", "rate_limited", "busy", "reads_priority")
+_STATE_MAGIC = b"VRADM1\0\0"
+_STATE_HEADER = struct.Struct("<8sII")
+_WORKER = struct.Struct("<6q")
+_BUCKET = struct.Struct("<48sdd")
+_COUNTER = struct.Struct("<q")
+_ACTIVE_READS, _ACTIVE_WRITES = 0, 1
+
+
+class TokenBucket:
+    """Token bucket для ограничения частоты запросов одного клиента"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def consume(self, now: float) -> float:
+        """
+        Списание одного токена.
+        Returns:
+            0, если запрос разрешён, иначе время в секундах до появления токена
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_idle(self, now: float) -> bool:
+        """Bucket полностью восстановился и может быть удалён"""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class AdmissionController:
+    """
+    Контроль допуска запросов на запись:
+    ограничение частоты по IP клиента, глобальный лимит одновременных записей
+    и приоритет чтений при высокой нагрузке.
+    """
+
+    # Количество bucket'ов, после которого удаляются неактивные
+    MAX_BUCKETS = 10000
+
+    def __init__(self, metrics: ConnectionMetrics, rate: float, burst: int,
+                 max_concurrent_writes: int, read_priority_threshold: int):
+        """
+        Args:
+            metrics: Экземпляр ConnectionMetrics
+            rate: Допустимое число запросов на запись в секунду от одного IP
+            burst: Размер всплеска запросов от одного IP
+            max_concurrent_writes: Лимит одновременно выполняемых записей
+            read_priority_threshold: Число активных чтений, при котором записи отклоняются
+        """
+        self.metrics = metrics
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.max_concurrent_writes = max(1, int(max_concurrent_writes))
+        self.read_priority_threshold = max(1, int(read_priority_threshold))
+
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.active_reads = 0
+        self.active_writes = 0
+        self.totals = {"admitted": 0, "rate_limited": 0, "busy": 0, "reads_priority": 0}
+
+    def _prune(self, now: float) -> None:
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.buckets = {ip: b for ip, b in self.buckets.items() if not b.is_idle(now)}
+
+    def _reject(self, reason: str) -> None:
+        self.totals[reason] += 1
+        self.metrics.increment(f"write_{reason}")
+
+    def try_acquire_write(self, client_ip: str) -> Optional[int]:
+        """
+        Попытка допустить запрос на запись.
+        Returns:
+            None, если запрос допущен (нужно вызвать release_write),
+            иначе значение Retry-After в секундах
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client_ip)
+            if bucket is None:
+                self._prune(now)
+                bucket = self.buckets[client_ip] = TokenBucket(self.rate, self.burst, now)
+            wait = bucket.consume(now)
+            if wait > 0:
+                self._reject("rate_limited")
+                return max(1, math.ceil(wait))
+
+            if self.active_reads >= self.read_priority_threshold:
+                bucket.tokens += 1  # Отказ не по вине клиента, токен возвращается
+                self._reject("reads_priority")
+                return 1
+
+            if self.active_writes >= self.max_concurrent_writes:
+                bucket.tokens += 1
+                self._reject("busy")
+                return 1
+
+            self.active_writes += 1
+            self.totals["admitted"] += 1
+            return None
+
+    def release_write(self) -> None:
+        with self.lock:
+            self.active_writes -= 1
+
+    @contextmanager
+    def read(self):
+        """Учёт активного запроса на чтение"""
+        with self.lock:
+            self.active_reads += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_reads -= 1
+
+    def stats(self) -> Dict[str, object]:
+        """Текущее состояние лимитера"""
+        with self.lock:
+            return {
+                "active_reads": self.active_reads,
+                "active_writes": self.active_writes,
+                "max_concurrent_writes": self.max_concurrent_writes,
+                "rate_per_client": self.rate,
+                "burst_per_client": self.burst,
+                "tracked_clients": len(self.buckets),
+                "writes": dict(self.totals)
+            }
+
+
+class SharedAdmissionController(AdmissionController):
+    """
+    Контроль допуска для нескольких процессов-воркеров: bucket'ы клиентов и счётчики запросов лежат
+    в общем файле, отображённом в память, поэтому лимиты действуют на весь сервер, а не на каждый воркер.
+    Допуск записи (bucket клиента и сумма активных записей) выполняется под flock. Счётчики активных
+    запросов воркер меняет только свои, и перезапущенный воркер обнуляет счётчики прежнего процесса.
+    """
+
+    # Число слотов bucket'ов и длина поиска слота клиента
+    BUCKET_SLOTS = 16384
+    MAX_PROBES = 64
+
+    def __init__(self, path: str, worker: int, workers: int, metrics: ConnectionMetrics, rate: float, burst: int,
+                 max_concurrent_writes: int, read_priority_threshold: int):
+        """
+        Args:
+            path: Путь к общему файлу лимитера
+            worker: Номер воркера (0..workers-1)
+            workers: Число воркеров
+            Остальные - как у AdmissionController
+        """
+        super().__init__(metrics, rate, burst, max_concurrent_writes, read_priority_threshold)
+        self.worker = worker
+        self.workers = workers
+        self.lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self.worker_offset = _STATE_HEADER.size + worker * _WORKER.size
+        self.buckets_offset = _STATE_HEADER.size + workers * _WORKER.size
+        self._full_warned = False
+
+        size = self.buckets_offset + self.BUCKET_SLOTS * _BUCKET.size
+        header = _STATE_HEADER.pack(_STATE_MAGIC, workers, self.BUCKET_SLOTS)
+        with self._shared():
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.pread(fd, _STATE_HEADER.size, 0) != header or os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                self.data = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            # Активные запросы прежнего процесса с этим номером завершились вместе с ним
+            _WORKER.pack_into(self.data, self.worker_offset, 0, 0, 0, 0, 0, 0)
+
+    @contextmanager
+    def _shared(self):
+        """Блокировка общего состояния: между потоками процесса и между процессами (flock)"""
+        with self.lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _add(self, counter: int, delta: int) -> None:
+        offset = self.worker_offset + counter * _COUNTER.size
+        _COUNTER.pack_into(self.data, offset, _COUNTER.unpack_from(self.data, offset)[0] + delta)
+
+    def _sum(self, counter: int) -> int:
+        return sum(_COUNTER.unpack_from(self.data, _STATE_HEADER.size + worker * _WORKER.size
+                                        + counter * _COUNTER.size)[0] for worker in range(self.workers))
+
+    def _bucket(self, client_ip: str, now: float) -> Optional[int]:
+        """Смещение bucket'а клиента: найденного, свободного или восстановившегося (вызывается под _shared)"""
+        key = client_ip.encode()[:_BUCKET.size - 16]
+        start = zlib.crc32(key) % self.BUCKET_SLOTS
+        reusable = None
+        for probe in range(self.MAX_PROBES):
+            offset = self.buckets_offset + (start + probe) % self.BUCKET_SLOTS * _BUCKET.size
+            owner, tokens, updated = _BUCKET.unpack_from(self.data, offset)
+            owner = owner.rstrip(b"\0")
+            if owner == key:
+                return offset
+            if not owner:
+                reusable = offset if reusable is None else reusable
+                break
+            if reusable is None and tokens + max(now - updated, 0) * self.rate >= self.burst:
+                reusable = offset
+        if reusable is None:
+            if not self._full_warned:
+                self.metrics.increment("write_limiter_full")
+                self._full_warned = True
+            return None
+        _BUCKET.pack_into(self.data, reusable, key, float(self.burst), now)
+        return reusable
+
+    def _reject(self, reason: str) -> None:
+        self._add(2 + _TOTALS.index(reason), 1)
+        self.metrics.increment(f"write_{reason}")
+
+    def try_acquire_write(self, client_ip: str) -> Optional[int]:
+        now = time.monotonic()
+        with self._shared():
+            offset = self._bucket(client_ip, now)
+            bucket = TokenBucket(self.rate, self.burst, now)
+            if offset is not None:
+                _, bucket.tokens, updated = _BUCKET.unpack_from(self.data, offset)
+                bucket.updated = min(updated, now)  # Файл мог остаться от прежней загрузки системы
+            try:
+                wait = bucket.consume(now)
+                if wait > 0:
+                    self._reject("rate_limited")
+                    return max(1, math.ceil(wait))
+
+                if self._sum(_ACTIVE_READS) >= self.read_priority_threshold:
+                    bucket.tokens += 1  # Отказ не по вине клиента, токен возвращается
+                    self._reject("reads_priority")
+                    return 1
+
+                if self._sum(_ACTIVE_WRITES) >= self.max_concurrent_writes:
+                    bucket.tokens += 1
+                    self._reject("busy")
+                    return 1
+
+                self._add(_ACTIVE_WRITES, 1)
+                self._add(2 + _TOTALS.index("admitted"), 1)
+                return None
+            finally:
+                if offset is not None:
+                    _BUCKET.pack_into(self.data, offset, client_ip.encode()[:_BUCKET.size - 16],
+                                      bucket.tokens, bucket.updated)
+
+    def release_write(self) -> None:
+        # Свой счётчик: другие процессы его только читают
+        with self.lock:
+            self._add(_ACTIVE_WRITES, -1)
+
+    @contextmanager
+    def read(self):
+        with self.lock:
+            self._add(_ACTIVE_READS, 1)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._add(_ACTIVE_READS, -1)
+
+    def _tracked_clients(self) -> int:
+        return sum(1 for slot in range(self.BUCKET_SLOTS)
+                   if self.data[self.buckets_offset + slot * _BUCKET.size])
+
+    def stats(self) -> Dict[str, object]:
+        """Состояние лимитера всех воркеров"""
+        counters: List[int] = [self._sum(counter) for counter in range(len(_TOTALS) + 2)]
+        return {
+            "active_reads": counters[_ACTIVE_READS],
+            "active_writes": counters[_ACTIVE_WRITES],
+            "max_concurrent_writes": self.max_concurrent_writes,
+            "rate_per_client": self.rate,
+            "burst_per_client": self.burst,
+            "tracked_clients": self._tracked_clients(),
+            "writes": dict(zip(_TOTALS, counters[2:])),
+            "shared_workers": self.workers
+        }
@@ -0,0 +1,202 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set
+from .logger import ServerLogger
+from .replication import ChangeLog
+
+
+class HostLists:
+    """
+    Именованные списки хостов с обратным индексом принадлежности IP к спискам.
+    Файл списков общий для процессов-воркеров: изменение выполняется под flock
+    с атомарной заменой файла, остальные процессы перечитывают его при смене.
+    Изменённые списки целиком записываются в журнал репликации, как записи реестра.
+    """
+
+    def __init__(self, path: str, logger: ServerLogger, changelog: Optional[ChangeLog] = None):
+        """
+        Args:
+            path: Путь к файлу списков ({"имя": [IP, ...]})
+            logger: Экземпляр ServerLogger
+            changelog: Журнал изменений для репликации на другие узлы (None - без репликации)
+        """
+        self.path = path
+        self.lock_file = f"{path}.lock"
+        self.logger = logger
+        self.changelog = changelog
+        self._lock = threading.RLock()
+        self._file_key = None
+        # Члены каждого списка в порядке добавления и списки каждого IP
+        self.members: Dict[str, Dict[str, None]] = {}
+        self.memberships: Dict[str, Set[str]] = {}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _refresh(self) -> None:
+        """Перестроение индексов, если файл изменил другой процесс (вызывается под self._lock)"""
+        key = self._stat()
+        if key == self._file_key:
+            return
+        lists = {}
+        if key is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    lists = json.load(f)
+            except json.JSONDecodeError as e:
+                self.logger.error(f"JSON decode error in {self.path}: {e}")
+        self.members, self.memberships = {}, {}
+        for name, ips in lists.items():
+            self.members[name] = {}
+            self._add(name, ips)
+        self._file_key = key
+
+    def _add(self, name: str, ips: Iterable[str]) -> int:
+        members = self.members[name]
+        added = 0
+        for ip in ips:
+            if ip not in members:
+                members[ip] = None
+                self.memberships.setdefault(ip, set()).add(name)
+                added += 1
+        return added
+
+    def _remove(self, name: str, ips: Iterable[str]) -> int:
+        members = self.members[name]
+        removed = 0
+        for ip in ips:
+            if ip in members:
+                del members[ip]
+                names = self.memberships[ip]
+                names.discard(name)
+                if not names:
+                    del self.memberships[ip]
+                removed += 1
+        return removed
+
+    @contextmanager
+    def _write(self, revisions: Optional[Dict[str, List]] = None):
+        """
+        Изменение списков: блокировка между потоками и процессами, затем атомарная замена файла
+        и запись изменённых списков в журнал. Тело блока добавляет имена изменённых списков
+        в полученное множество; без изменений файл не перезаписывается.
+        Args:
+            revisions: Ревизии изменений, полученных от других узлов (иначе - новые локальные)
+        """
+        with self._lock:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._refresh()
+                changed: Set[str] = set()
+                yield changed
+                if not changed:
+                    return
+                tmp_file = f"{self.path}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump({name: list(members) for name, members in self.members.items()},
+                              f, ensure_ascii=False, indent=2)
+                os.replace(tmp_file, self.path)
+                self._file_key = self._stat()
+                if self.changelog:
+                    try:
+                        self.changelog.record_lists({
+                            name: list(self.members[name]) if name in self.members else None for name in changed
+                        }, revisions)
+                    except (OSError, ValueError) as e:
+                        self.logger.error(f"Failed to record list changes for replication: {e}")
+            finally:
+                os.close(fd)  # Закрытие дескриптора снимает flock
+
+    def get_all(self) -> Dict[str, List[str]]:
+        with self._lock:
+            self._refresh()
+            return {name: list(members) for name, members in self.members.items()}
+
+    def counts(self) -> Dict[str, int]:
+        """Число хостов в каждом списке"""
+        with self._lock:
+            self._refresh()
+            return {name: len(members) for name, members in self.members.items()}
+
+    def get_members(self, name: str) -> Optional[List[str]]:
+        """IP списка в порядке добавления (None - нет такого списка)"""
+        with self._lock:
+            self._refresh()
+            members = self.members.get(name)
+            return list(members) if members is not None else None
+
+    def lists_of(self, ip: str) -> List[str]:
+        """Списки, в которые входит IP"""
+        with self._lock:
+            self._refresh()
+            return sorted(self.memberships.get(ip, ()))
+
+    def add(self, name: str, ips: List[str]) -> int:
+        """
+        Добавление IP в список (список создаётся, если его нет).
+        Returns:
+            Число добавленных IP
+        """
+        with self._write() as changed:
+            created = name not in self.members
+            self.members.setdefault(name, {})
+            added = self._add(name, ips)
+            if created or added:
+                changed.add(name)
+        self.logger.info(f"List '{name}': {added} host(s) added")
+        return added
+
+    def remove(self, name: str, ips: List[str]) -> int:
+        """
+        Удаление IP из списка, без IP - удаление самого списка.
+        Returns:
+            Число удалённых IP
+        """
+        with self._write() as changed:
+            if name not in self.members:
+                return 0
+            if ips:
+                removed = self._remove(name, ips)
+            else:
+                removed = self._remove(name, list(self.members[name]))
+                del self.members[name]
+            if removed or not ips:
+                changed.add(name)
+        self.logger.info(f"List '{name}': {removed} host(s) removed" + ("" if ips else ", list deleted"))
+        return removed
+
+    def apply_changes(self, changes: List[Dict[str, Any]]) -> int:
+        """
+        Применение изменений списков, полученных от другого узла: список заменяется целиком,
+        если ревизия изменения новее локальной.
+        Returns:
+            Число применённых изменений
+        """
+        newest: Dict[str, Dict[str, Any]] = {}
+        for change in changes:
+            current = newest.get(change["list"])
+            if current is None or change["rev"] > current["rev"]:
+                newest[change["list"]] = change
+        revisions: Dict[str, List] = {}
+        with self._write(revisions) as changed:
+            for name, change in newest.items():
+                local = self.changelog.list_revision(name)
+                if local is not None and change["rev"] <= local:
+                    continue
+                if name in self.members:
+                    self._remove(name, list(self.members[name]))
+                    del self.members[name]
+                if change["members"] is not None:
+                    self.members[name] = {}
+                    self._add(name, change["members"])
+                revisions[name] = change["rev"]
+                changed.add(name)
+        return len(changed)
@@ -0,0 +1,369 @@
+import argparse
+import bz2
+import gzip
+import heapq
+import lzma
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Начало записи лога в формате Logger: '2024-01-31 12:00:00,123 - INFO - сообщение'
+_RECORD = re.compile(rb"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - ([A-Z]+) - ")
+
+# Индексы лежат в подкаталоге: файлы рядом с логами ротация приняла бы за архивы и удаляла бы вместо логов
+INDEX_DIR = ".index"
+
+# Расстояние между соседними точками индекса в байтах (несжатого) лога
+INDEX_STEP = 64 * 1024
+
+# Заголовок индекса: сигнатура, inode и размер файла лога, проиндексированная часть потока,
+# время последней записи и число точек; точка - время записи и её смещение
+_MAGIC = b"VRLIDX1\0"
+_HEADER = struct.Struct("<8sQQQ23sI")
+_ENTRY = struct.Struct("<23sQ")
+
+# Ротированные логи, сжатые после ротации, читаются прозрачно
+_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+Record = Tuple[bytes, bytes, bytes]  # (время, уровень, текст записи со строками продолжения)
+
+
+class LogIndex:
+    """
+    Разреженный индекс времени одного файла лога: смещения начал записей примерно через INDEX_STEP байт.
+    Для несжатого файла точки находятся переходами по mmap, без разбора каждой строки,
+    растущий текущий лог доиндексируется с места, где индекс закончился.
+    Сжатый файл индексируется один раз полным чтением.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.compressed = os.path.splitext(path)[1] in _OPENERS
+        directory, name = os.path.split(path)
+        self.index_path = os.path.join(directory, INDEX_DIR, f"{name}.idx")
+        self.times: List[bytes] = []
+        self.offsets: List[int] = []
+        self.indexed = 0
+        self.last = b""
+
+    def update(self) -> None:
+        """Загрузка индекса с диска, его построение или дополнение и сохранение при изменении"""
+        st = os.stat(self.path)
+        if self._load(st):
+            if self.compressed or self.indexed == st.st_size:
+                return
+        else:
+            self.times, self.offsets, self.indexed, self.last = [], [], 0, b""
+        if self.compressed:
+            self._index_stream()
+        elif st.st_size:
+            with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._index_mapped(data)
+        self._save(st)
+
+    def _load(self, st: os.stat_result) -> bool:
+        try:
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        except OSError:
+            return False
+        if len(raw) < _HEADER.size:
+            return False
+        magic, inode, size, indexed, last, count = _HEADER.unpack_from(raw)
+        if magic != _MAGIC or inode != st.st_ino or len(raw) != _HEADER.size + count * _ENTRY.size:
+            return False
+        # Сжатый файл не меняется, несжатый может только расти
+        if (size != st.st_size) if self.compressed else (indexed > st.st_size):
+            return False
+        entries = [_ENTRY.unpack_from(raw, _HEADER.size + i * _ENTRY.size) for i in range(count)]
+        if entries and not self.compressed and not self._starts_with(entries[0][0]):
+            return False  # Файл переписан заново под тем же inode
+        self.times = [t for t, _ in entries]
+        self.offsets = [o for _, o in entries]
+        self.indexed, self.last = indexed, last
+        return True
+
+    def _starts_with(self, timestamp: bytes) -> bool:
+        with open(self.path, "rb") as f:
+            return f.read(len(timestamp)) == timestamp
+
+    def _save(self, st: os.stat_result) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_file = f"{self.index_path}.tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, st.st_ino, st.st_size, self.indexed, self.last, len(self.times)))
+                f.write(b"".join(_ENTRY.pack(t, o) for t, o in zip(self.times, self.offsets)))
+            os.replace(tmp_file, self.index_path)
+        except OSError as e:
+            # Без прав на запись индекс действует только в этом запуске
+            print(f"Index not saved for {self.path}: {e}", file=sys.stderr)
+
+    def _add(self, timestamp: bytes, offset: int) -> None:
+        # Записи разных потоков могут идти не строго по времени: точки индекса должны оставаться упорядоченными
+        if not self.times or timestamp >= self.times[-1]:
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+
+    def _index_mapped(self, data: mmap.mmap) -> None:
+        # Индексируются только завершённые строки, остаток допишется следующим запуском
+        end = data.rfind(b"\n", self.indexed) + 1
+        position = self.indexed
+        while position < end:
+            match = _RECORD.match(data, position)
+            if match:
+                self._add(match.group(1), position)
+                line_end = data.find(b"\n", position + INDEX_STEP - 1)
+            else:
+                line_end = data.find(b"\n", position)
+            if line_end < 0:
+                break
+            position = line_end + 1
+
+        # Время последней записи - для отбора файлов по интервалу без чтения
+        line_end = end - 1
+        while line_end > self.indexed:
+            line_start = data.rfind(b"\n", self.indexed, line_end) + 1
+            match = _RECORD.match(data, max(line_start, self.indexed))
+            if match:
+                self.last = match.group(1)
+                break
+            line_end = line_start - 1
+        self.indexed = max(end, self.indexed)
+
+    def _index_stream(self) -> None:
+        offset, next_point = 0, 0
+        with _OPENERS[os.path.splitext(self.path)[1]](self.path, "rb") as f:
+            for line in f:
+                if line[:1].isdigit():
+                    match = _RECORD.match(line)
+                    if match:
+                        self.last = match.group(1)
+                        if offset >= next_point:
+                            self._add(self.last, offset)
+                            next_point = offset + INDEX_STEP
+                offset += len(line)
+        self.indexed = offset
+
+    def overlaps(self, since: Optional[bytes], until: Optional[bytes]) -> bool:
+        """Может ли файл содержать записи интервала (у текущего лога хвост после индекса не учтён)"""
+        if not self.times:
+            return not self.compressed and self.indexed < os.path.getsize(self.path)
+        if until is not None and self.times[0] > until:
+            return False
+        tail = not self.compressed and self.indexed < os.path.getsize(self.path)
+        return since is None or tail or self.last >= since
+
+    def seek_offset(self, since: Optional[bytes]) -> int:
+        """Смещение точки индекса, после которой начинаются записи не раньше since"""
+        if since is None or not self.times:
+            return 0
+        return self.offsets[max(bisect_left(self.times, since) - 1, 0)]
+
+
+def _mapped_lines(data: mmap.mmap, position: int) -> Iterator[bytes]:
+    end = len(data)
+    while position < end:
+        line_end = data.find(b"\n", position) + 1 or end
+        yield data[position:line_end]
+        position = line_end
+
+
+def _records(lines: Iterable[bytes]) -> Iterator[Record]:
+    """Группировка строк в записи: строки без метки времени (трассировки) продолжают предыдущую запись"""
+    current: Optional[Tuple[bytes, bytes, List[bytes]]] = None
+    for line in lines:
+        match = _RECORD.match(line) if line[:1].isdigit() else None
+        if match:
+            if current is not None:
+                yield current[0], current[1], b"".join(current[2])
+            current = match.group(1), match.group(2), [line]
+        elif current is not None:
+            current[2].append(line)
+    if current is not None:
+        yield current[0], current[1], b"".join(current[2])
+
+
+def read_records(index: LogIndex, since: Optional[bytes], until: Optional[bytes]) -> Iterator[Record]:
+    """
+    Записи файла лога за интервал [since, until].
+    Чтение начинается с точки индекса перед since и заканчивается на первой записи после until.
+    """
+    offset = index.seek_offset(since)
+    if index.compressed:
+        source = _OPENERS[os.path.splitext(index.path)[1]](index.path, "rb")
+        source.seek(offset)
+        lines: Iterable[bytes] = source
+    else:
+        source = open(index.path, "rb")
+        if not os.fstat(source.fileno()).st_size:
+            source.close()
+            return
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        lines = _mapped_lines(data, offset)
+    try:
+        for record in _records(lines):
+            if since is not None and record[0] < since:
+                continue
+            if until is not None and record[0] > until:
+                break
+            yield record
+    finally:
+        if not index.compressed:
+            data.close()
+        source.close()
+
+
+class RecordFilter:
+    """Отбор записей по минимальному уровню, IP и имени пользователя в тексте записи"""
+
+    def __init__(self, level: Optional[str] = None, ip: Optional[str] = None, username: Optional[str] = None):
+        self.level = LEVELS[level] if level else None
+        # IP и имя ищутся целиком: 10.0.0.1 не совпадает с 10.0.0.12, ivan - с ivanov
+        self.patterns = []
+        if ip:
+            self.patterns.append(re.compile(rb"(?<![\w.])" + re.escape(ip.encode()) + rb"(?!\w|\.\d)"))
+        if username:
+            self.patterns.append(re.compile(rb"(?<![\w.-])" + re.escape(username.encode()) + rb"(?![\w-]|\.\w)"))
+
+    def __call__(self, record: Record) -> bool:
+        if self.level is not None and LEVELS.get(record[1].decode(), 0) < self.level:
+            return False
+        return all(pattern.search(record[2]) for pattern in self.patterns)
+
+
+def query(paths: Iterable[str], since: Optional[bytes] = None, until: Optional[bytes] = None,
+          record_filter: Optional[RecordFilter] = None,
+          stats: Optional[dict] = None) -> Iterator[Tuple[bytes, bytes, bytes, str]]:
+    """
+    Записи нескольких логов за интервал в порядке времени (слияние потоков, без загрузки файлов целиком).
+    Файлы, которые по индексу не пересекаются с интервалом, не открываются.
+    Yields:
+        (время, уровень, текст, путь к файлу)
+    """
+    streams = []
+    paths = list(paths)
+    for directory in {os.path.dirname(path) for path in paths}:
+        prune_indexes(directory)
+    for path in paths:
+        index = LogIndex(path)
+        index.update()
+        if not index.overlaps(since, until):
+            if stats is not None:
+                stats["skipped"] = stats.get("skipped", 0) + 1
+            continue
+        if stats is not None:
+            stats["read"] = stats.get("read", 0) + 1
+        streams.append(_tagged(read_records(index, since, until), path, record_filter))
+    return heapq.merge(*streams, key=itemgetter(0))
+
+
+def _tagged(records: Iterator[Record], path: str,
+            record_filter: Optional[RecordFilter]) -> Iterator[Tuple[bytes, bytes, bytes, str]]:
+    for record in records:
+        if record_filter is None or record_filter(record):
+            yield record[0], record[1], record[2], path
+
+
+def prune_indexes(directory: str) -> None:
+    """Удаление индексов логов, которые ротация удалила или сжала под другим именем"""
+    index_dir = os.path.join(directory, INDEX_DIR)
+    try:
+        names = os.listdir(index_dir)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith(".idx") and not os.path.exists(os.path.join(directory, name[:-len(".idx")])):
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                pass
+
+
+def log_files(paths: Iterable[str]) -> List[str]:
+    """Файлы логов из аргументов: каталог заменяется всеми логами в нём (текущими и ротированными)"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if ".log" in name and not name.endswith((".lock", ".tmp"))
+                                and os.path.isfile(os.path.join(path, name))))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_time(value: str, now: Optional[datetime] = None) -> bytes:
+    """
+    Время в формате меток лога.
+    Args:
+        value: '2024-01-31', '2024-01-31 12:00[:00]', '2024-01-31T12:00' или относительное '15m', '2h', '1d'
+    Raises:
+        ValueError: Нераспознанное время
+    """
+    relative = re.fullmatch(r"(\d+)([smhd])", value)
+    if relative:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[relative.group(2)]
+        moment = (now or datetime.now()) - timedelta(**{unit: int(relative.group(1))})
+    else:
+        moment = datetime.fromisoformat(value)
+    return moment.strftime("%Y-%m-%d %H:%M:%S,%f")[:23].encode()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m modules.logquery",
+        description="Query rotated logs by time range using a sidecar time index"
+    )
+    parser.add_argument("paths", nargs="+", help="log files or directories (rotated and .gz/.bz2/.xz files included)")
+    parser.add_argument("--since", help="start time: '2024-01-31 12:00' or relative '30m', '2h', '1d'")
+    parser.add_argument("--until", help="end time (inclusive), same formats as --since")
+    parser.add_argument("--level", type=str.upper, choices=list(LEVELS), help="minimum level")
+    parser.add_argument("--ip", help="records mentioning this IP")
+    parser.add_argument("--user", help="records mentioning this username")
+    parser.add_argument("-H", "--with-filename", action="store_true", help="prefix records with the file name")
+    parser.add_argument("--stats", action="store_true", help="print files read/skipped and elapsed time to stderr")
+    args = parser.parse_args(argv)
+
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    stats: dict = {}
+    out = sys.stdout.buffer
+    count = 0
+    try:
+        for _, _, text, path in query(log_files(args.paths), since, until,
+                                      RecordFilter(args.level, args.ip, args.user), stats):
+            if args.with_filename:
+                out.write(os.path.basename(path).encode() + b": ")
+            out.write(text if text.endswith(b"\n") else text + b"\n")
+            count += 1
+        out.flush()
+    except BrokenPipeError:
+        # Вывод обрезан (например, head): оставшийся буфер stdout уходит в /dev/null
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.stats:
+        print(f"{count} records, {stats.get('read', 0)} files read, {stats.get('skipped', 0)} skipped, "
+              f"{time.perf_counter() - start:.3f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
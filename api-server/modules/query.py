@@ -0,0 +1,315 @@
+import base64
+import json
+import socket
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+
+@lru_cache(maxsize=1 << 17)
+def ip_number(ip: str) -> int:
+    """Числовое значение IP для сортировки (-1 для нераспознанного адреса)"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return int.from_bytes(socket.inet_pton(family, ip), "big")
+        except OSError:
+            pass
+    return -1
+
+
+# Ключи сортировки: однозначны для записи (IP и сессия), поэтому порядок стабилен между страницами
+SORT_KEYS = {
+    "ip": lambda s: (ip_number(s["ip"]), s["ip"], s.get("session", "")),
+    "username": lambda s: (s.get("username") or "", ip_number(s["ip"]), s["ip"], s.get("session", "")),
+}
+
+# Поля light=true: только необходимое для плиток (session - для хостов с несколькими сессиями, vnc_port - для шлюза)
+LIGHT_FIELDS = ("ip", "session", "username", "websockify_port", "vnc_port", "excluded", "reachable")
+
+
+def _bool(value: str) -> bool:
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError(f"Invalid boolean: {value}")
+
+
+def _positive_int(name: str, value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return number
+
+
+class ServerQuery:
+    """Параметры запроса GET /api/servers: фильтры, сортировка, курсор страницы и набор полей"""
+
+    def __init__(self, params: Dict[str, List[str]]):
+        """
+        Args:
+            params: Разобранная строка запроса (parse_qs)
+        Raises:
+            ValueError: Некорректное значение параметра
+        """
+        def get(name: str) -> Optional[str]:
+            values = params.get(name)
+            return values[0] if values else None
+
+        self.include_excluded = _bool(get("include_excluded") or "false")
+        self.excluded = _bool(get("excluded")) if get("excluded") is not None else None
+        self.reachable = _bool(get("reachable")) if get("reachable") is not None else None
+        self.username = get("username")
+        self.ip = get("ip")
+        self.ip_prefix = get("ip_prefix")
+        self.list = get("list")
+
+        self.sort = get("sort")
+        if self.sort is not None and self.sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {self.sort}")
+
+        self.limit = _positive_int("limit", get("limit")) if get("limit") is not None else None
+        self.cursor = self.decode_cursor(get("cursor")) if get("cursor") else None
+
+        if get("fields"):
+            self.fields: Optional[Tuple[str, ...]] = tuple(f for f in get("fields").split(",") if f)
+        elif _bool(get("light") or "false"):
+            self.fields = LIGHT_FIELDS
+        else:
+            self.fields = None
+
+        # Последний замер нагрузки хоста в поле telemetry
+        self.telemetry = _bool(get("telemetry") or "false") or (self.fields is not None and "telemetry" in self.fields)
+        if self.telemetry and self.fields is not None and "telemetry" not in self.fields:
+            self.fields += ("telemetry",)
+
+    @property
+    def is_plain(self) -> bool:
+        """Полный список в порядке реестра: ответ берётся из кеша закодированных тел"""
+        return (self.excluded is None and self.reachable is None and self.username is None
+                and self.ip is None and self.ip_prefix is None and self.list is None and self.sort is None
+                and self.limit is None and self.cursor is None and not self.telemetry
+                and self.fields in (None, LIGHT_FIELDS))
+
+    @staticmethod
+    def encode_cursor(key: Tuple) -> str:
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            key = None
+        # Курсор - закодированный ключ сортировки последней записи страницы (непустой список)
+        if not isinstance(key, list) or not key:
+            raise ValueError("cursor must be the X-Next-Cursor value of a previous page")
+        return tuple(key)
+
+
+def project(servers: List[Dict[str, Any]], fields: Optional[Tuple[str, ...]]) -> List[Dict[str, Any]]:
+    """Оставить в записях только запрошенные поля"""
+    if fields is None:
+        return servers
+    return [
+        {f: s.get(f, False) if f == "excluded" else s[f] for f in fields if f == "excluded" or f in s}
+        for s in servers
+    ]
+
+
+class Reachability:
+    """
+    Последний результат проверки доступности по IP.
+    IP с каждым результатом хранятся отдельно, поэтому фильтр reachable не просматривает весь реестр.
+    """
+
+    def __init__(self):
+        self.results: Dict[str, bool] = {}
+        self.ips: Dict[bool, Set[str]] = {True: set(), False: set()}
+
+    def record(self, ip: str, reachable: bool) -> None:
+        previous = self.results.get(ip)
+        if previous is not None:
+            self.ips[previous].discard(ip)
+        self.results[ip] = reachable
+        self.ips[reachable].add(ip)
+
+    def get(self, ip: str) -> Optional[bool]:
+        return self.results.get(ip)
+
+    def with_result(self, reachable: bool) -> Tuple[str, ...]:
+        """IP с последним результатом reachable (копия: проверки идут из других потоков)"""
+        return tuple(self.ips[reachable])
+
+
+class _Partition:
+    """Индексы одной части реестра (активные, исключённые или все записи)"""
+
+    def __init__(self):
+        # Для каждого ключа сортировки: ключи и записи в этом порядке
+        self.ordered: Dict[str, Tuple[List[Tuple], List[Dict[str, Any]]]] = {sort: ([], []) for sort in SORT_KEYS}
+        # IP в строковом порядке: совпадения префикса образуют непрерывный диапазон
+        self.ips: List[str] = []
+        self.by_ip: List[Dict[str, Any]] = []
+
+
+def _remove(keys: List, records: List[Dict[str, Any]], key: Any, server: Dict[str, Any]) -> None:
+    """Удаление записи из пары упорядоченных списков (ключ ищется бинарным поиском, запись - по идентичности)"""
+    position = bisect_left(keys, key)
+    while position < len(keys) and keys[position] == key:
+        if records[position] is server:
+            del keys[position]
+            del records[position]
+            return
+        position += 1
+
+
+def _insert(keys: List, records: List[Dict[str, Any]], key: Any, server: Dict[str, Any]) -> None:
+    position = bisect_right(keys, key)
+    keys.insert(position, key)
+    records.insert(position, server)
+
+
+class RegistryIndex:
+    """
+    Индексы снимка реестра для запросов с фильтрами и постраничной выдачей.
+    Строятся один раз, затем обновляются по изменившимся IP; запрос стоит O(log n + размер результата).
+    """
+
+    # Доля хостов с результатом проверки, ниже которой фильтр reachable идёт по IP с этим результатом
+    SPARSE_RATIO = 4
+    # Больше изменившихся IP за одно обновление - индекс строится заново
+    REBUILD_THRESHOLD = 256
+
+    def __init__(self, servers: List[Dict[str, Any]]):
+        self.partitions = {"active": _Partition(), "excluded": _Partition(), "all": _Partition()}
+        active, excluded, all_ = self.partitions["active"], self.partitions["excluded"], self.partitions["all"]
+
+        # Сортировка выполняется один раз, части реестра отбираются из готового порядка
+        for sort, key in SORT_KEYS.items():
+            pairs = sorted(((key(s), s) for s in servers), key=itemgetter(0))
+            all_.ordered[sort] = ([k for k, _ in pairs], [s for _, s in pairs])
+            for k, s in pairs:
+                keys, records = (excluded if s.get("excluded", False) else active).ordered[sort]
+                keys.append(k)
+                records.append(s)
+
+        # Записи каждого IP для выборки по списку хостов
+        self.records_by_ip: Dict[str, List[Dict[str, Any]]] = {}
+        for s in servers:
+            self.records_by_ip.setdefault(s["ip"], []).append(s)
+
+        all_.by_ip = sorted(servers, key=itemgetter("ip"))
+        all_.ips = [s["ip"] for s in all_.by_ip]
+        for s in all_.by_ip:
+            partition = excluded if s.get("excluded", False) else active
+            partition.by_ip.append(s)
+            partition.ips.append(s["ip"])
+
+    def _partitions_of(self, server: Dict[str, Any]) -> Tuple[_Partition, _Partition]:
+        return self.partitions["all"], self.partitions["excluded" if server.get("excluded", False) else "active"]
+
+    def update(self, ip: str, entries: List[Dict[str, Any]]) -> None:
+        """Замена записей одного IP (пустой список - удаление) во всех упорядоченных списках"""
+        for server in self.records_by_ip.pop(ip, ()):
+            for partition in self._partitions_of(server):
+                for sort, key in SORT_KEYS.items():
+                    _remove(*partition.ordered[sort], key(server), server)
+                _remove(partition.ips, partition.by_ip, ip, server)
+        if entries:
+            self.records_by_ip[ip] = list(entries)
+        for server in entries:
+            for partition in self._partitions_of(server):
+                for sort, key in SORT_KEYS.items():
+                    _insert(*partition.ordered[sort], key(server), server)
+                _insert(partition.ips, partition.by_ip, ip, server)
+
+    def select(self, query: ServerQuery, reachability: Reachability, members: Optional[List[str]] = None,
+               telemetry: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None
+               ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Выборка страницы.
+        Args:
+            query: Параметры запроса
+            reachability: Последний результат проверки доступности по IP
+            members: IP списка хостов query.list
+            telemetry: Последний замер нагрузки по IP (для query.telemetry)
+        Returns:
+            (записи страницы с выбранными полями, курсор следующей страницы или None)
+        """
+        if query.excluded is not None:
+            part = "excluded" if query.excluded else "active"
+        else:
+            part = "all" if query.include_excluded else "active"
+        partition = self.partitions[part]
+        sort = query.sort or "ip"
+
+        candidate_ips = members
+        if candidate_ips is None and query.reachable is not None and query.ip is None and query.username is None:
+            # Редкий результат проверки (например, недоступные хосты) выбирается по IP с этим результатом.
+            # Частый дешевле отфильтровать при обходе порядка: страница набирается за несколько её размеров
+            ips = reachability.with_result(query.reachable)
+            if len(ips) * self.SPARSE_RATIO < len(partition.by_ip):
+                candidate_ips = ips
+
+        if candidate_ips is not None:
+            # Хосты списка или проверки: стоимость пропорциональна их числу, а не размеру реестра
+            candidates = [s for ip in candidate_ips for s in self.records_by_ip.get(ip, ())
+                          if part == "all" or s.get("excluded", False) == (part == "excluded")]
+            if query.ip is not None:
+                candidates = [s for s in candidates if s["ip"] == query.ip]
+            if query.ip_prefix is not None:
+                candidates = [s for s in candidates if s["ip"].startswith(query.ip_prefix)]
+            if query.username is not None:
+                candidates = [s for s in candidates if (s.get("username") or "") == query.username]
+            pairs = sorted(((SORT_KEYS[sort](s), s) for s in candidates), key=itemgetter(0))
+            keys, records = [k for k, _ in pairs], [s for _, s in pairs]
+        elif query.ip is not None or query.ip_prefix is not None:
+            if query.ip is not None:
+                lo, hi = bisect_left(partition.ips, query.ip), bisect_right(partition.ips, query.ip)
+            else:
+                lo = bisect_left(partition.ips, query.ip_prefix)
+                hi = bisect_left(partition.ips, query.ip_prefix + "\uffff")
+            candidates = partition.by_ip[lo:hi]
+            if query.ip is not None and query.ip_prefix is not None:
+                candidates = [s for s in candidates if s["ip"].startswith(query.ip_prefix)]
+            if query.username is not None:
+                candidates = [s for s in candidates if (s.get("username") or "") == query.username]
+            pairs = sorted(((SORT_KEYS[sort](s), s) for s in candidates), key=itemgetter(0))
+            keys, records = [k for k, _ in pairs], [s for _, s in pairs]
+        elif query.username is not None:
+            # Записи пользователя - непрерывный диапазон порядка username, внутри него порядок по IP
+            keys, records = partition.ordered["username"]
+            lo = bisect_left(keys, (query.username,))
+            hi = bisect_right(keys, (query.username, float("inf")))
+            keys, records = keys[lo:hi], records[lo:hi]
+            if sort == "ip":
+                keys = [k[1:] for k in keys]
+        else:
+            keys, records = partition.ordered[sort]
+
+        try:
+            position = bisect_right(keys, query.cursor) if query.cursor is not None else 0
+        except TypeError:
+            raise ValueError("Cursor does not match the sort key")
+        page = []
+        while position < len(records) and (query.limit is None or len(page) < query.limit):
+            server = records[position]
+            position += 1
+            if query.reachable is not None and reachability.get(server["ip"]) is not query.reachable:
+                continue
+            page.append(server)
+
+        next_cursor = None
+        if query.limit is not None and len(page) == query.limit and position < len(records):
+            next_cursor = ServerQuery.encode_cursor(keys[position - 1])
+        if members is not None:
+            page = [dict(s, reachable=reachability.get(s["ip"])) if reachability.get(s["ip"]) is not None else s
+                    for s in page]
+        if query.telemetry and telemetry is not None:
+            page = [dict(s, telemetry=telemetry(s["ip"])) for s in page]
+        return project(page, query.fields), next_cursor
@@ -0,0 +1,292 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlencode
+from typing import Any, Dict, Iterable, List, Optional
+from .logger import ServerLogger
+
+
+def change_key(change: Dict[str, Any]) -> str:
+    """Ключ изменения в журнале: IP записи реестра или имя списка хостов (IP не начинается с 'list:')"""
+    return change["ip"] if "ip" in change else f"list:{change['list']}"
+
+
+class ChangeLog:
+    """
+    Журнал изменений реестра для репликации между узлами API-сервера.
+    Запись журнала - все записи одного IP после изменения (пустой список - удаление)
+    или все IP именованного списка (None - список удалён)
+    с ревизией [время, узел]: при слиянии побеждает бо́льшая ревизия.
+    Номера seq локальны для узла, эпоха меняется при пересоздании файла журнала.
+    Файл общий для процессов-воркеров, дописывается под собственным flock (реестр и списки
+    пишутся под разными блокировками).
+    """
+
+    # Допустимое число устаревших строк сверх актуальных перед сжатием файла
+    COMPACT_SLACK = 1000
+
+    def __init__(self, path: str, node_id: str):
+        """
+        Args:
+            path: Путь к файлу журнала (JSON Lines, первая строка - заголовок с эпохой)
+            node_id: Идентификатор узла в ревизиях
+        """
+        self.path = path
+        self.lock_file = f"{path}.lock"
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._file_key = None
+        self.epoch: Optional[str] = None
+        self.seq = 0
+        self.lines = 0
+        # Последнее изменение каждого IP и списка (ключ change_key)
+        self.latest: Dict[str, Dict[str, Any]] = {}
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _create(self) -> None:
+        """Создание пустого журнала с новой эпохой (os.link не перезапишет журнал другого процесса)"""
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps({"epoch": uuid.uuid4().hex}) + "\n")
+        try:
+            os.link(tmp_file, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_file)
+
+    def _refresh(self) -> None:
+        """Перечитывание файла, если его изменил другой процесс (вызывается под self._lock)"""
+        key = self._stat()
+        if key is None:
+            self._create()
+            key = self._stat()
+        if key == self._file_key:
+            return
+
+        latest, seq, lines = {}, 0, 0
+        with open(self.path, "r") as f:
+            epoch = json.loads(f.readline())["epoch"]
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # Строка ещё дописывается другим процессом
+                change = json.loads(line)
+                latest[change_key(change)] = change
+                seq = change["seq"]
+                lines += 1
+        self.epoch, self.seq, self.lines, self.latest = epoch, seq, lines, latest
+        self._file_key = key
+
+    def revision(self, ip: str) -> Optional[List]:
+        with self._lock:
+            self._refresh()
+            change = self.latest.get(ip)
+            return change["rev"] if change else None
+
+    def list_revision(self, name: str) -> Optional[List]:
+        return self.revision(f"list:{name}")
+
+    @contextmanager
+    def _append_lock(self):
+        """Дописывание журнала: блокировка между потоками и процессами, затем актуальное состояние файла"""
+        with self._lock:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._refresh()
+                yield
+            finally:
+                os.close(fd)  # Закрытие дескриптора снимает flock
+
+    def _append(self, changes: List[Dict[str, Any]], revisions: Optional[Dict[str, List]]) -> None:
+        """Присвоение ревизий и seq изменениям и запись их в конец журнала (под _append_lock)"""
+        now = time.time()
+        lines = []
+        for change in changes:
+            key = change_key(change)
+            rev = (revisions or {}).get(change.get("ip", change.get("list")))
+            if rev is None:
+                previous = self.latest.get(key)
+                # Ревизия локального изменения растёт даже при отставании часов
+                rev = [max(now, previous["rev"][0] + 1e-6) if previous else now, self.node_id]
+            self.seq += 1
+            change = {"seq": self.seq, **change, "rev": rev}
+            self.latest[key] = change
+            lines.append(json.dumps(change, default=dict) + "\n")
+
+        with open(self.path, "a") as f:
+            f.write("".join(lines))
+        self.lines += len(lines)
+        self._file_key = self._stat()
+
+        if self.lines > 2 * len(self.latest) + self.COMPACT_SLACK:
+            self._compact()
+
+    def record(self, servers: List[Dict[str, Any]], ips: Iterable[str],
+               revisions: Optional[Dict[str, List]] = None) -> None:
+        """
+        Запись изменившихся IP в журнал. Вызывается под блокировкой записи реестра.
+        Args:
+            servers: Сохранённый список серверов
+            ips: IP, записи которых изменились
+            revisions: Ревизии изменений, полученных от других узлов (иначе - новые локальные)
+        """
+        entries = {ip: [] for ip in ips}
+        if not entries:
+            return
+        for server in servers:
+            if server["ip"] in entries:
+                entries[server["ip"]].append(server)
+
+        with self._append_lock():
+            self._append([{"ip": ip, "entries": ip_entries} for ip, ip_entries in entries.items()], revisions)
+
+    def record_lists(self, lists: Dict[str, Optional[List[str]]],
+                     revisions: Optional[Dict[str, List]] = None) -> None:
+        """
+        Запись изменившихся списков хостов в журнал. Вызывается под блокировкой записи списков.
+        Args:
+            lists: Все IP каждого изменившегося списка (None - список удалён)
+            revisions: Ревизии изменений, полученных от других узлов (иначе - новые локальные)
+        """
+        if not lists:
+            return
+        with self._append_lock():
+            self._append([{"list": name, "members": members} for name, members in lists.items()], revisions)
+
+    def _compact(self) -> None:
+        """Перезапись журнала только последними изменениями IP и списков (номера seq сохраняются)"""
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(json.dumps({"epoch": self.epoch}) + "\n")
+            for change in sorted(self.latest.values(), key=lambda c: c["seq"]):
+                f.write(json.dumps(change, default=dict) + "\n")
+        os.replace(tmp_file, self.path)
+        self.lines = len(self.latest)
+        self._file_key = self._stat()
+
+    def seed(self, servers: List[Dict[str, Any]], lists: Optional[Dict[str, List[str]]] = None) -> None:
+        """
+        Запись уже существующих реестра и списков хостов в пустой журнал с нулевой ревизией,
+        чтобы другие узлы получили их, но любое реальное изменение имело приоритет.
+        """
+        with self._lock:
+            self._refresh()
+            if self.seq:
+                return
+        ips = {server["ip"] for server in servers}
+        self.record(servers, ips, {ip: [0, self.node_id] for ip in ips})
+        if lists:
+            self.record_lists(dict(lists), {name: [0, self.node_id] for name in lists})
+
+    def changes(self, epoch: Optional[str], since: int, limit: int) -> Dict[str, Any]:
+        """
+        Изменения после since для узла, читающего журнал с эпохой epoch.
+        При другой эпохе или отставании больше limit узлу нужен полный снимок.
+        """
+        with self._lock:
+            self._refresh()
+            if epoch != self.epoch or since > self.seq:
+                return {"epoch": self.epoch, "seq": self.seq, "snapshot_required": True}
+            changes = [c for c in self.latest.values() if c["seq"] > since]
+            if len(changes) > limit:
+                return {"epoch": self.epoch, "seq": self.seq, "snapshot_required": True}
+            return {"epoch": self.epoch, "seq": self.seq, "changes": sorted(changes, key=lambda c: c["seq"])}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Полный снимок: последние изменения всех IP, включая удаления"""
+        with self._lock:
+            self._refresh()
+            return {"epoch": self.epoch, "seq": self.seq,
+                    "changes": sorted(self.latest.values(), key=lambda c: c["seq"])}
+
+
+class Replicator:
+    """
+    Синхронизация реестра с другими узлами: периодическое чтение журнала изменений каждого узла.
+    Отставший или перезапущенный узел догоняет остальных по полному снимку.
+    """
+
+    def __init__(self, logger: ServerLogger, manager, peers: List[str], interval: float,
+                 timeout: float = 5, limit: int = 1000):
+        """
+        Args:
+            logger: Экземпляр ServerLogger
+            manager: Экземпляр ServerManager с журналом изменений
+            peers: Адреса других узлов (host:port)
+            interval: Период опроса узлов (сек)
+            timeout: Таймаут HTTP-запроса к узлу (сек)
+            limit: Максимальное число изменений в ответе, иначе - полный снимок
+        """
+        self.logger = logger
+        self.manager = manager
+        self.peers = peers
+        self.interval = interval
+        self.timeout = timeout
+        self.limit = limit
+        self.thread: Optional[threading.Thread] = None
+        # Позиция чтения журнала каждого узла и статистика синхронизации
+        self.peer_state: Dict[str, Dict[str, Any]] = {
+            peer: {"epoch": None, "seq": 0, "applied": 0, "snapshots": 0, "last_sync": None, "error": None}
+            for peer in peers
+        }
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="replication", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Replication started with peers: {', '.join(self.peers)}")
+
+    def _run(self) -> None:
+        while True:
+            for peer in self.peers:
+                state = self.peer_state[peer]
+                try:
+                    self.sync(peer)
+                    state["error"] = None
+                except Exception as e:
+                    if state["error"] != str(e):
+                        self.logger.warning(f"Replication from {peer} failed: {e}")
+                    state["error"] = str(e)
+            time.sleep(self.interval)
+
+    def _get(self, peer: str, path: str) -> Dict[str, Any]:
+        with urllib.request.urlopen(f"http://{peer}{path}", timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def sync(self, peer: str) -> int:
+        """
+        Применение новых изменений одного узла.
+        Returns:
+            Число применённых изменений
+        """
+        state = self.peer_state[peer]
+        query = urlencode({"epoch": state["epoch"] or "", "since": state["seq"], "limit": self.limit})
+        data = self._get(peer, f"/api/replication/changes?{query}")
+        if data.get("snapshot_required"):
+            self.logger.info(f"Catching up with {peer} from snapshot")
+            data = self._get(peer, "/api/replication/snapshot")
+            state["snapshots"] += 1
+
+        applied = self.manager.apply_changes(data["changes"])
+        if applied:
+            self.logger.info(f"Applied {applied} change(s) from {peer}")
+        state.update(epoch=data["epoch"], seq=data["seq"], last_sync=time.time())
+        state["applied"] += applied
+        return applied
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние репликации для /api/metrics"""
+        changelog = self.manager.changelog
+        return {"node": changelog.node_id, "epoch": changelog.epoch, "seq": changelog.seq,
+                "peers": self.peer_state}
@@ -0,0 +1,457 @@
+import asyncio
+import struct
+import zlib
+from io import BytesIO
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него Tight сжимает кадр только zlib
+    Image = None
+
+
+# Формат пикселя, который noVNC запрашивает по умолчанию:
+# 32 bpp, глубина 24, little-endian, true colour, R/G/B в младших байтах
+PIXEL_FORMAT = struct.pack("!BBBBHHHBBB3x", 32, 24, 0, 1, 255, 255, 255, 0, 8, 16)
+BYTES_PER_PIXEL = 4
+
+ENCODING_RAW = 0
+ENCODING_COPYRECT = 1
+ENCODING_HEXTILE = 5
+ENCODING_ZLIB = 6
+ENCODING_TIGHT = 7
+ENCODING_ZRLE = 16
+ENCODING_DESKTOP_SIZE = -223
+# Псевдокодировки уровня сжатия и качества JPEG: базовое значение + уровень 0-9
+ENCODING_COMPRESS_LEVEL_0 = -256
+ENCODING_QUALITY_LEVEL_0 = -32
+
+HEXTILE_RAW = 1
+HEXTILE_BACKGROUND = 2
+HEXTILE_FOREGROUND = 4
+HEXTILE_ANY_SUBRECTS = 8
+HEXTILE_SUBRECTS_COLOURED = 16
+
+SECURITY_NONE = 1
+SECURITY_VNC = 2
+
+Rect = Tuple[int, int, int, int]
+
+
+class RFBError(Exception):
+    """Ошибка протокола RFB"""
+
+
+# DES (только шифрование одного блока) для VNC-аутентификации.
+# Стандартная библиотека Python не содержит DES, а VNC auth требует именно его.
+
+_PC1 = (57, 49, 41, 33, 25, 17, 9, 1, 58, 50, 42, 34, 26, 18, 10, 2, 59, 51, 43, 35, 27, 19, 11, 3, 60, 52,
+        44, 36, 63, 55, 47, 39, 31, 23, 15, 7, 62, 54, 46, 38, 30, 22, 14, 6, 61, 53, 45, 37, 29, 21, 13, 5,
+        28, 20, 12, 4)
+_PC2 = (14, 17, 11, 24, 1, 5, 3, 28, 15, 6, 21, 10, 23, 19, 12, 4, 26, 8, 16, 7, 27, 20, 13, 2, 41, 52, 31,
+        37, 47, 55, 30, 40, 51, 45, 33, 48, 44, 49, 39, 56, 34, 53, 46, 42, 50, 36, 29, 32)
+_SHIFTS = (1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1)
+_IP = (58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4, 62, 54, 46, 38, 30, 22, 14, 6, 64, 56,
+       48, 40, 32, 24, 16, 8, 57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3, 61, 53, 45, 37,
+       29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7)
+_FP = (40, 8, 48, 16, 56, 24, 64, 32, 39, 7, 47, 15, 55, 23, 63, 31, 38, 6, 46, 14, 54, 22, 62, 30, 37, 5,
+       45, 13, 53, 21, 61, 29, 36, 4, 44, 12, 52, 20, 60, 28, 35, 3, 43, 11, 51, 19, 59, 27, 34, 2, 42, 10,
+       50, 18, 58, 26, 33, 1, 41, 9, 49, 17, 57, 25)
+_E = (32, 1, 2, 3, 4, 5, 4, 5, 6, 7, 8, 9, 8, 9, 10, 11, 12, 13, 12, 13, 14, 15, 16, 17, 16, 17, 18, 19, 20,
+      21, 20, 21, 22, 23, 24, 25, 24, 25, 26, 27, 28, 29, 28, 29, 30, 31, 32, 1)
+_P = (16, 7, 20, 21, 29, 12, 28, 17, 1, 15, 23, 26, 5, 18, 31, 10, 2, 8, 24, 14, 32, 27, 3, 9, 19, 13, 30,
+      6, 22, 11, 4, 25)
+_SBOX = (
+    (14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7, 0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+     4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0, 15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13),
+    (15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10, 3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5,
+     0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15, 13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9),
+    (10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8, 13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1,
+     13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7, 1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12),
+    (7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15, 13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9,
+     10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4, 3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14),
+    (2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9, 14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6,
+     4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14, 11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3),
+    (12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11, 10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8,
+     9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6, 4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13),
+    (4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1, 13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6,
+     1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2, 6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12),
+    (13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7, 1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2,
+     7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8, 2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11),
+)
+
+
+def _permute(value: int, table: Tuple[int, ...], width: int) -> int:
+    result = 0
+    for position in table:
+        result = (result << 1) | ((value >> (width - position)) & 1)
+    return result
+
+
+def des_encrypt_block(key: bytes, block: bytes) -> bytes:
+    """Шифрование одного 8-байтового блока DES"""
+    cd = _permute(int.from_bytes(key, "big"), _PC1, 64)
+    c, d = cd >> 28, cd & 0xFFFFFFF
+    subkeys = []
+    for shift in _SHIFTS:
+        c = ((c << shift) | (c >> (28 - shift))) & 0xFFFFFFF
+        d = ((d << shift) | (d >> (28 - shift))) & 0xFFFFFFF
+        subkeys.append(_permute((c << 28) | d, _PC2, 56))
+
+    data = _permute(int.from_bytes(block, "big"), _IP, 64)
+    left, right = data >> 32, data & 0xFFFFFFFF
+    for subkey in subkeys:
+        x = _permute(right, _E, 32) ^ subkey
+        out = 0
+        for i in range(8):
+            chunk = (x >> (42 - 6 * i)) & 0x3F
+            row = ((chunk & 0x20) >> 4) | (chunk & 1)
+            out = (out << 4) | _SBOX[i][row * 16 + ((chunk >> 1) & 0xF)]
+        left, right = right, left ^ _permute(out, _P, 32)
+    return _permute((right << 32) | left, _FP, 64).to_bytes(8, "big")
+
+
+def vnc_auth_response(password: str, challenge: bytes) -> bytes:
+    """Ответ на 16-байтовый вызов VNC-аутентификации (биты каждого байта ключа инвертированы по порядку)"""
+    key = password.encode("latin-1")[:8].ljust(8, b"\0")
+    key = bytes(int(f"{b:08b}"[::-1], 2) for b in key)
+    return des_encrypt_block(key, challenge[:8]) + des_encrypt_block(key, challenge[8:16])
+
+
+class Framebuffer:
+    """Декодированный кадр в формате PIXEL_FORMAT"""
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.data = bytearray(width * height * BYTES_PER_PIXEL)
+
+    def resize(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        self.data = bytearray(width * height * BYTES_PER_PIXEL)
+
+    def put(self, x: int, y: int, w: int, h: int, pixels: bytes) -> None:
+        """Запись прямоугольника построчно"""
+        stride = self.width * BYTES_PER_PIXEL
+        row = w * BYTES_PER_PIXEL
+        src = memoryview(pixels)
+        for i in range(h):
+            start = (y + i) * stride + x * BYTES_PER_PIXEL
+            self.data[start:start + row] = src[i * row:(i + 1) * row]
+
+    def get(self, x: int, y: int, w: int, h: int) -> bytes:
+        """Чтение прямоугольника построчно"""
+        if x == 0 and w == self.width:
+            stride = self.width * BYTES_PER_PIXEL
+            return bytes(self.data[y * stride:(y + h) * stride])
+        stride = self.width * BYTES_PER_PIXEL
+        row = w * BYTES_PER_PIXEL
+        view = memoryview(self.data)
+        return b"".join(view[(y + i) * stride + x * BYTES_PER_PIXEL:][:row] for i in range(h))
+
+    def copy(self, src_x: int, src_y: int, x: int, y: int, w: int, h: int) -> None:
+        self.put(x, y, w, h, self.get(src_x, src_y, w, h))
+
+
+def _cpixels(pixels: bytes) -> bytearray:
+    """Пиксели PIXEL_FORMAT без неиспользуемого старшего байта (CPIXEL в ZRLE, TPIXEL в Tight)"""
+    packed = bytearray(len(pixels) // BYTES_PER_PIXEL * 3)
+    packed[0::3] = pixels[0::4]
+    packed[1::3] = pixels[1::4]
+    packed[2::3] = pixels[2::4]
+    return packed
+
+
+def _compact_length(length: int) -> bytes:
+    """Длина данных Tight: 1-3 байта по 7 бит, старший бит - признак продолжения"""
+    out = bytearray([length & 0x7F])
+    if length > 0x7F:
+        out[0] |= 0x80
+        out.append(length >> 7 & 0x7F)
+        if length > 0x3FFF:
+            out[1] |= 0x80
+            out.append(length >> 14 & 0xFF)
+    return bytes(out)
+
+
+class RectEncoder:
+    """
+    Кодирование прямоугольников кадра для одного клиента.
+    Кодировка выбирается по SetEncodings клиента (первая из поддерживаемых),
+    уровень zlib и качество JPEG - по псевдокодировкам уровня сжатия и качества.
+    Потоки zlib у каждого клиента свои, поэтому экземпляр нельзя делить между клиентами.
+    """
+
+    SUPPORTED = (ENCODING_TIGHT, ENCODING_ZRLE, ENCODING_ZLIB, ENCODING_RAW)
+    DEFAULT_COMPRESS_LEVEL = 1
+    # Уровни качества 0-9 в качество JPEG (как в TigerVNC)
+    JPEG_QUALITY = (15, 29, 41, 42, 62, 77, 79, 86, 92, 100)
+    # Мелкие прямоугольники (текст, курсор) выгоднее сжимать без потерь
+    JPEG_MIN_PIXELS = 4096
+    TIGHT_MAX_WIDTH = 2048
+    ZRLE_TILE = 64
+
+    def __init__(self):
+        self.encoding = ENCODING_RAW
+        self.compress_level = self.DEFAULT_COMPRESS_LEVEL
+        self.quality: Optional[int] = None
+        self.streams: Dict[int, "zlib._Compress"] = {}
+        self.tight_reset = False
+
+    def configure(self, encodings: Sequence[int]) -> None:
+        """Выбор кодировки, уровня сжатия и качества по сообщению SetEncodings"""
+        self.encoding = next((e for e in encodings if e in self.SUPPORTED), ENCODING_RAW)
+        levels = [e - ENCODING_COMPRESS_LEVEL_0 for e in encodings if 0 <= e - ENCODING_COMPRESS_LEVEL_0 <= 9]
+        qualities = [e - ENCODING_QUALITY_LEVEL_0 for e in encodings if 0 <= e - ENCODING_QUALITY_LEVEL_0 <= 9]
+        level = levels[0] if levels else self.DEFAULT_COMPRESS_LEVEL
+        if level != self.compress_level and self.streams.pop(ENCODING_TIGHT, None):
+            # Поток Tight пересоздаётся с новым уровнем, клиент сбросит свой по флагу в заголовке.
+            # Потоки ZRLE и Zlib сбросить нельзя, они сохраняют прежний уровень
+            self.tight_reset = True
+        self.compress_level = level
+        self.quality = self.JPEG_QUALITY[qualities[0]] if qualities and Image is not None else None
+
+    def _compress(self, encoding: int, data: bytes) -> bytes:
+        stream = self.streams.get(encoding)
+        if stream is None:
+            stream = self.streams[encoding] = zlib.compressobj(self.compress_level)
+        return stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+    def encode(self, rects: List[Tuple[int, int, int, int, bytes]]) -> Tuple[int, List[bytes]]:
+        """
+        Кодирование прямоугольников; может выполняться вне цикла событий.
+        Args:
+            rects: Прямоугольники (x, y, w, h, пиксели в формате PIXEL_FORMAT)
+        Returns:
+            Число прямоугольников и части сообщения FramebufferUpdate после его заголовка
+        """
+        count = 0
+        parts = []
+        for x, y, w, h, pixels in rects:
+            if self.encoding == ENCODING_TIGHT and w > self.TIGHT_MAX_WIDTH:
+                # Ширина прямоугольника Tight ограничена: кадр делится на вертикальные полосы
+                view = memoryview(pixels)
+                row = w * BYTES_PER_PIXEL
+                for left in range(0, w, self.TIGHT_MAX_WIDTH):
+                    width = min(self.TIGHT_MAX_WIDTH, w - left)
+                    strip = b"".join(view[i * row + left * BYTES_PER_PIXEL:][:width * BYTES_PER_PIXEL]
+                                     for i in range(h))
+                    parts.append(struct.pack("!HHHHi", x + left, y, width, h, ENCODING_TIGHT))
+                    parts.append(self._tight(width, h, strip))
+                    count += 1
+                continue
+            parts.append(struct.pack("!HHHHi", x, y, w, h, self.encoding))
+            if self.encoding == ENCODING_TIGHT:
+                parts.append(self._tight(w, h, pixels))
+            elif self.encoding == ENCODING_ZRLE:
+                parts.append(self._zrle(w, h, pixels))
+            elif self.encoding == ENCODING_ZLIB:
+                data = self._compress(ENCODING_ZLIB, pixels)
+                parts.extend((struct.pack("!I", len(data)), data))
+            else:
+                parts.append(pixels)
+            count += 1
+        return count, parts
+
+    def _tight(self, w: int, h: int, pixels: bytes) -> bytes:
+        """Tight: заливка одним цветом, JPEG при заданном качестве или zlib без фильтра"""
+        reset = 0x01 if self.tight_reset else 0
+        self.tight_reset = False
+        if pixels.count(pixels[:BYTES_PER_PIXEL]) == w * h:
+            return bytes([0x80 | reset]) + pixels[:3]
+        if self.quality is not None and w * h >= self.JPEG_MIN_PIXELS:
+            out = BytesIO()
+            Image.frombuffer("RGB", (w, h), pixels, "raw", "RGBX", 0, 1).save(out, "JPEG", quality=self.quality)
+            data = out.getvalue()
+            return bytes([0x90 | reset]) + _compact_length(len(data)) + data
+        packed = _cpixels(pixels)
+        if len(packed) < 12:  # Совсем мелкие данные передаются без сжатия
+            return bytes([reset]) + packed
+        data = self._compress(ENCODING_TIGHT, packed)
+        return bytes([reset]) + _compact_length(len(data)) + data
+
+    def _zrle(self, w: int, h: int, pixels: bytes) -> bytes:
+        """ZRLE: плитки 64x64, одноцветные - заливкой, остальные - пикселями без палитры"""
+        packed = _cpixels(pixels)
+        view = memoryview(packed)
+        stride = w * 3
+        tiles = []
+        for top in range(0, h, self.ZRLE_TILE):
+            th = min(self.ZRLE_TILE, h - top)
+            for left in range(0, w, self.ZRLE_TILE):
+                tw = min(self.ZRLE_TILE, w - left)
+                tile = b"".join(view[(top + i) * stride + left * 3:][:tw * 3] for i in range(th))
+                if tile.count(tile[:3]) == tw * th:
+                    tiles.append(b"\x01" + tile[:3])
+                else:
+                    tiles.append(b"\x00" + tile)
+        data = self._compress(ENCODING_ZRLE, b"".join(tiles))
+        return struct.pack("!I", len(data)) + data
+
+
+class RFBClient:
+    """Минимальный клиент RFB 3.8: Zlib, Hextile, CopyRect, Raw и DesktopSize"""
+
+    # Кодировки в порядке предпочтения; низкий уровень zlib бережёт CPU хоста
+    ENCODINGS = (ENCODING_COPYRECT, ENCODING_ZLIB, ENCODING_HEXTILE, ENCODING_RAW,
+                 ENCODING_DESKTOP_SIZE, ENCODING_COMPRESS_LEVEL_0 + 1)
+
+    def __init__(self, host: str, port: int, password: str = "", timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.framebuffer: Optional[Framebuffer] = None
+        self.name = ""
+        # Последнее обновление изменило размер кадра
+        self.resized = False
+        self.inflator = zlib.decompressobj()
+        self.bytes_received = 0
+
+    async def _read(self, n: int) -> bytes:
+        self.bytes_received += n
+        return await asyncio.wait_for(self.reader.readexactly(n), self.timeout)
+
+    async def connect(self, shared: bool = True) -> None:
+        """Подключение, аутентификация и согласование формата пикселя"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+        version = await self._read(12)
+        if not version.startswith(b"RFB "):
+            raise RFBError(f"Not an RFB server: {version!r}")
+        self.writer.write(b"RFB 003.008\n")
+
+        count = (await self._read(1))[0]
+        if count == 0:
+            reason_len = struct.unpack("!I", await self._read(4))[0]
+            raise RFBError((await self._read(reason_len)).decode(errors="replace"))
+        types = await self._read(count)
+
+        if SECURITY_VNC in types and self.password:
+            self.writer.write(bytes([SECURITY_VNC]))
+            challenge = await self._read(16)
+            self.writer.write(vnc_auth_response(self.password, challenge))
+        elif SECURITY_NONE in types:
+            self.writer.write(bytes([SECURITY_NONE]))
+        else:
+            raise RFBError(f"No supported security type in {list(types)}")
+
+        if struct.unpack("!I", await self._read(4))[0] != 0:
+            raise RFBError("Authentication failed")
+
+        self.writer.write(bytes([1 if shared else 0]))
+        width, height = struct.unpack("!HH", await self._read(4))
+        await self._read(16)  # Исходный формат пикселя сервера
+        name_len = struct.unpack("!I", await self._read(4))[0]
+        self.name = (await self._read(name_len)).decode(errors="replace")
+        self.framebuffer = Framebuffer(width, height)
+
+        self.writer.write(b"\x00\x00\x00\x00" + PIXEL_FORMAT)
+        self.writer.write(struct.pack(f"!BxH{len(self.ENCODINGS)}i", 2, len(self.ENCODINGS), *self.ENCODINGS))
+        await self.writer.drain()
+
+    async def request_update(self, incremental: bool = True) -> None:
+        fb = self.framebuffer
+        self.writer.write(struct.pack("!BBHHHH", 3, 1 if incremental else 0, 0, 0, fb.width, fb.height))
+        await self.writer.drain()
+
+    async def read_update(self) -> List[Rect]:
+        """
+        Чтение сообщений до очередного FramebufferUpdate и применение его к кадру.
+        Returns:
+            Изменённые прямоугольники; при смене размера - весь кадр
+        """
+        fb = self.framebuffer
+        self.resized = False
+        while True:
+            msg_type = (await self._read(1))[0]
+            if msg_type == 0:
+                break
+            if msg_type == 1:  # SetColourMapEntries - не используется в true colour
+                _, count = struct.unpack("!xHH", await self._read(5))
+                await self._read(count * 6)
+            elif msg_type == 2:  # Bell
+                continue
+            elif msg_type == 3:  # ServerCutText
+                length = struct.unpack("!3xI", await self._read(7))[0]
+                await self._read(length)
+            else:
+                raise RFBError(f"Unsupported server message {msg_type}")
+
+        count = struct.unpack("!xH", await self._read(3))[0]
+        rects = []
+        for _ in range(count):
+            x, y, w, h, encoding = struct.unpack("!HHHHi", await self._read(12))
+            if encoding == ENCODING_RAW:
+                fb.put(x, y, w, h, await self._read(w * h * BYTES_PER_PIXEL))
+                rects.append((x, y, w, h))
+            elif encoding == ENCODING_COPYRECT:
+                src_x, src_y = struct.unpack("!HH", await self._read(4))
+                fb.copy(src_x, src_y, x, y, w, h)
+                rects.append((x, y, w, h))
+            elif encoding == ENCODING_ZLIB:
+                length = struct.unpack("!I", await self._read(4))[0]
+                fb.put(x, y, w, h, self.inflator.decompress(await self._read(length)))
+                rects.append((x, y, w, h))
+            elif encoding == ENCODING_HEXTILE:
+                # Плитки читаются без отдельного тайм-аута на каждую: он один на весь прямоугольник
+                await asyncio.wait_for(self._read_hextile(x, y, w, h), self.timeout)
+                rects.append((x, y, w, h))
+            elif encoding == ENCODING_DESKTOP_SIZE:
+                fb.resize(w, h)
+                self.resized = True
+                rects = [(0, 0, w, h)]
+            else:
+                raise RFBError(f"Unsupported encoding {encoding}")
+        return rects
+
+    async def _read_hextile(self, x: int, y: int, w: int, h: int) -> None:
+        """Декодирование Hextile: плитки 16x16 слева направо и сверху вниз"""
+        fb = self.framebuffer
+        read = self.reader.readexactly
+        background = foreground = bytes(BYTES_PER_PIXEL)
+        for top in range(y, y + h, 16):
+            th = min(16, y + h - top)
+            for left in range(x, x + w, 16):
+                tw = min(16, x + w - left)
+                mask = (await read(1))[0]
+                self.bytes_received += 1
+                if mask & HEXTILE_RAW:
+                    fb.put(left, top, tw, th, await read(tw * th * BYTES_PER_PIXEL))
+                    self.bytes_received += tw * th * BYTES_PER_PIXEL
+                    continue
+                if mask & HEXTILE_BACKGROUND:
+                    background = await read(BYTES_PER_PIXEL)
+                    self.bytes_received += BYTES_PER_PIXEL
+                if mask & HEXTILE_FOREGROUND:
+                    foreground = await read(BYTES_PER_PIXEL)
+                    self.bytes_received += BYTES_PER_PIXEL
+                tile = bytearray(background * (tw * th))
+                if mask & HEXTILE_ANY_SUBRECTS:
+                    count = (await read(1))[0]
+                    size = BYTES_PER_PIXEL + 2 if mask & HEXTILE_SUBRECTS_COLOURED else 2
+                    data = await read(count * size)
+                    self.bytes_received += 1 + len(data)
+                    colour = foreground
+                    for i in range(0, len(data), size):
+                        if size > 2:
+                            colour = data[i:i + BYTES_PER_PIXEL]
+                        xy, wh = data[i + size - 2], data[i + size - 1]
+                        sx, sw, sh = xy >> 4, (wh >> 4) + 1, (wh & 15) + 1
+                        line = colour * sw
+                        for row in range((xy & 15), (xy & 15) + sh):
+                            pos = (row * tw + sx) * BYTES_PER_PIXEL
+                            tile[pos:pos + len(line)] = line
+                fb.put(left, top, tw, th, tile)
+
+    async def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, AttributeError):
+                pass
@@ -0,0 +1,199 @@
+import ipaddress
+from bisect import bisect_left, insort
+from typing import Any, Callable, Dict, Iterable, List, Set
+
+# Поля и режимы поиска
+SEARCH_FIELDS = ("any", "username", "ip")
+SEARCH_MODES = ("prefix", "substring")
+
+
+def ip_key(ip: str) -> str:
+    """Ключ IP в индексе: IPv6 в сокращённой записи (FE80:0::1 и fe80::1 совпадают), остальное в нижнем регистре"""
+    if ":" in ip:
+        try:
+            return ipaddress.ip_address(ip).compressed
+        except ValueError:
+            pass
+    return ip.lower()
+
+
+def _all_starts(key: str) -> Iterable[int]:
+    return range(len(key))
+
+
+def _octet_starts(ip: str) -> Iterable[int]:
+    """Начала октетов IPv4 (групп IPv6): подстрока IP ищется с границы октета"""
+    return [0] + [i + 1 for i, c in enumerate(ip) if c in ".:"]
+
+
+class _SuffixIndex:
+    """
+    Регистронезависимый индекс строковых ключей.
+    Префикс ищется бинарным поиском по отсортированным ключам, подстрока - по отсортированным
+    суффиксам ключей, поэтому время поиска пропорционально числу совпадений.
+    """
+
+    # Больше изменённых ключей за одно обновление - списки пересортировываются целиком
+    REBUILD_THRESHOLD = 256
+
+    def __init__(self, starts: Callable[[str], Iterable[int]]):
+        """
+        Args:
+            starts: Позиции ключа, с которых начинаются индексируемые суффиксы
+        """
+        self.starts = starts
+        # Число записей реестра с каждым ключом
+        self.counts: Dict[str, int] = {}
+        self.keys: List[str] = []
+        # Элементы "суффикс\0ключ": совпадения подстроки образуют непрерывный диапазон
+        self.suffixes: List[str] = []
+        # Ключи, появившиеся и исчезнувшие после последнего commit()
+        self._added: Set[str] = set()
+        self._removed: Set[str] = set()
+
+    def _entries(self, key: str) -> List[str]:
+        return [f"{key[i:]}\0{key}" for i in self.starts(key)]
+
+    def add(self, key: str) -> None:
+        if not key:
+            return
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if not count:
+            if key in self._removed:
+                self._removed.discard(key)
+            else:
+                self._added.add(key)
+
+    def discard(self, key: str) -> None:
+        count = self.counts.get(key)
+        if not count:
+            return
+        if count > 1:
+            self.counts[key] = count - 1
+        else:
+            del self.counts[key]
+            if key in self._added:
+                self._added.discard(key)
+            else:
+                self._removed.add(key)
+
+    def commit(self) -> None:
+        """Перенос появившихся и исчезнувших ключей в отсортированные списки"""
+        if len(self._added) + len(self._removed) > self.REBUILD_THRESHOLD:
+            self.keys = sorted(self.counts)
+            self.suffixes = sorted(entry for key in self.keys for entry in self._entries(key))
+        else:
+            for key in self._removed:
+                del self.keys[bisect_left(self.keys, key)]
+                for entry in self._entries(key):
+                    del self.suffixes[bisect_left(self.suffixes, entry)]
+            for key in self._added:
+                insort(self.keys, key)
+                for entry in self._entries(key):
+                    insort(self.suffixes, entry)
+        self._added.clear()
+        self._removed.clear()
+
+    def find(self, text: str, substring: bool) -> Iterable[str]:
+        """Ключи, которые начинаются с text (или содержат text)"""
+        if not substring:
+            return self.keys[bisect_left(self.keys, text):bisect_left(self.keys, text + "\uffff")]
+        lo = bisect_left(self.suffixes, text)
+        hi = bisect_left(self.suffixes, text + "\uffff")
+        return {entry.partition("\0")[2] for entry in self.suffixes[lo:hi]}
+
+
+def _discard(index: Dict[str, Set[str]], key: str, ip: str) -> None:
+    ips = index.get(key)
+    if ips is not None:
+        ips.discard(ip)
+        if not ips:
+            del index[key]
+
+
+class SearchIndex:
+    """
+    Поисковый индекс реестра по пользователям и IP.
+    Обновляется по изменившимся IP, а не перестраивается при каждом изменении реестра.
+    """
+
+    def __init__(self):
+        self.usernames = _SuffixIndex(_all_starts)
+        self.ips = _SuffixIndex(_octet_starts)
+        # Записи каждого IP, IP с каждым ключом ip_key и IP каждого пользователя (в нижнем регистре)
+        self.by_ip: Dict[str, List[Dict[str, Any]]] = {}
+        self.by_key: Dict[str, Set[str]] = {}
+        self.by_username: Dict[str, Set[str]] = {}
+
+    def update(self, ip: str, entries: List[Dict[str, Any]]) -> None:
+        """Замена записей одного IP (пустой список - удаление); вступает в силу после commit()"""
+        key = ip_key(ip)
+        for server in self.by_ip.pop(ip, []):
+            username = (server.get("username") or "").lower()
+            self.usernames.discard(username)
+            self.ips.discard(key)
+            _discard(self.by_username, username, ip)
+        _discard(self.by_key, key, ip)
+        if not entries:
+            return
+        self.by_ip[ip] = list(entries)
+        self.by_key.setdefault(key, set()).add(ip)
+        for server in entries:
+            username = (server.get("username") or "").lower()
+            self.usernames.add(username)
+            self.ips.add(key)
+            self.by_username.setdefault(username, set()).add(ip)
+
+    def commit(self) -> None:
+        self.usernames.commit()
+        self.ips.commit()
+
+    def sync(self, servers: List[Dict[str, Any]]) -> int:
+        """
+        Приведение индекса к снимку реестра: обновляются только IP, записи которых отличаются.
+        Returns:
+            Число обновлённых IP
+        """
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for server in servers:
+            grouped.setdefault(server["ip"], []).append(server)
+        changed = [ip for ip in self.by_ip if ip not in grouped]
+        changed += [ip for ip, entries in grouped.items() if self.by_ip.get(ip) != entries]
+        for ip in changed:
+            self.update(ip, grouped.get(ip, []))
+        self.commit()
+        return len(changed)
+
+    def search(self, text: str, field: str = "any", mode: str = "prefix") -> List[Dict[str, Any]]:
+        """
+        Регистронезависимый поиск записей.
+        Args:
+            text: Искомая строка
+            field: any | username | ip
+            mode: prefix | substring (для IP - подстрока с начала октета)
+        Raises:
+            ValueError: Пустой запрос или неизвестные поле/режим
+        """
+        if not text:
+            raise ValueError("Empty search query")
+        if field not in SEARCH_FIELDS:
+            raise ValueError(f"Unknown search field: {field}")
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        text = text.lower()
+        substring = mode == "substring"
+        found: Dict[int, Dict[str, Any]] = {}
+        if field in ("any", "ip"):
+            for key in self.ips.find(text, substring):
+                for ip in self.by_key[key]:
+                    for server in self.by_ip[ip]:
+                        found[id(server)] = server
+        if field in ("any", "username"):
+            for username in self.usernames.find(text, substring):
+                for ip in self.by_username[username]:
+                    for server in self.by_ip[ip]:
+                        if (server.get("username") or "").lower() == username:
+                            found[id(server)] = server
+        return list(found.values())
@@ -0,0 +1,80 @@
+import marshal
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+# Заголовок: сигнатура, версии marshal и Python (формат marshal от них зависит),
+# ключ файла JSON, из которого сделан снимок (inode, mtime_ns, размер), и число записей.
+# Номер в сигнатуре меняется вместе с упаковкой записей: снимок прежнего формата создаётся заново
+MAGIC = b"VRSNAP2\0"
+_HEADER = struct.Struct("<8sHHQqQI")
+_LENGTH = struct.Struct("<I")
+_PYTHON = sys.version_info[0] << 8 | sys.version_info[1]
+
+FileKey = Tuple[int, int, int]
+
+
+def write_snapshot(path: str, source_key: FileKey, rows: Iterable[tuple], count: int) -> None:
+    """
+    Запись бинарного снимка реестра: записи с префиксом длины, каждая - кортеж marshal.
+    Файл заменяется атомарно, поэтому читатель видит либо старый, либо новый снимок целиком.
+    Args:
+        source_key: Ключ файла JSON, содержимому которого соответствует снимок
+        rows: Состояния записей
+        count: Число записей
+    """
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, marshal.version, _PYTHON, *source_key, count))
+        for row in rows:
+            data = marshal.dumps(row)
+            f.write(_LENGTH.pack(len(data)))
+            f.write(data)
+    os.replace(tmp_file, path)
+
+
+def read_snapshot(path: str, source_key: FileKey, build: Callable[[tuple], Any]) -> Optional[List[Any]]:
+    """
+    Потоковое чтение снимка через mmap: каждая запись сразу преобразуется build,
+    так что в памяти не бывает одновременно всего разобранного файла и готового реестра.
+    Returns:
+        Записи реестра или None, если снимка нет или он сделан для другого файла JSON
+        (другой версии marshal/Python)
+    Raises:
+        ValueError: Снимок повреждён
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size:
+            raise ValueError(f"Truncated snapshot header in {path}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, marshal_version, python, ino, mtime_ns, source_size, count = _HEADER.unpack_from(data)
+            if magic[:6] == MAGIC[:6] and magic != MAGIC:
+                return None
+            if magic != MAGIC:
+                raise ValueError(f"Not a registry snapshot: {path}")
+            if (marshal_version, python, (ino, mtime_ns, source_size)) != (marshal.version, _PYTHON, tuple(source_key)):
+                return None
+
+            records = []
+            position, unpack, loads = _HEADER.size, _LENGTH.unpack_from, marshal.loads
+            view = memoryview(data)
+            try:
+                for _ in range(count):
+                    (length,) = unpack(data, position)
+                    position += _LENGTH.size
+                    if position + length > size:
+                        raise ValueError(f"Truncated record in {path}")
+                    records.append(build(loads(view[position:position + length])))
+                    position += length
+            except (struct.error, EOFError, TypeError) as e:
+                raise ValueError(f"Corrupted snapshot {path}: {e}")
+            finally:
+                view.release()
+            return records
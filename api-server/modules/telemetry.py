@@ -0,0 +1,277 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from .logger import ServerLogger
+
+# Поля замера агента: загрузка CPU и памяти хоста (%), CPU (%) и RSS (байт) x11vnc и websockify,
+# число подключённых клиентов и исходящий трафик (байт/с); ts - время получения замера
+SAMPLE_FIELDS = ("ts", "cpu", "mem", "vnc_cpu", "vnc_rss", "ws_cpu", "ws_rss", "clients", "tx_bps")
+_SAMPLE = struct.Struct("<dfffQfQId")
+_INTEGER_FIELDS = ("vnc_rss", "ws_rss", "clients")
+# Поля, которые агент может не измерить (None): хранятся как NaN
+_OPTIONAL_FIELDS = ("tx_bps",)
+
+# Заголовок файла: сигнатура, размер кольца, выделено слотов, занято слотов (занятые идут подряд с начала)
+# и счётчик передачи слотов другим хостам (при его изменении процессы заново читают IP слотов)
+_MAGIC = b"VRTELE2\0"
+_FILE_HEADER = struct.Struct("<8sIIII")
+# Заголовок слота: счётчик изменений (нечётный - идёт запись), число записанных замеров, IP хоста
+_SLOT_HEADER = struct.Struct("<II48s")
+
+# Слоты выделяются по мере появления хостов: сначала столько, затем вдвое больше до максимума хостов
+INITIAL_SLOTS = 1024
+
+# Слот хоста, не получавшего замеров дольше этого времени (сек), может занять другой хост
+EXPIRE_AFTER = 24 * 3600
+
+# Хост с загрузкой CPU не меньше этой (%) считается перегруженным в сводке /api/metrics
+CPU_STARVED = 90.0
+
+
+class TelemetryStore:
+    """
+    Последние замеры нагрузки хостов: кольцо фиксированного размера на каждый хост.
+    Кольца лежат в общем для процессов-воркеров файле, отображённом в память. Слот получает
+    следующий по порядку хост, поэтому занятые слоты идут подряд и сводка читает только их,
+    а файл растёт вместе с числом хостов. Запись сериализуется flock, а читатели не блокируются
+    и повторяют чтение слота, если во время чтения в него писали.
+    """
+
+    def __init__(self, path: str, logger: ServerLogger, capacity: int = 65536, ring: int = 20):
+        """
+        Args:
+            path: Путь к файлу колец
+            logger: Экземпляр ServerLogger
+            capacity: Максимум хостов
+            ring: Число хранимых замеров одного хоста
+        """
+        self.path = path
+        self.lock_file = f"{path}.lock"
+        self.logger = logger
+        self.capacity = capacity
+        self.ring = ring
+        self.slot_size = _SLOT_HEADER.size + ring * _SAMPLE.size
+        self._lock = threading.Lock()
+        self._map_lock = threading.Lock()
+        # Слоты IP, прочитанные из файла: первые _known слотов при счётчике передачи слотов _reassigned
+        # (слот может занять другой хост - IP в слоте проверяется при каждом обращении)
+        self._slots: Dict[str, int] = {}
+        self._known = 0
+        self._reassigned = 0
+        self._full_warned = False
+        self.data: Optional[mmap.mmap] = None
+        self._mapped = 0
+
+        with self._write():
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                header = os.pread(fd, _FILE_HEADER.size, 0)
+                valid = len(header) == _FILE_HEADER.size
+                if valid:
+                    magic, ring_size, allocated, used, _ = _FILE_HEADER.unpack(header)
+                    valid = (magic == _MAGIC and ring_size == ring and used <= allocated <= capacity
+                             and os.fstat(fd).st_size == self._offset(allocated))
+                if not valid:
+                    # Другие размеры колец или максимум хостов - прежние замеры не переносятся
+                    allocated = min(INITIAL_SLOTS, capacity)
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self._offset(allocated))
+                    os.pwrite(fd, _FILE_HEADER.pack(_MAGIC, ring, allocated, 0, 0), 0)
+            finally:
+                os.close(fd)
+            self._refresh()
+
+    @contextmanager
+    def _write(self):
+        """Блокировка записи: между потоками процесса и между процессами (flock)"""
+        with self._lock:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)  # Закрытие дескриптора снимает flock
+
+    def _offset(self, slot: int) -> int:
+        return _FILE_HEADER.size + slot * self.slot_size
+
+    def _slot_ip(self, slot: int) -> bytes:
+        return _SLOT_HEADER.unpack_from(self.data, self._offset(slot))[2].rstrip(b"\0")
+
+    def _refresh(self) -> int:
+        """
+        Чтение изменений файла другими процессами: отображение выросшего файла и IP новых слотов.
+        Returns:
+            Число занятых слотов
+        """
+        with self._map_lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> int:
+        if self.data is None:
+            with open(self.path, "rb") as f:
+                _, _, allocated, used, reassigned = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+        else:
+            _, _, allocated, used, reassigned = _FILE_HEADER.unpack_from(self.data, 0)
+        if allocated > self._mapped:
+            fd = os.open(self.path, os.O_RDWR)
+            try:
+                data = mmap.mmap(fd, self._offset(allocated))
+            finally:
+                os.close(fd)
+            # Прежнее отображение закрывается сборщиком мусора: его ещё может читать другой поток
+            self.data, self._mapped = data, allocated
+        if reassigned != self._reassigned:
+            self._slots, self._known, self._reassigned = {}, 0, reassigned
+        for slot in range(self._known, used):
+            self._slots[self._slot_ip(slot).decode()] = slot
+        self._known = max(self._known, used)
+        return used
+
+    def _find(self, ip: str, create: bool) -> Optional[int]:
+        """Слот IP; create - занять новый или устаревший слот (вызывается под блокировкой записи)"""
+        key = ip.encode()
+        slot = self._slots.get(ip)
+        if slot is not None and self._slot_ip(slot) == key:
+            return slot
+        used = self._refresh()
+        slot = self._slots.get(ip)
+        if slot is not None and self._slot_ip(slot) == key:
+            return slot
+        if not create:
+            return None
+
+        _, _, allocated, _, reassigned = _FILE_HEADER.unpack_from(self.data, 0)
+        if used < self.capacity:
+            slot = used
+            if slot == allocated:
+                allocated = min(allocated * 2, self.capacity)
+                os.truncate(self.path, self._offset(allocated))
+                _FILE_HEADER.pack_into(self.data, 0, _MAGIC, self.ring, allocated, used, reassigned)
+                self._refresh()
+        else:
+            slot = next((slot for slot in range(used) if self._expired(slot)), None)
+            if slot is None:
+                if not self._full_warned:
+                    self.logger.warning(
+                        f"Telemetry store is full ({self.capacity} hosts), samples of new hosts dropped")
+                    self._full_warned = True
+                return None
+            self._slots.pop(self._slot_ip(slot).decode(), None)
+            reassigned += 1
+        seq = _SLOT_HEADER.unpack_from(self.data, self._offset(slot))[0]
+        _SLOT_HEADER.pack_into(self.data, self._offset(slot), (seq + 2) & 0xFFFFFFFF, 0, key)
+        # Слот заполнен до того, как его увидят другие процессы
+        _FILE_HEADER.pack_into(self.data, 0, _MAGIC, self.ring, allocated, max(used, slot + 1), reassigned)
+        self._slots[ip] = slot
+        self._known = max(used, slot + 1)
+        self._reassigned = reassigned
+        return slot
+
+    def _expired(self, slot: int) -> bool:
+        samples = self._read(slot, last=True)
+        return not samples or samples[0]["ts"] < time.time() - EXPIRE_AFTER
+
+    def record(self, ip: str, telemetry: Dict[str, Any]) -> bool:
+        """
+        Сохранение замера хоста в его кольцо.
+        Raises:
+            ValueError: Значения полей не числа
+        """
+        if len(ip.encode()) > _SLOT_HEADER.size - 8:
+            raise ValueError(f"Invalid IP: {ip}")
+        values = [time.time()]
+        for field in SAMPLE_FIELDS[1:]:
+            value = telemetry.get(field)
+            if value is None and field in _OPTIONAL_FIELDS:
+                values.append(math.nan)
+                continue
+            value = value or 0
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Invalid telemetry field: {field}")
+            values.append(max(int(value), 0) if field in _INTEGER_FIELDS else float(value))
+        sample = _SAMPLE.pack(*values)
+
+        with self._write():
+            slot = self._find(ip, create=True)
+            if slot is None:
+                return False
+            offset = self._offset(slot)
+            seq, written, key = _SLOT_HEADER.unpack_from(self.data, offset)
+            # Нечётный счётчик на время записи: читатель увидит незавершённое изменение и повторит чтение
+            _SLOT_HEADER.pack_into(self.data, offset, (seq + 1) & 0xFFFFFFFF, written, key)
+            position = offset + _SLOT_HEADER.size + (written % self.ring) * _SAMPLE.size
+            self.data[position:position + _SAMPLE.size] = sample
+            _SLOT_HEADER.pack_into(self.data, offset, (seq + 2) & 0xFFFFFFFF, written + 1, key)
+        return True
+
+    def _read(self, slot: int, ip: Optional[bytes] = None, last: bool = False) -> List[Dict[str, Any]]:
+        """Замеры слота от старого к новому (пустой список, если слот принадлежит другому IP), last - только последний"""
+        offset = self._offset(slot)
+        for _ in range(10):
+            seq, written, key = _SLOT_HEADER.unpack_from(self.data, offset)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            if ip is not None and key.rstrip(b"\0") != ip:
+                return []
+            count = min(written, 1 if last else self.ring)
+            base = offset + _SLOT_HEADER.size
+            rows = [_SAMPLE.unpack_from(self.data, base + ((written - count + i) % self.ring) * _SAMPLE.size)
+                    for i in range(count)]
+            if _SLOT_HEADER.unpack_from(self.data, offset)[0] == seq:
+                samples = [dict(zip(SAMPLE_FIELDS, row)) for row in rows]
+                for sample in samples:
+                    for field in _OPTIONAL_FIELDS:
+                        if math.isnan(sample[field]):
+                            sample[field] = None
+                return samples
+        return []
+
+    def history(self, ip: str) -> List[Dict[str, Any]]:
+        """Кольцо замеров хоста от старого к новому"""
+        slot = self._find(ip, create=False)
+        return self._read(slot, ip.encode()) if slot is not None else []
+
+    def latest(self, ip: str) -> Optional[Dict[str, Any]]:
+        """Последний замер хоста или None"""
+        slot = self._find(ip, create=False)
+        samples = self._read(slot, ip.encode(), last=True) if slot is not None else []
+        return samples[0] if samples else None
+
+    def summary(self, max_age: float = 300, top: int = 10) -> Dict[str, Any]:
+        """
+        Сводка по последним замерам хостов не старше max_age секунд (раздел /api/metrics).
+        Для поиска перегруженных хостов и процессов x11vnc, расходующих больше всего CPU.
+        """
+        now = time.time()
+        latest = []
+        for slot in range(self._refresh()):
+            samples = self._read(slot, last=True)
+            if samples and samples[0]["ts"] >= now - max_age:
+                latest.append((self._slot_ip(slot).decode(), samples[0]))
+        if not latest:
+            return {"hosts": 0}
+        cpu = [s["cpu"] for _, s in latest]
+        tx = [s["tx_bps"] for _, s in latest if s["tx_bps"] is not None]
+        by_vnc_cpu = sorted(latest, key=lambda item: item[1]["vnc_cpu"], reverse=True)[:top]
+        return {
+            "hosts": len(latest),
+            "cpu_avg": round(sum(cpu) / len(cpu), 1),
+            "cpu_max": round(max(cpu), 1),
+            "mem_avg": round(sum(s["mem"] for _, s in latest) / len(latest), 1),
+            "cpu_starved": sorted(ip for ip, s in latest if s["cpu"] >= CPU_STARVED),
+            "clients": sum(s["clients"] for _, s in latest),
+            # Трафик хостов, где он измерен (агент с websockify вместо встроенного моста его не сообщает)
+            "tx_bps": round(sum(tx)),
+            "tx_hosts": len(tx),
+            "top_vnc_cpu": [{"ip": ip, "vnc_cpu": round(s["vnc_cpu"], 1), "clients": s["clients"]}
+                            for ip, s in by_vnc_cpu],
+        }
+
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from .logger import ServerLogger
+from .rfb import Framebuffer, RFBClient, RFBError
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него миниатюры кодируются в PNG
+    Image = None
+
+
+def downscale(fb: Framebuffer, max_width: int) -> Tuple[int, int, bytes]:
+    """
+    Уменьшение кадра выборкой каждого n-го пикселя (n - целый шаг по ширине).
+    Returns:
+        (ширина, высота, пиксели RGB)
+    """
+    step = max(1, -(-fb.width // max_width))
+    pixels = memoryview(fb.data).cast("I")
+    rgbx = b"".join(
+        pixels[y * fb.width:(y + 1) * fb.width:step].tobytes()
+        for y in range(0, fb.height, step)
+    )
+    width = len(range(0, fb.width, step))
+    height = len(range(0, fb.height, step))
+
+    # Пиксель кадра - байты R, G, B и неиспользуемый четвёртый
+    rgb = bytearray(len(rgbx) // 4 * 3)
+    rgb[0::3] = rgbx[0::4]
+    rgb[1::3] = rgbx[1::4]
+    rgb[2::3] = rgbx[2::4]
+    return width, height, bytes(rgb)
+
+
+def encode_png(width: int, height: int, rgb: bytes, level: int = 6) -> bytes:
+    """Кодирование RGB в PNG средствами стандартной библиотеки"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack("!I", len(data)) + tag + data + struct.pack("!I", zlib.crc32(tag + data))
+
+    stride = width * 3
+    raw = b"".join(b"\x00" + rgb[y * stride:(y + 1) * stride] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, level))
+            + chunk(b"IEND", b""))
+
+
+class Thumbnail:
+    """Закодированная миниатюра экрана хоста"""
+
+    __slots__ = ("body", "content_type", "etag", "frame_hash", "captured_at", "width", "height")
+
+    def __init__(self, body: bytes, content_type: str, frame_hash: str, width: int, height: int):
+        self.body = body
+        self.content_type = content_type
+        self.etag = f'"{frame_hash}"'
+        self.frame_hash = frame_hash
+        self.captured_at = time.time()
+        self.width = width
+        self.height = height
+
+
+class ThumbnailStore:
+    """
+    Каталог миниатюр, общий для процессов-воркеров API-сервера:
+    сервис одного воркера публикует файлы, остальные читают их с кешированием по stat.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.cache: Dict[str, Tuple[Tuple[int, int], Thumbnail]] = {}
+
+    def _path(self, ip: str, session: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", f"{ip}_{session}") + ".thumb")
+
+    def publish(self, key: Tuple[str, str], thumbnail: Thumbnail) -> None:
+        """Атомарная запись: строка метаданных JSON и тело изображения"""
+        path = self._path(*key)
+        meta = {"ip": key[0], "session": key[1], "content_type": thumbnail.content_type,
+                "frame_hash": thumbnail.frame_hash, "width": thumbnail.width, "height": thumbnail.height,
+                "captured_at": thumbnail.captured_at}
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(json.dumps(meta).encode() + b"\n" + thumbnail.body)
+        os.replace(f"{path}.tmp", path)
+
+    def remove(self, key: Tuple[str, str]) -> None:
+        try:
+            os.remove(self._path(*key))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, path: str) -> Optional[Thumbnail]:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        stamp = (st.st_ino, st.st_mtime_ns)
+        cached = self.cache.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        thumbnail = Thumbnail(body, meta["content_type"], meta["frame_hash"], meta["width"], meta["height"])
+        thumbnail.captured_at = meta["captured_at"]
+        self.cache[path] = (stamp, thumbnail)
+        return thumbnail
+
+    def get(self, ip: str, session: str = "") -> Optional[Thumbnail]:
+        thumbnail = self._read(self._path(ip, session))
+        if thumbnail is None and not session:
+            prefix = os.path.basename(self._path(ip, ""))[:-len(".thumb")]
+            for name in sorted(os.listdir(self.directory)):
+                if name.startswith(prefix) and name.endswith(".thumb"):
+                    return self._read(os.path.join(self.directory, name))
+        return thumbnail
+
+
+class ThumbnailService:
+    """
+    Периодический снимок экранов зарегистрированных хостов через RFB (view-only пароль).
+    Кадр кодируется заново, только если изменился его хеш.
+    """
+
+    def __init__(self, logger: ServerLogger, manager, password: str, interval: float,
+                 max_width: int = 320, image_format: str = "png", quality: int = 70, concurrency: int = 8,
+                 store: Optional[ThumbnailStore] = None):
+        """
+        Args:
+            logger: Экземпляр ServerLogger
+            manager: Экземпляр ServerManager со списком хостов
+            password: View-only пароль VNC хостов
+            interval: Период обновления миниатюр (сек)
+            max_width: Максимальная ширина миниатюры
+            image_format: 'png' или 'jpeg' (JPEG требует Pillow)
+            quality: Качество JPEG
+            concurrency: Число одновременных снимков
+            store: Каталог для публикации миниатюр другим воркерам (None - только в памяти)
+        """
+        self.logger = logger
+        self.manager = manager
+        self.password = password
+        self.interval = interval
+        self.max_width = max_width
+        self.quality = quality
+        self.concurrency = concurrency
+        self.store = store
+        self.image_format = image_format.lower()
+        if self.image_format == "jpeg" and Image is None:
+            logger.warning("Pillow is not installed, thumbnails will be encoded as PNG")
+            self.image_format = "png"
+
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        # Объекты Thumbnail не изменяются, а заменяются целиком, поэтому читаются без блокировки
+        self.thumbnails: Dict[Tuple[str, str], Thumbnail] = {}
+        self.stats = {"captured": 0, "unchanged": 0, "encoded": 0, "failed": 0}
+
+    def start(self) -> None:
+        """Запуск расписания снимков в отдельном потоке"""
+        self.thread = threading.Thread(target=self.loop.run_forever, name="thumbnails", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._schedule(), self.loop)
+        self.logger.info(f"Thumbnail service started: every {self.interval}s, "
+                         f"{self.max_width}px {self.image_format.upper()}")
+
+    def get(self, ip: str, session: str = "") -> Optional[Thumbnail]:
+        thumbnail = self.thumbnails.get((ip, session))
+        if thumbnail is None and not session:
+            # Хост с несколькими сессиями без указания сессии - первая попавшаяся
+            thumbnail = next((t for (i, _), t in list(self.thumbnails.items()) if i == ip), None)
+        return thumbnail
+
+    async def _schedule(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(key: Tuple[str, str], vnc_port: int) -> None:
+            async with semaphore:
+                await self.capture(key, vnc_port)
+
+        while True:
+            started = self.loop.time()
+            try:
+                servers = await self.loop.run_in_executor(None, self.manager.get_servers, True)
+                targets = {
+                    (s["ip"], s.get("session", "")): int(s["vnc_port"])
+                    for s in servers if s.get("ip") and s.get("vnc_port")
+                }
+                for key in set(self.thumbnails) - set(targets):
+                    self.thumbnails.pop(key, None)
+                    if self.store:
+                        self.store.remove(key)
+                await asyncio.gather(*(limited(key, port) for key, port in targets.items()))
+            except Exception as e:
+                self.logger.error(f"Thumbnail schedule error: {e}")
+            await asyncio.sleep(max(0.0, self.interval - (self.loop.time() - started)))
+
+    async def capture(self, key: Tuple[str, str], vnc_port: int) -> Optional[Thumbnail]:
+        """Снимок одного хоста; при неизменном кадре остаётся прежняя миниатюра"""
+        client = RFBClient(key[0], vnc_port, self.password)
+        try:
+            await client.connect(shared=True)
+            await client.request_update(incremental=False)
+            await client.read_update()
+        except (OSError, RFBError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            self.stats["failed"] += 1
+            self.logger.debug(f"Thumbnail capture failed for {key[0]}:{vnc_port}: {e}")
+            return None
+        finally:
+            await client.close()
+
+        self.stats["captured"] += 1
+        fb = client.framebuffer
+        # SHA-1 на кадре 1080p заметно быстрее blake2b/md5 и достаточна для обнаружения изменений
+        frame_hash = hashlib.sha1(fb.data).hexdigest()
+        previous = self.thumbnails.get(key)
+        if previous and previous.frame_hash == frame_hash:
+            self.stats["unchanged"] += 1
+            return previous
+
+        thumbnail = await self.loop.run_in_executor(None, self.encode, fb, frame_hash)
+        self.thumbnails[key] = thumbnail
+        if self.store:
+            await self.loop.run_in_executor(None, self.store.publish, key, thumbnail)
+        self.stats["encoded"] += 1
+        return thumbnail
+
+    def encode(self, fb: Framebuffer, frame_hash: str) -> Thumbnail:
+        if Image is not None:
+            image = Image.frombuffer("RGBX", (fb.width, fb.height), bytes(fb.data), "raw", "RGBX", 0, 1)
+            image = image.convert("RGB")
+            image.thumbnail((self.max_width, fb.height), Image.BOX)
+            out = BytesIO()
+            if self.image_format == "jpeg":
+                image.save(out, "JPEG", quality=self.quality)
+            else:
+                image.save(out, "PNG")
+            return Thumbnail(out.getvalue(), f"image/{self.image_format}", frame_hash, *image.size)
+
+        width, height, rgb = downscale(fb, self.max_width)
+        return Thumbnail(encode_png(width, height, rgb), "image/png", frame_hash, width, height)
+
+    def get_stats(self) -> Dict[str, object]:
+        """Состояние сервиса для /api/metrics"""
+        return {**self.stats, "hosts": len(self.thumbnails), "format": self.image_format}
@@ -0,0 +1,53 @@
+# Кадры и рукопожатие WebSocket (RFC 6455) на стороне сервера: общие для шлюза API-сервера и моста агента.
+# Агент подключает этот файл символьной ссылкой agent/src/modules/websocket.py, поэтому модуль должен
+# работать на Python 3.7 и не зависеть от других модулей пакета.
+import base64
+import hashlib
+import struct
+from typing import Dict
+
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+def ws_frame_header(opcode: int, length: int) -> bytes:
+    """Заголовок неразбитого кадра WebSocket от сервера (без маски)"""
+    if length < 126:
+        return struct.pack("!BB", 0x80 | opcode, length)
+    if length < 65536:
+        return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+
+def ws_unmask(payload, mask: bytes) -> bytes:
+    """Снятие маски с данных кадра от клиента без побайтового цикла"""
+    n = len(payload)
+    if n == 0:
+        return b""
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")).to_bytes(n, "little")
+
+
+def ws_accept_response(key: str, headers: Dict[str, str]) -> bytes:
+    """
+    Ответ 101 на запрос открытия WebSocket.
+    Args:
+        key: Значение Sec-WebSocket-Key
+        headers: Заголовки запроса (имена в нижнем регистре); подпротокол binary подтверждается, если запрошен
+    """
+    accept = base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+    protocols = [p.strip() for p in headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
+    response = (
+        "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        f"Sec-WebSocket-Accept: {accept}\r\n"
+    )
+    if "binary" in protocols:
+        response += "Sec-WebSocket-Protocol: binary\r\n"
+    return (response + "\r\n").encode()
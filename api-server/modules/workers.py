@@ -0,0 +1,77 @@
+import os
+import signal
+import time
+from typing import Callable, Dict
+from .logger import ServerLogger
+
+
+class PreforkSupervisor:
+    """
+    Режим нескольких процессов: N воркеров принимают соединения на одном порту
+    (SO_REUSEPORT, распределение выполняет ядро), главный процесс перезапускает упавшие.
+    """
+
+    # Пауза перед перезапуском аварийно завершившегося воркера (сек)
+    RESTART_DELAY = 1
+
+    def __init__(self, logger: ServerLogger, workers: int, run_worker: Callable[[int], None]):
+        """
+        Args:
+            logger: Экземпляр ServerLogger главного процесса
+            workers: Число процессов-воркеров
+            run_worker: Функция воркера, получает его номер (0..workers-1)
+        """
+        self.logger = logger
+        self.workers = workers
+        self.run_worker = run_worker
+        self.children: Dict[int, int] = {}  # pid -> номер воркера
+        self.stopping = False
+
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                self.run_worker(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                self.logger.critical(f"Worker {index} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        self.logger.info(f"Worker {index} started (pid {pid})")
+
+    def _stop(self, signum, frame) -> None:
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        """Запуск воркеров и ожидание их завершения"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            self.logger.warning(f"Worker {index} (pid {pid}) exited with code "
+                                f"{os.waitstatus_to_exitcode(status)}, restarting")
+            time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self._spawn(index)
+
+        self.logger.info("All workers stopped")
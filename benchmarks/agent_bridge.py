@@ -0,0 +1,213 @@
+"""
+Сравнение встроенного WebSocket-моста агента с websockify.
+Каждый прокси запускается отдельным процессом перед тестовым VNC-сервером; клиент WebSocket в этом процессе
+измеряет поток данных сервер -> браузер, время отклика на сообщение браузера и процессорное время прокси
+(вместе с дочерними процессами: websockify обслуживает соединение в отдельном процессе).
+
+Запуск: python benchmarks/agent_bridge.py [--duration 5] [--round-trips 2000] [--websockify websockify]
+Без websockify (не найден в PATH) замеряется только мост. Процессорное время читается из /proc (Linux).
+"""
+import argparse
+import base64
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+AGENT_SRC = Path(__file__).resolve().parent.parent / "agent" / "src"
+# Размер куска потока данных тестового сервера и ответа на сообщение браузера
+STREAM_CHUNK = 64 * 1024
+REPLY_SIZE = 4096
+BRIDGE_RUNNER = """
+import logging, sys
+sys.path.insert(0, sys.argv[1])
+from modules.bridge import WebSocketBridge
+bridge = WebSocketBridge(logging.getLogger(), sys.argv[2])
+assert bridge.add_listener(int(sys.argv[3]), int(sys.argv[4]))
+sys.stdin.read()
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeVNC:
+    """Источник данных вместо VNC-сервера: первый байт клиента выбирает режим (T - поток, E - ответы)"""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _serve(conn: socket.socket) -> None:
+        try:
+            conn.sendall(b"RFB 003.008\n")
+            mode = conn.recv(1)
+            if mode == b"T":
+                chunk = os.urandom(STREAM_CHUNK)
+                while True:
+                    conn.sendall(chunk)
+            reply = os.urandom(REPLY_SIZE)
+            while conn.recv(64):
+                conn.sendall(reply)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+class Client:
+    """Блокирующий клиент WebSocket с бинарными кадрами"""
+
+    def __init__(self, port: int):
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                self.sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall(f"GET /websockify HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                          f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n"
+                          f"Sec-WebSocket-Protocol: binary\r\n\r\n".encode())
+        self.file = self.sock.makefile("rb")
+        status = self.file.readline()
+        if b" 101 " not in status:
+            raise RuntimeError(f"WebSocket handshake failed: {status!r}")
+        while self.file.readline() not in (b"\r\n", b""):
+            pass
+
+    def close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+    def frame(self) -> bytes:
+        head = self.file.read(2)
+        size = head[1] & 0x7F
+        if size == 126:
+            size = struct.unpack("!H", self.file.read(2))[0]
+        elif size == 127:
+            size = struct.unpack("!Q", self.file.read(8))[0]
+        return self.file.read(size)
+
+    def read(self, size: int) -> None:
+        while size > 0:
+            size -= len(self.frame())
+
+    def send(self, payload: bytes) -> None:
+        # Маска из нулей не меняет данные: клиент не тратит время на маскирование
+        self.sock.sendall(struct.pack("!BB", 0x82, 0x80 | len(payload)) + b"\0\0\0\0" + payload)
+
+
+def cpu_seconds(pid: int) -> float:
+    """Процессорное время процесса и всех его потомков (utime + stime) по /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            children.setdefault(int(fields[1]), []).append((int(entry), int(fields[11]) + int(fields[12])))
+    ticks, stack = 0, [pid]
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+        ticks += int(fields[11]) + int(fields[12])
+    while stack:
+        for child, child_ticks in children.get(stack.pop(), []):
+            ticks += child_ticks
+            stack.append(child)
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def measure(name: str, start: Callable[[int, int], subprocess.Popen], vnc: FakeVNC,
+            duration: float, round_trips: int) -> None:
+    port = free_port()
+    proxy = start(port, vnc.port)
+    try:
+        client = Client(port)
+        client.read(12)
+        client.send(b"T")
+        cpu, started, total = cpu_seconds(proxy.pid), time.perf_counter(), 0
+        while time.perf_counter() - started < duration:
+            total += len(client.frame())
+        elapsed = time.perf_counter() - started
+        stream_cpu = cpu_seconds(proxy.pid) - cpu
+        client.close()
+
+        client = Client(port)
+        client.read(12)
+        client.send(b"E")
+        latencies: List[float] = []
+        cpu = cpu_seconds(proxy.pid)
+        for _ in range(round_trips):
+            sent = time.perf_counter()
+            client.send(b"k")
+            client.read(REPLY_SIZE)
+            latencies.append(time.perf_counter() - sent)
+        echo_cpu = cpu_seconds(proxy.pid) - cpu
+        client.close()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+    latencies.sort()
+    print(f"{name:>10}: {total / elapsed / 1e6:7.1f} MB/s  {stream_cpu / (total / 1e9):6.2f} CPU s/GB  "
+          f"round trip p50={latencies[len(latencies) // 2] * 1e6:6.0f} us "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1e6:6.0f} us  "
+          f"{echo_cpu / round_trips * 1e6:5.0f} CPU us/message")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--round-trips", type=int, default=2000)
+    parser.add_argument("--websockify", default="websockify", help="Команда websockify")
+    args = parser.parse_args()
+    vnc = FakeVNC()
+    web_dir = tempfile.mkdtemp(prefix="novnc-")
+    proxies: List[Tuple[str, Callable[[int, int], subprocess.Popen]]] = [
+        ("bridge", lambda port, target: subprocess.Popen(
+            [sys.executable, "-c", BRIDGE_RUNNER, str(AGENT_SRC), web_dir, str(port), str(target)],
+            stdin=subprocess.PIPE, stderr=subprocess.DEVNULL))
+    ]
+    websockify: Optional[str] = shutil.which(args.websockify)
+    if websockify:
+        proxies.append(("websockify", lambda port, target: subprocess.Popen(
+            [websockify, str(port), f"127.0.0.1:{target}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)))
+    else:
+        print(f"{args.websockify} not found, measuring the bridge only")
+    print(f"CPU: {os.cpu_count()}, stream chunk: {STREAM_CHUNK} B, reply: {REPLY_SIZE} B")
+    try:
+        for name, start in proxies:
+            measure(name, start, vnc, args.duration, args.round_trips)
+    finally:
+        shutil.rmtree(web_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
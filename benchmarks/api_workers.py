@@ -0,0 +1,147 @@
+"""
+Замер API-сервера с разным числом воркеров (API_WORKERS).
+Сервер запускается из копии api-server во временном каталоге с синтетическим реестром, клиенты в отдельных
+процессах в течение заданного времени отправляют GET /api/servers с фильтром и пагинацией.
+После замера проверяется, что лимит частоты записей одного IP общий для всех воркеров.
+
+Запуск: python benchmarks/api_workers.py [--hosts 5000] [--clients 8] [--duration 10] [--workers 1,2,4]
+Воркеры распределяют запросы по ядрам: при os.cpu_count() == 1 прироста пропускной способности нет.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent / "api-server"
+TOKEN = "benchmark"
+RATE_LIMIT_BURST = 20
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_registry(path: Path, hosts: int) -> None:
+    servers = [{
+        "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+        "session": f":{i % 4 + 1}",
+        "username": f"user{i % 997}",
+        "vnc_port": 5900 + i % 4,
+        "websockify_port": 6080 + i % 4,
+        "excluded": i % 50 == 0
+    } for i in range(hosts)]
+    path.write_text(json.dumps(servers))
+
+
+def start_server(root: Path, port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, API_SERVER_PORT=str(port), API_WORKERS=str(workers), API_AUTH_TOKEN=TOKEN,
+               TELEMETRY_MAX_HOSTS="0", RATE_LIMIT_RPS="0.01", RATE_LIMIT_BURST=str(RATE_LIMIT_BURST),
+               MAX_CONCURRENT_WRITES="64", READ_PRIORITY_THRESHOLD="1000", METRICS_UPDATE_INTERVAL="3600")
+    process = subprocess.Popen([sys.executable, "__main__.py"], cwd=root, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            status, _ = request(port, "GET", "/api/servers?limit=1")
+            if status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("API server did not start")
+
+
+def request(port: int, method: str, path: str, body: bytes = None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"} if body else {}
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def client(port: int, duration: float, seed: int, results) -> None:
+    latencies, errors = [], 0
+    stop = time.monotonic() + duration
+    n = seed
+    while time.monotonic() < stop:
+        n += 1
+        path = f"/api/servers?username=user{n % 997}&sort=ip&limit=50"
+        started = time.perf_counter()
+        try:
+            status, _ = request(port, "GET", path)
+        except OSError:
+            status = 0
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors += 1
+    results.put((latencies, errors))
+
+
+def admitted_writes(port: int) -> int:
+    """Сколько регистраций одного IP подряд допущено: при общем лимите - RATE_LIMIT_BURST при любом числе воркеров"""
+    admitted = 0
+    for i in range(RATE_LIMIT_BURST * 4):
+        body = json.dumps({"ip": "10.255.0.1", "session": ":1", "username": "bench", "vnc_port": 5901,
+                           "websockify_port": 6081}).encode()
+        status, _ = request(port, "POST", "/api/servers/register", body)
+        admitted += status != 429
+    return admitted
+
+
+def run(hosts: int, clients: int, duration: float, workers: int) -> None:
+    with tempfile.TemporaryDirectory(prefix="api-bench-") as tmp:
+        root = Path(tmp) / "api-server"
+        shutil.copytree(API_DIR, root, ignore=shutil.ignore_patterns("data", "__pycache__"))
+        (root / "data").mkdir()
+        make_registry(root / "data" / "servers.json", hosts)
+        port = free_port()
+        server = start_server(root, port, workers)
+        try:
+            results = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=client, args=(port, duration, i * 7919, results))
+                         for i in range(clients)]
+            for process in processes:
+                process.start()
+            collected = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            latencies = sorted(value for values, _ in collected for value in values)
+            errors = sum(count for _, count in collected)
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+            print(f"workers={workers}: {len(latencies) / duration:8.1f} req/s  p50={p50:6.1f} ms  "
+                  f"p99={p99:6.1f} ms  errors={errors}  admitted writes of one IP={admitted_writes(port)}"
+                  f"/{RATE_LIMIT_BURST}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hosts", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", default="1,2,4")
+    args = parser.parse_args()
+    print(f"CPU: {os.cpu_count()}, hosts: {args.hosts}, clients: {args.clients}, duration: {args.duration} s")
+    for workers in (int(value) for value in args.workers.split(",")):
+        run(args.hosts, args.clients, args.duration, workers)
+
+
+if __name__ == "__main__":
+    main()
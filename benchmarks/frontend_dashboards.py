@@ -0,0 +1,151 @@
+"""
+Нагрузочный тест веб-интерфейса: одновременные панели опрашивают frontend-server, запущенный
+с разным числом воркеров gunicorn (FRONTEND_WORKERS, 0 - отладочный сервер Flask).
+Frontend и API-сервер запускаются из копий во временном каталоге, реестр синтетический.
+Цикл панели: полный список серверов плиток, размеры списков и подбор качества видимых плиток.
+
+Запуск: python benchmarks/frontend_dashboards.py [--dashboards 50] [--hosts 2000] [--duration 10] [--workers 0,4]
+Воркеры распределяют запросы по ядрам: при os.cpu_count() == 1 прирост даёт только параллельное ожидание API.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from api_workers import free_port, make_registry, start_server as start_api
+
+FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend-server"
+TOKEN = "benchmark"
+# Видимые плитки панели: их качество подбирается по замерам нагрузки хостов
+VISIBLE_TILES = 16
+CYCLE = (
+    ("servers", "GET", "/api/servers?light=true&tile_mode=true", None),
+    ("lists", "GET", "/api/lists?counts=true", None),
+    ("quality", "POST", "/api/tiles/quality", lambda n: json.dumps({
+        "tiles": [f"10.0.{(n + i) >> 8 & 255}.{(n + i) & 255}" for i in range(VISIBLE_TILES)], "fps": 30})),
+)
+
+
+def request(port: int, method: str, path: str, body: str = None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        headers = {"Accept-Encoding": "gzip"}
+        if body:
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def start_frontend(root: Path, port: int, api_port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, FRONTEND_PORT=str(port), FRONTEND_WORKERS=str(workers), FRONTEND_THREADS="8",
+               API_SERVER_ADDR=f"127.0.0.1:{api_port}", API_AUTH_TOKEN=TOKEN)
+    process = subprocess.Popen([sys.executable, "__main__.py"], cwd=root, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if request(port, "GET", "/api/lists?counts=true")[0] == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("frontend-server did not start")
+
+
+def dashboards(port: int, count: int, first: int, duration: float, results) -> None:
+    """Панели одного процесса-клиента, каждая в своём потоке; в results - задержки по запросам и число ошибок"""
+    latencies = {name: [] for name, _, _, _ in CYCLE}
+    errors = [0]
+    stop = time.monotonic() + duration
+
+    def dashboard(n: int) -> None:
+        while time.monotonic() < stop:
+            for name, method, path, body in CYCLE:
+                started = time.perf_counter()
+                try:
+                    status, _ = request(port, method, path, body(n) if body else None)
+                except OSError:
+                    status = 0
+                if status == 200:
+                    latencies[name].append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=dashboard, args=(first + i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+
+def run(hosts: int, count: int, processes: int, duration: float, workers: int) -> None:
+    with tempfile.TemporaryDirectory(prefix="frontend-bench-") as tmp:
+        api_root = Path(tmp) / "api-server"
+        shutil.copytree(FRONTEND_DIR.parent / "api-server", api_root,
+                        ignore=shutil.ignore_patterns("data", "__pycache__"))
+        (api_root / "data").mkdir()
+        make_registry(api_root / "data" / "servers.json", hosts)
+        frontend_root = Path(tmp) / "frontend-server"
+        shutil.copytree(FRONTEND_DIR, frontend_root, ignore=shutil.ignore_patterns("data", "__pycache__"))
+        (frontend_root / "data").mkdir()
+
+        api_port, port = free_port(), free_port()
+        api = start_api(api_root, api_port, 1)
+        frontend = None
+        try:
+            frontend = start_frontend(frontend_root, port, api_port, workers)
+            results = multiprocessing.Queue()
+            share = [count // processes + (i < count % processes) for i in range(processes)]
+            clients = [multiprocessing.Process(target=dashboards, args=(port, n, sum(share[:i]) * VISIBLE_TILES,
+                                                                        duration, results))
+                       for i, n in enumerate(share) if n]
+            for client in clients:
+                client.start()
+            collected = [results.get() for _ in clients]
+            for client in clients:
+                client.join()
+        finally:
+            for process in (frontend, api):
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+
+    errors = sum(e for _, e in collected)
+    total = sum(len(values) for latencies, _ in collected for values in latencies.values())
+    cycles = min(sum(len(latencies[name]) for latencies, _ in collected) for name, _, _, _ in CYCLE)
+    print(f"workers={workers}: {total / duration:7.1f} req/s  {cycles / duration / count * 60:5.1f} "
+          f"cycles/min per dashboard  errors={errors}")
+    for name, _, _, _ in CYCLE:
+        values = sorted(v for latencies, _ in collected for v in latencies[name])
+        if values:
+            print(f"    {name:>8}: p50={values[len(values) // 2] * 1000:7.1f} ms  "
+                  f"p99={values[int(len(values) * 0.99)] * 1000:7.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dashboards", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=5, help="Процессов-клиентов, панели делятся между ними")
+    parser.add_argument("--hosts", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", default="0,4")
+    args = parser.parse_args()
+    print(f"CPU: {os.cpu_count()}, dashboards: {args.dashboards}, hosts: {args.hosts}, duration: {args.duration} s")
+    for workers in (int(value) for value in args.workers.split(",")):
+        run(args.hosts, args.dashboards, args.processes, args.duration, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
+import fcntl
+import gzip
 import requests
+from functools import partial
 from modules import config
-from flask import Flask, render_template, jsonify, request
+from modules.shards import ShardRouter
+from modules.quality import TileQualityController
+from modules.assets import AssetManifest
+from flask import Flask, Response, make_response, render_template, jsonify, request, url_for
 
 app = Flask(
     __name__,
@@ -9,7 +15,44 @@ app = Flask(
     static_url_path='/static'
 )
 
-API_BASE = f"http://{config.API_SERVER_ADDR}"
+# Шарды реестра (API_SHARDS) или единственный шард из узлов API_SERVER_ADDR
+shards = ShardRouter(config.API_SHARDS, config.API_SERVER_ADDR, float(config.API_TIMEOUT), str(config.CACHE_DIR))
+
+# Статические файлы с отпечатком содержимого в имени, кешируются браузером бессрочно
+try:
+    assets = AssetManifest(app.static_folder)
+except ValueError as e:
+    app.logger.warning(f"Static assets are served without fingerprints: {e}")
+    assets = None
+
+
+@app.template_global()
+def asset_url(name):
+    """URL статического файла: с отпечатком, если он есть, иначе обычный /static/"""
+    return (assets and assets.url(name)) or url_for('static', filename=name)
+
+
+@app.template_global()
+def module_preloads(name):
+    """URL модулей, импортируемых модулем name, для <link rel="modulepreload">"""
+    return assets.preloads(name) if assets else []
+
+
+# Подбор качества live-плиток (ADAPTIVE_QUALITY)
+quality = TileQualityController(
+    budget_kbps=float(config.TILE_BANDWIDTH_BUDGET),
+    target_fps=float(config.TILE_TARGET_FPS),
+    cpu_high=float(config.TILE_HOST_CPU_HIGH),
+    max_quality=int(config.VNC_FULLSCREEN_QUALITY),
+    max_scale=float(config.VNC_FULLSCREEN_SCALE),
+    compression=int(config.VNC_COMPRESSION),
+    max_live=int(config.MAX_LIVE_TILES)
+)
+
+# Фильтры GET /api/servers, передаваемые шардам как есть
+QUERY_PARAMS = ('excluded', 'reachable', 'username', 'ip', 'ip_prefix', 'list', 'sort', 'fields', 'telemetry')
+# Постраничная выдача: курсор - позиция в выдаче шарда, поэтому только при одном целевом шарде
+PAGE_PARAMS = ('limit', 'cursor')
 
 
 def get_auth_headers():
@@ -22,47 +65,187 @@ def get_auth_headers():
 @app.route('/')
 def index():
     cfg = config.to_dict()
-    return render_template('index.html', config=cfg)
+    # Страница ссылается на файлы с отпечатками, поэтому перепроверяется при каждой загрузке
+    response = make_response(render_template('index.html', config=cfg))
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/assets/<path:name>', methods=['GET'])
+def get_asset(name):
+    asset = assets.get(name) if assets else None
+    if asset is None:
+        return jsonify({"error": "Not found"}), 404
+    response = Response(asset.body, mimetype=asset.mimetype)
+    if asset.gzip is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        # Вариант gzip сжат один раз при запуске
+        response.set_data(asset.gzip)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 @app.route('/api/servers', methods=['GET'])
 def get_servers():
-    try:
-        params = {
-            'include_excluded': request.args.get('include_excluded') == 'true',
-            'light': request.args.get('light') == 'true',
-            'quality': 'low' if request.args.get('tile_mode') else 'medium'
-        }
-        resp = requests.get(f"{API_BASE}/api/servers", params=params)
-        return jsonify(resp.json()), resp.status_code
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    params = {
+        'include_excluded': request.args.get('include_excluded') == 'true',
+        'light': request.args.get('light') == 'true',
+        'quality': 'low' if request.args.get('tile_mode') else 'medium'
+    }
+    filters = {name: request.args[name] for name in QUERY_PARAMS if name in request.args}
+    params.update(filters)
+    # Хост с заданным IP хранится на одном шарде, остальные не опрашиваются
+    targets = [shards.shard_for(filters['ip'])] if 'ip' in filters else shards.shards
+    if len(targets) == 1:
+        params.update({name: request.args[name] for name in PAGE_PARAMS if name in request.args})
+
+    def fetch(shard):
+        resp = shard.request('GET', "/api/servers", params=params)
+        if resp.status_code != 400:  # Ошибка параметров запроса - не отказ шарда
+            resp.raise_for_status()
+        return resp
+
+    # Недоступный шард отдаёт последний полученный полный список, остальные шарды не ждут его
+    variant = tuple(sorted(params.items()))
+    cacheable = not filters and not any(name in params for name in PAGE_PARAMS)
+    if len(targets) == 1:
+        return relay_servers(targets[0], params, variant, cacheable)
+
+    servers, seen, failed, next_cursor = [], set(), [], None
+    for shard, (resp, error) in shards.fan_out({s: partial(fetch, s) for s in targets}).items():
+        if error is None and resp.status_code == 400:
+            return jsonify(resp.json()), 400
+        if error is None:
+            result = resp.json()
+            next_cursor = resp.headers.get('X-Next-Cursor')
+            if cacheable:
+                shard.remember(variant, resp.content)
+        else:
+            app.logger.warning(f"Shard {shard.name} failed: {error}")
+            failed.append(shard.name)
+            result = shard.recall(variant)
+        for server in result or []:
+            key = (server.get('ip'), server.get('session'))
+            if key not in seen:
+                seen.add(key)
+                servers.append(server)
+
+    if len(failed) == len(targets) and not servers:
+        return jsonify({"error": f"All shards failed: {', '.join(failed)}"}), 500
+    if 'sort' in filters and len(targets) > 1:
+        # Каждый шард упорядочил свою часть, общий порядок восстанавливается после слияния
+        servers.sort(key=partial(ShardRouter.sort_key, filters['sort']))
+    response = jsonify(servers)
+    if failed:
+        response.headers['X-Shards-Failed'] = ','.join(failed)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+
+def relay_servers(shard, params, variant, cacheable):
+    """
+    Список серверов единственного целевого шарда. Объединять нечего, поэтому тело ответа
+    (в gzip, если браузер его принимает) передаётся как есть, без разбора и повторного кодирования JSON.
+    """
+    def fetch():
+        resp = shard.request('GET', "/api/servers", params=params, headers={'Accept-Encoding': 'gzip'}, stream=True)
+        with resp:
+            if resp.status_code != 400:  # Ошибка параметров запроса - не отказ шарда
+                resp.raise_for_status()
+            return resp, resp.raw.read(decode_content=False)
+
+    (result, error), = shards.fan_out({shard: fetch}).values()
+    if error is not None:
+        app.logger.warning(f"Shard {shard.name} failed: {error}")
+        servers = shard.recall(variant)
+        if servers is None:
+            return jsonify({"error": f"All shards failed: {shard.name}"}), 500
+        response = jsonify(servers)
+        response.headers['X-Shards-Failed'] = shard.name
+        return response, 200
+
+    resp, body = result
+    if resp.status_code == 200 and cacheable:
+        shard.remember(variant, body)
+    compressed = resp.headers.get('Content-Encoding') == 'gzip'
+    if compressed and 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        body, compressed = gzip.decompress(body), False
+    response = Response(body, status=resp.status_code, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    if resp.headers.get('X-Next-Cursor'):
+        response.headers['X-Next-Cursor'] = resp.headers['X-Next-Cursor']
+    return response
+
+
+@app.route('/api/servers/search', methods=['GET'])
+def search_servers():
+    # Поиск выполняют все шарды, совпадения объединяются в общем порядке
+    params = dict(request.args)
+
+    def fetch(shard):
+        resp = shard.request('GET', "/api/servers/search", params=params)
+        if resp.status_code != 400:  # Ошибка параметров запроса - не отказ шарда
+            resp.raise_for_status()
+        return resp
+
+    servers, seen, failed = [], set(), []
+    for shard, (resp, error) in shards.fan_out({s: partial(fetch, s) for s in shards.shards}).items():
+        if error is None and resp.status_code == 400:
+            return jsonify(resp.json()), 400
+        if error is not None:
+            app.logger.warning(f"Shard {shard.name} failed: {error}")
+            failed.append(shard.name)
+            continue
+        for server in resp.json():
+            key = (server.get('ip'), server.get('session'))
+            if key not in seen:
+                seen.add(key)
+                servers.append(server)
+
+    if len(failed) == len(shards.shards):
+        return jsonify({"error": f"All shards failed: {', '.join(failed)}"}), 500
+    if len(shards.shards) > 1:
+        servers.sort(key=partial(ShardRouter.sort_key, params.get('sort', 'ip')))
+        if params.get('limit', '').isdigit():
+            servers = servers[:int(params['limit'])]
+    response = jsonify(servers)
+    if failed:
+        response.headers['X-Shards-Failed'] = ','.join(failed)
+    return response, 200
+
+
+def forward_ips(path):
+    """Рассылка изменения по списку IP шардам, которым принадлежат эти IP"""
+    data = request.json or {}
+    ips = data.get('ips') or ([data['ip']] if data.get('ip') else [])
+    calls = {
+        shard: partial(shard.request, 'POST', path, json={'ips': group}, headers=get_auth_headers())
+        for shard, group in shards.group(ips).items()
+    }
+    results = shards.fan_out(calls)
+    if len(results) == 1:
+        resp, error = next(iter(results.values()))
+        if error is not None:
+            return jsonify({"error": str(error)}), 500
+        return jsonify(resp.json() if resp.content else {"status": "ok"}), resp.status_code
+
+    failed = [shard.name for shard, (resp, error) in results.items() if error is not None or not resp.ok]
+    if failed:
+        return jsonify({"error": f"Failed on shards: {', '.join(failed)}"}), 500
+    return jsonify({"status": "ok"}), 200
 
 
 @app.route('/api/servers/exclude', methods=['POST'])
 def exclude_server():
-    try:
-        resp = requests.post(
-            f"{API_BASE}/api/servers/exclude",
-            json=request.json,
-            headers=get_auth_headers()
-        )
-        return jsonify(resp.json() if resp.content else {"status": "ok"}), resp.status_code
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    return forward_ips("/api/servers/exclude")
 
 
 @app.route('/api/servers/include', methods=['POST'])
 def include_server():
-    try:
-        resp = requests.post(
-            f"{API_BASE}/api/servers/include",
-            json=request.json,
-            headers=get_auth_headers()
-        )
-        return jsonify(resp.json() if resp.content else {"status": "ok"}), resp.status_code
-    except requests.RequestException as e:
-        return jsonify({"error": str(e)}), 500
+    return forward_ips("/api/servers/include")
 
 
 @app.route('/api/servers/check', methods=['GET'])
@@ -70,74 +253,186 @@ def check_server():
     try:
         ip = request.args.get('ip')
         ws_port = request.args.get('websockify_port')
-        resp = requests.get(f"{API_BASE}/api/servers/check", params={'ip': ip, 'port': ws_port})
+        # Проверку выполняет шард хоста, нагрузка проверок распределяется вместе с хостами
+        resp = shards.shard_for(ip).request('GET', "/api/servers/check", params={'ip': ip, 'port': ws_port})
         return jsonify(resp.json()), resp.status_code
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/api/lists', methods=['GET'])
-def get_lists():
+@app.route('/api/servers/telemetry', methods=['GET'])
+def get_telemetry():
     try:
-        lists = config.load_lists()
-        return jsonify(lists), 200
-    except Exception as e:
+        ip = request.args.get('ip', '')
+        # Замеры хоста хранятся на шарде, которому агент отправляет регистрацию
+        resp = shards.shard_for(ip).request('GET', "/api/servers/telemetry", params={'ip': ip})
+        return jsonify(resp.json()), resp.status_code
+    except requests.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/tiles/quality', methods=['POST'])
+def tile_quality():
+    # {"tiles": [ключ видимой плитки, ...], "columns": ..., "fps": ..., "pressure": ...}
+    data = request.json or {}
+    try:
+        keys = [str(key) for key in data.get('tiles') or []]
+        fps = float(data['fps']) if data.get('fps') is not None else None
+        pressure = int(data.get('pressure') or 0)
+        columns = int(data.get('columns') or TileQualityController.columns_for(len(keys)))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+
+    # Последние замеры нагрузки хостов хранят шарды, которым принадлежат хосты. Замеры не реплицируются:
+    # агент мог отправить их любой реплике шарда, поэтому опрашиваются все и берётся самый свежий замер
+    ips = sorted({key.split('|', 1)[0] for key in keys})
+    calls = {
+        shard: partial(shard.request_each, 'GET', "/api/servers/telemetry", params={'ips': ','.join(group)})
+        for shard, group in shards.group(ips).items()
+    }
+    load = {}
+    for shard, (responses, error) in shards.fan_out(calls).items():
+        for resp in responses if error is None else []:
+            if not resp.ok:
+                continue
+            for ip, sample in resp.json().items():
+                if load.get(ip) is None or (sample is not None and sample['ts'] > load[ip]['ts']):
+                    load[ip] = sample
+        if error is not None:
+            # Без замеров плитки шарда получают значения без учёта нагрузки хостов
+            app.logger.warning(f"Shard {shard.name} telemetry failed: {error}")
+    return jsonify(quality.choose(keys, load, columns, fps, pressure)), 200
+
+
+@app.route('/api/thumbnails/<path:target>', methods=['GET'])
+def get_thumbnail(target):
+    try:
+        headers = {}
+        if request.headers.get('If-None-Match'):
+            headers['If-None-Match'] = request.headers['If-None-Match']
+        ip = target.split('/', 1)[0]
+        resp = shards.shard_for(ip).request('GET', f"/api/thumbnails/{target}", headers=headers)
+        response = Response(resp.content, status=resp.status_code, content_type=resp.headers.get('Content-Type'))
+        if 'ETag' in resp.headers:
+            response.headers['ETag'] = resp.headers['ETag']
+        return response
+    except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.after_request
 def add_cache_headers(response):
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
     response.headers['X-Content-Type-Options'] = 'nosniff'
+    if request.path.startswith('/assets/') and response.status_code == 200:
+        # Имя файла меняется вместе с содержимым: браузер не перепроверяет его
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif request.path.startswith('/api/') and 'ETag' not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+    else:
+        # Страница, файлы /static/ без отпечатка и миниатюры перепроверяются по ETag
+        response.headers["Cache-Control"] = "no-cache"
     return response
 
 
-@app.after_request
-def add_headers(response):
-    if request.path.startswith('/static/'):
-        response.headers['Cache-Control'] = 'no-store, max-age=0'
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-    return response
+def update_list(action, list_name, servers):
+    """
+    Изменение списка на API-серверах: IP уходят шардам, которым они принадлежат,
+    создание и удаление списка - всем шардам. Реплики шарда получают изменение через журнал репликации.
+    """
+    groups = shards.group(servers) if servers else {shard: [] for shard in shards.shards}
+    calls = {
+        shard: partial(shard.request, 'POST', "/api/lists", headers=get_auth_headers(),
+                       json={'action': action, 'list_name': list_name, 'servers': group})
+        for shard, group in groups.items()
+    }
+    return [shard.name for shard, (resp, error) in shards.fan_out(calls).items() if error is not None or not resp.ok]
+
+
+def migrate_lists():
+    """
+    Перенос списков, которые хранил сам веб-интерфейс, на API-серверы (один раз).
+    Первые запросы могут прийти в несколько воркеров сразу: перенос выполняет один из них под flock.
+    Файл списков не меняется: о переносе говорит метка LISTS_MIGRATED в каталоге data/cache.
+    """
+    if config.LISTS_MIGRATED.exists() or not config.LISTS_FILE.exists():
+        return
+    config.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(config.LISTS_MIGRATED.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if config.LISTS_MIGRATED.exists():
+            return
+        for name, servers in config.load_lists().items():
+            if name == "All Servers":
+                continue
+            failed = update_list('add', name, servers)
+            if failed:
+                app.logger.warning(f"Lists migration failed on shards: {', '.join(failed)}")
+                return
+        config.LISTS_MIGRATED.touch()
+        app.logger.info("Lists migrated to the api-server")
 
 
 @app.route('/api/lists', methods=['GET', 'POST'])
 def handle_lists():
-    if request.method == 'GET':
-        try:
-            lists = config.load_lists()
-            return jsonify(lists), 200
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
-
     try:
-        data = request.json
-        action = data.get('action')
-        list_name = data.get('list_name')
-        servers = data.get('servers', [])
-
-        lists = config.load_lists()
-
-        if action == 'add':
-            if list_name not in lists:
-                lists[list_name] = []
-            for server in servers:
-                if server not in lists[list_name]:
-                    lists[list_name].append(server)
-        elif action == 'remove':
-            if list_name in lists:
-                if servers:
-                    lists[list_name] = [s for s in lists[list_name] if s not in servers]
-                else:
-                    del lists[list_name]
-
-        config.save_lists(lists)
-        return jsonify({"status": "ok"}), 200
+        migrate_lists()
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        app.logger.warning(f"Lists migration failed: {e}")
+
+    if request.method == 'POST':
+        data = request.json or {}
+        if not data.get('list_name') or data.get('action') not in ('add', 'remove'):
+            return jsonify({"error": "list_name and action add|remove are required"}), 400
+        failed = update_list(data.get('action'), data.get('list_name'), data.get('servers') or [])
+        if failed:
+            return jsonify({"error": f"Failed on shards: {', '.join(failed)}"}), 500
+        return jsonify({"status": "ok"}), 200
+
+    # GET: все списки, ?counts=true - размеры, ?ip= - списки хоста; каждый шард хранит свои IP.
+    # Недоступный шард, как и для списка серверов, отдаёт последний полученный ответ
+    params = dict(request.args)
+    variant = ('lists',) + tuple(sorted(params.items()))
+    results = shards.fan_out({s: partial(s.request, 'GET', "/api/lists", params=params) for s in shards.shards})
+    replies, failed = [], []
+    for shard, (resp, error) in results.items():
+        if error is None and resp.ok:
+            shard.remember(variant, resp.content)
+            replies.append(resp.json())
+            continue
+        app.logger.warning(f"Shard {shard.name} lists failed: {error or resp.status_code}")
+        failed.append(shard.name)
+        reply = shard.recall(variant)
+        if reply is not None:
+            replies.append(reply)
+
+    if len(failed) == len(shards.shards) and not replies:
+        return jsonify({"error": f"All shards failed: {', '.join(failed)}"}), 500
+    if 'ip' in params:
+        response = jsonify(sorted({name for reply in replies for name in reply}))
+    elif params.get('counts') == 'true':
+        merged = {"All Servers": 0}
+        for reply in replies:
+            for name, count in reply.items():
+                merged[name] = merged.get(name, 0) + count
+        response = jsonify(merged)
+    else:
+        merged = {"All Servers": []}
+        for reply in replies:
+            for name, ips in reply.items():
+                merged.setdefault(name, []).extend(ips)
+        response = jsonify(merged)
+    if failed:
+        response.headers['X-Shards-Failed'] = ','.join(failed)
+    return response, 200
 
 
 if __name__ == '__main__':
     port = int(config.FRONTEND_PORT)
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if int(config.FRONTEND_WORKERS) > 0:
+        from modules.server import FrontendServer
+        FrontendServer(app, port, int(config.FRONTEND_WORKERS), int(config.FRONTEND_THREADS),
+                       int(config.FRONTEND_MAX_REQUESTS), int(config.FRONTEND_GRACEFUL_TIMEOUT)).run()
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
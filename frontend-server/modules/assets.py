@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+
+# Текстовые файлы: в них переписываются ссылки на другие файлы и для них хранится вариант gzip
+TEXT_SUFFIXES = ('.js', '.css', '.html', '.svg', '.json')
+
+# Относительные импорты ES-модулей: from './x.js', import './x.js', import('./x.js')
+_IMPORT = re.compile(r"""(\bfrom\s*|\bimport\s*\(?\s*)(['"])(\.{1,2}/[^'"]+)\2""")
+# Относительные url() в CSS
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)(?![a-z]+:|/|#)([^'")?#]+)\1\s*\)""")
+# Абсолютные пути к статическим файлам в строках: fetch("/static/components/header.html")
+_STATIC = re.compile(r"""(['"(])/static/([^'"()?#\s]+)""")
+
+
+class Asset:
+    """Файл с отпечатком содержимого в имени, тело и сжатый вариант хранятся в памяти"""
+
+    def __init__(self, name, url, body, modules):
+        self.name = name
+        self.url = url
+        self.body = body
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        # Исходные имена ES-модулей, которые импортирует файл (для modulepreload)
+        self.modules = modules
+        self.gzip = None
+        if name.endswith(TEXT_SUFFIXES):
+            packed = gzip.compress(body, 9, mtime=0)
+            if len(packed) < len(body):
+                self.gzip = packed
+
+
+class AssetManifest:
+    """
+    Отпечатки статических файлов, вычисляемые при запуске без отдельной сборки.
+    Имя каждого файла дополняется хешем содержимого (grid.js -> grid.1a2b3c4d5e6f.js), ссылки
+    между файлами переписываются на такие имена, поэтому хеш файла меняется и при изменении
+    любого импортируемого им модуля. Такие файлы можно кешировать бессрочно.
+    """
+
+    def __init__(self, static_dir, prefix='/assets'):
+        """
+        Args:
+            static_dir: Каталог статических файлов
+            prefix: Путь URL, по которому отдаются файлы с отпечатком
+        Raises:
+            ValueError: Циклический импорт модулей (отпечаток модуля зависит от самого себя)
+        """
+        self.static_dir = Path(static_dir)
+        self.prefix = prefix
+        # Исходное имя -> файл; имя с отпечатком -> файл
+        self.by_name = {}
+        self.by_hashed = {}
+        self._building = []
+        for path in sorted(p for p in self.static_dir.rglob('*') if p.is_file()):
+            self._build(path.relative_to(self.static_dir).as_posix())
+
+    def _build(self, name):
+        """Файл с отпечатком (None, если файла нет); ссылки переписываются после обработки целей"""
+        if name in self.by_name:
+            return self.by_name[name]
+        if name in self._building:
+            cycle = self._building[self._building.index(name):] + [name]
+            raise ValueError(f"Circular reference: {' -> '.join(cycle)}")
+        path = self.static_dir / name
+        if not path.is_file():
+            return None
+
+        self._building.append(name)
+        try:
+            body, modules = path.read_bytes(), []
+            if name.endswith(TEXT_SUFFIXES):
+                body = self._rewrite(name, body.decode('utf-8'), modules).encode('utf-8')
+        finally:
+            self._building.pop()
+
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, dot, suffix = name.rpartition('.')
+        hashed = f"{stem}.{digest}.{suffix}" if dot and '/' not in suffix else f"{name}.{digest}"
+        asset = Asset(name, f"{self.prefix}/{hashed}", body, modules)
+        self.by_name[name] = self.by_hashed[hashed] = asset
+        return asset
+
+    def _rewrite(self, name, text, modules):
+        base = posixpath.dirname(name)
+
+        def replace(target, original):
+            if target.startswith('../') or target.startswith('/'):
+                return original
+            asset = self._build(target)
+            return asset.url if asset else original
+
+        def replace_import(match):
+            target = posixpath.normpath(posixpath.join(base, match.group(3)))
+            url = replace(target, match.group(3))
+            if url != match.group(3) and target.endswith('.js'):
+                modules.append(target)
+            return f"{match.group(1)}{match.group(2)}{url}{match.group(2)}"
+
+        def replace_css_url(match):
+            target = posixpath.normpath(posixpath.join(base, match.group(2).strip()))
+            return f"url({match.group(1)}{replace(target, match.group(2))}{match.group(1)})"
+
+        def replace_static(match):
+            url = replace(match.group(2), f"/static/{match.group(2)}")
+            return f"{match.group(1)}{url}"
+
+        if name.endswith('.js'):
+            text = _IMPORT.sub(replace_import, text)
+        elif name.endswith('.css'):
+            text = _CSS_URL.sub(replace_css_url, text)
+        return _STATIC.sub(replace_static, text)
+
+    def get(self, hashed):
+        """Файл по имени с отпечатком или None"""
+        return self.by_hashed.get(hashed)
+
+    def url(self, name):
+        """URL файла с отпечатком по исходному имени или None"""
+        asset = self.by_name.get(name)
+        return asset.url if asset else None
+
+    def preloads(self, name):
+        """URL всех модулей, которые транзитивно импортирует модуль: браузер загрузит их параллельно"""
+        seen, order, stack = {name}, [], list(reversed(self.by_name[name].modules)) if name in self.by_name else []
+        while stack:
+            module = stack.pop()
+            if module in seen:
+                continue
+            seen.add(module)
+            order.append(self.by_name[module].url)
+            stack.extend(reversed(self.by_name[module].modules))
+        return order
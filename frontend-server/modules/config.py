@@ -5,15 +5,49 @@ from pathlib import Path
 # The port of web-app
 FRONTEND_PORT = os.getenv('FRONTEND_PORT', "5000")
 
-# The port of api-server
+# Number of WSGI worker processes (gunicorn), 0 - Flask development server for debugging
+FRONTEND_WORKERS = os.getenv('FRONTEND_WORKERS', "4")
+
+# Threads per worker: requests mostly wait for api-servers
+FRONTEND_THREADS = os.getenv('FRONTEND_THREADS', "8")
+
+# Requests after which a worker is gracefully replaced (with up to 10% random jitter), 0 - never
+FRONTEND_MAX_REQUESTS = os.getenv('FRONTEND_MAX_REQUESTS', "10000")
+
+# Seconds a stopping or replaced worker has to finish its requests
+FRONTEND_GRACEFUL_TIMEOUT = os.getenv('FRONTEND_GRACEFUL_TIMEOUT', "30")
+
+# The address of api-server, several replicated nodes - comma-separated, tried in order
 API_SERVER_ADDR = os.getenv('API_SERVER_ADDR', "localhost:8080")
 
+# Timeout (in seconds) of a request to an api-server node before switching to the next one
+API_TIMEOUT = os.getenv('API_TIMEOUT', "5")
+
+# Registry shards: 'cidr|cidr=host:port,host:port;*=host:port', '*' - IPs outside the ranges by hash.
+# Empty - a single shard on API_SERVER_ADDR
+API_SHARDS = os.getenv('API_SHARDS', "")
+
 # Token for API validations
 API_AUTH_TOKEN = os.getenv("API_AUTH_TOKEN", "moneyprintergobrrr")
 
 # VNC-server password for the view-only mode
 VIEW_ONLY_PASS = os.getenv('VIEW_ONLY_PASS', "password")
 
+# Address (host:port) of the api-server VNC gateway for view-only tiles, empty - direct connection
+VNC_GATEWAY_ADDR = os.getenv('VNC_GATEWAY_ADDR', "")
+
+# Tile content: 'live' - noVNC stream per tile, 'thumbnail' - api-server snapshots (THUMBNAIL_INTERVAL)
+TILE_MODE = os.getenv('TILE_MODE', "live")
+
+# Interval (in seconds) between thumbnail refreshes in the grid
+THUMBNAIL_REFRESH = os.getenv('THUMBNAIL_REFRESH', "5")
+
+# Maximum number of tiles holding a live VNC connection at the same time
+MAX_LIVE_TILES = os.getenv('MAX_LIVE_TILES', "16")
+
+# Seconds an off-screen tile keeps its live connection before it is suspended
+LIVE_TILE_GRACE = os.getenv('LIVE_TILE_GRACE', "10")
+
 # VNC compression value
 VNC_COMPRESSION = os.getenv('VNC_COMPRESSION', '9')
 
@@ -29,9 +63,31 @@ VNC_FULLSCREEN_QUALITY = os.getenv('VNC_FULLSCREEN_QUALITY', "5")
 # VNC scale for fullscreen mode
 VNC_FULLSCREEN_SCALE = os.getenv('VNC_FULLSCREEN_SCALE', "0.8")
 
-# Lists storage
+# Pick tile quality, scale and compression at runtime from the visible tiles, host load and browser frame rate.
+# The VNC_TILE_* values are used until the first adjustment, the VNC_FULLSCREEN_* values are the upper bound
+ADAPTIVE_QUALITY = os.getenv('ADAPTIVE_QUALITY', "true")
+
+# Total bandwidth (in kbit/s) of all live tiles of one viewer
+TILE_BANDWIDTH_BUDGET = os.getenv('TILE_BANDWIDTH_BUDGET', "20000")
+
+# Browser frame rate below which tile quality and scale are lowered
+TILE_TARGET_FPS = os.getenv('TILE_TARGET_FPS', "20")
+
+# Host CPU load (in %) from which its tile switches to light compression
+TILE_HOST_CPU_HIGH = os.getenv('TILE_HOST_CPU_HIGH', "85")
+
+# Interval (in seconds) between tile quality adjustments
+ADAPTIVE_INTERVAL = os.getenv('ADAPTIVE_INTERVAL', "15")
+
+# Lists stored by the web-app itself before they moved to the api-server, migrated on first use
 LISTS_FILE = Path(__file__).parent.parent / 'data' / 'lists.json'
 
+# Last server lists received from each shard, shared by the workers and served while a shard is down
+CACHE_DIR = Path(__file__).parent.parent / 'data' / 'cache'
+
+# Marker of the one-time transfer of LISTS_FILE to the api-server (the file itself is left in place)
+LISTS_MIGRATED = CACHE_DIR / 'lists.migrated'
+
 
 def load_lists():
     try:
@@ -43,16 +99,6 @@ def load_lists():
         return {"All Servers": []}
 
 
-def save_lists(lists):
-    try:
-        LISTS_FILE.parent.mkdir(exist_ok=True)
-        with open(LISTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(lists, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving lists: {e}")
-        raise
-
-
 def to_dict() -> dict:
     """
     Return all UPPER‑CASE names from this module as a dict.
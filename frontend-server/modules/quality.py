@@ -0,0 +1,108 @@
+import math
+import time
+
+# Оценка трафика live-плитки (кбит/с) при качестве JPEG 0-9 для обычной активности рабочего стола
+QUALITY_KBPS = (120, 160, 210, 270, 340, 430, 540, 680, 860, 1100)
+
+# Допустимые масштабы плитки: масштаб подбирается под ширину колонки сетки
+SCALES = (0.25, 0.35, 0.5, 0.65, 0.8, 1.0)
+
+# Степень сжатия для хоста с перегруженным CPU: zlib с высокой степенью сжатия нагружает x11vnc
+LOADED_COMPRESSION = 2
+
+# Замер нагрузки старше этого (сек) не учитывается
+TELEMETRY_MAX_AGE = 120
+
+# Предел понижения качества из-за низкой частоты кадров браузера
+MAX_PRESSURE = 5
+
+
+class TileQualityController:
+    """
+    Выбор качества, масштаба и сжатия VNC для каждой live-плитки сетки.
+    Бюджет трафика зрителя делится между подключёнными плитками, качество понижается для хостов
+    с перегруженным CPU и для всех плиток, пока браузер не успевает отрисовывать кадры.
+    Лучшие значения плитки ограничены настройками полноэкранного режима.
+    """
+
+    def __init__(self, budget_kbps, target_fps, cpu_high, max_quality, max_scale, compression, max_live):
+        """
+        Args:
+            budget_kbps: Общий трафик всех плиток одного зрителя (кбит/с)
+            target_fps: Частота кадров страницы, ниже которой качество понижается
+            cpu_high: Загрузка CPU хоста (%), с которой его плитка переходит на лёгкое сжатие
+            max_quality: Наибольшее качество плитки (0-9)
+            max_scale: Наибольший масштаб плитки
+            compression: Степень сжатия для хостов без перегрузки (0-9)
+            max_live: Наибольшее число одновременно подключённых плиток (MAX_LIVE_TILES)
+        """
+        self.budget_kbps = budget_kbps
+        self.target_fps = target_fps
+        self.cpu_high = cpu_high
+        self.max_quality = min(max(int(max_quality), 0), len(QUALITY_KBPS) - 1)
+        self.max_scale = max_scale
+        self.compression = compression
+        self.max_live = max(max_live, 1)
+
+    def update_pressure(self, pressure, fps):
+        """
+        Уровень понижения качества по частоте кадров страницы у зрителя.
+        Уровень меняется на один шаг за вызов, а повышается только с запасом частоты,
+        чтобы качество не колебалось вокруг целевой частоты.
+        """
+        pressure = min(max(int(pressure), 0), MAX_PRESSURE)
+        if fps is None or self.target_fps <= 0:
+            return pressure
+        if fps < self.target_fps:
+            return min(pressure + 1, MAX_PRESSURE)
+        if fps >= self.target_fps * 1.5:
+            return max(pressure - 1, 0)
+        return pressure
+
+    def base_settings(self, tiles, columns, pressure):
+        """Значения плитки без учёта нагрузки её хоста"""
+        # Видимые плитки сверх MAX_LIVE_TILES ждут свободного слота и трафика не создают
+        share = self.budget_kbps / min(max(tiles, 1), self.max_live)
+        quality = 0
+        for level in range(self.max_quality, -1, -1):
+            if QUALITY_KBPS[level] <= share:
+                quality = level
+                break
+        quality = max(quality - pressure, 0)
+
+        # Плитка занимает 1/columns ширины экрана: больший масштаб браузер всё равно уменьшит
+        wanted = min(1.0 / max(columns, 1), self.max_scale)
+        notch = next((i for i, scale in enumerate(SCALES) if scale >= wanted), len(SCALES) - 1)
+        scale = min(SCALES[max(notch - pressure, 0)], self.max_scale)
+        return {"quality": quality, "scale": scale, "compression": self.compression}
+
+    def choose(self, keys, load, columns, fps=None, pressure=0):
+        """
+        Значения для видимых плиток зрителя.
+        Args:
+            keys: Ключи видимых плиток ('ip' или 'ip|session')
+            load: Последние замеры нагрузки по IP (может не быть или быть None)
+            columns: Число колонок сетки
+            fps: Измеренная частота кадров страницы или None
+            pressure: Текущий уровень понижения качества зрителя
+        Returns:
+            {"pressure": ..., "default": значения для новых плиток, "tiles": {ключ: значения}}
+        """
+        pressure = self.update_pressure(pressure, fps)
+        default = self.base_settings(len(keys), columns, pressure)
+        now = time.time()
+        tiles = {}
+        for key in keys:
+            sample = load.get(key.split('|', 1)[0])
+            settings = default
+            if sample and now - sample.get("ts", 0) <= TELEMETRY_MAX_AGE and sample.get("cpu", 0) >= self.cpu_high:
+                # Лёгкое сжатие увеличивает трафик, качество JPEG понижается, чтобы остаться в бюджете
+                settings = dict(default, quality=max(default["quality"] - 1, 0),
+                                compression=min(default["compression"], LOADED_COMPRESSION))
+            tiles[key] = settings
+        return {"pressure": pressure, "default": default, "tiles": tiles}
+
+    @staticmethod
+    def columns_for(tiles):
+        """Число колонок сетки для числа плиток, как в grid.js"""
+        return min(math.ceil(math.sqrt(max(tiles, 1))), 4)
@@ -0,0 +1,41 @@
+from gunicorn.app.base import BaseApplication
+
+
+class FrontendServer(BaseApplication):
+    """
+    Продакшен-сервер веб-интерфейса: gunicorn с процессами-воркерами и потоками в каждом (gthread).
+    Приложение создаётся до запуска воркеров и наследуется ими при fork. Поэтому при импорте
+    модулей не должно запускаться потоков: пулы запросов к шардам создают потоки при первом запросе уже в воркере.
+    """
+
+    def __init__(self, app, port, workers, threads, max_requests, graceful_timeout):
+        """
+        Args:
+            app: WSGI-приложение
+            port: Порт
+            workers: Число процессов-воркеров
+            threads: Число потоков воркера
+            max_requests: Число запросов, после которого воркер заменяется новым (0 - не заменяется)
+            graceful_timeout: Время (сек) на завершение начатых запросов останавливаемым воркером
+        """
+        self.application = app
+        self.options = {
+            'bind': f'0.0.0.0:{port}',
+            'workers': workers,
+            'worker_class': 'gthread',
+            'threads': threads,
+            # Разброс, чтобы воркеры, запущенные одновременно, не заменялись тоже одновременно
+            'max_requests': max_requests,
+            'max_requests_jitter': max_requests // 10,
+            'graceful_timeout': graceful_timeout,
+            # Соединения панелей, опрашивающих сервер каждые несколько секунд, не закрываются между запросами
+            'keepalive': 10,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
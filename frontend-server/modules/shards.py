@@ -0,0 +1,222 @@
+import gzip
+import hashlib
+import ipaddress
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import requests
+
+
+class Shard:
+    """Шард реестра: диапазоны IP и узлы API-сервера (реплики), на которых он хранится"""
+
+    # Одновременных запросов к шарду; свой пул у каждого шарда, чтобы зависший не занял чужие потоки
+    MAX_REQUESTS = 4
+
+    def __init__(self, name, networks, addresses, timeout, cache_dir=None):
+        self.name = name
+        self.networks = networks
+        self.bases = [f"http://{addr}" for addr in addresses]
+        self.timeout = timeout
+        # Узел последнего успешного запроса, с него начинается следующий
+        self.preferred = 0
+        # Последние полученные ответы шарда (списки серверов и списки хостов) по параметрам запроса,
+        # отдаются при его недоступности. Копия в cache_dir общая для процессов-воркеров:
+        # ответ есть и у воркера, который его не запрашивал
+        self.last_servers = {}
+        self.cache_dir = cache_dir
+        self._cached = {}
+        # Разобранные ответы recall: вариант -> (источник - тело в памяти или версия файла, данные)
+        self._recalled = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_REQUESTS, thread_name_prefix='shard')
+        # Запросы ко всем репликам сразу выполняются в отдельном пуле: вызов из self.executor не ждёт сам себя
+        self.replica_executor = ThreadPoolExecutor(max_workers=self.MAX_REQUESTS * len(self.bases),
+                                                   thread_name_prefix='replica')
+
+    def request(self, method, path, **kwargs):
+        """Запрос к шарду с переключением на следующую реплику при ошибке соединения"""
+        error = None
+        for offset in range(len(self.bases)):
+            index = (self.preferred + offset) % len(self.bases)
+            try:
+                resp = requests.request(method, f"{self.bases[index]}{path}", timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+            self.preferred = index
+            return resp
+        raise error
+
+    def request_each(self, method, path, **kwargs):
+        """
+        Параллельный запрос ко всем репликам шарда: для данных, которые узлы не реплицируют между собой.
+        Returns:
+            Ответы реплик, до которых удалось достучаться
+        Raises:
+            requests.RequestException: Не ответила ни одна реплика
+        """
+        if len(self.bases) == 1:
+            return [self.request(method, path, **kwargs)]
+        futures = [
+            self.replica_executor.submit(requests.request, method, f"{base}{path}", timeout=self.timeout, **kwargs)
+            for base in self.bases
+        ]
+        responses, error = [], None
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+        if not responses:
+            raise error
+        return responses
+
+    def _cache_file(self, variant):
+        key = hashlib.md5(f"{self.name}|{variant!r}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"servers-{key}.json")
+
+    def remember(self, variant, raw):
+        """
+        Сохранение полученного ответа - тела JSON (или gzip) как есть.
+        Файл переписывается, только если список изменился.
+        """
+        self.last_servers[variant] = raw
+        if self.cache_dir is None:
+            return
+        digest = hashlib.md5(raw).digest()
+        if self._cached.get(variant) == digest:
+            return
+        path = self._cache_file(variant)
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp_file, path)
+            self._cached[variant] = digest
+        except OSError:
+            pass  # Без файла остаётся копия в памяти воркера
+
+    def recall(self, variant):
+        """
+        Последний полученный любым воркером ответ или None.
+        Разобранный ответ хранится в памяти: файл читается и разбирается заново, только если его переписали.
+        """
+        source = self.last_servers.get(variant)
+        if self.cache_dir is not None:
+            try:
+                stat = os.stat(self._cache_file(variant))
+                source = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+        if source is None:
+            return None
+        cached = self._recalled.get(variant)
+        if cached is not None and (cached[0] is source or isinstance(source, tuple) and cached[0] == source):
+            return cached[1]
+
+        raw = source
+        if isinstance(source, tuple):
+            try:
+                with open(self._cache_file(variant), 'rb') as f:
+                    raw = f.read()
+            except OSError:
+                raw = source = self.last_servers.get(variant)
+                if raw is None:
+                    return None
+        try:
+            data = json.loads(gzip.decompress(raw) if raw[:2] == b'\x1f\x8b' else raw)
+        except (OSError, ValueError):
+            return None
+        self._recalled[variant] = (source, data)
+        return data
+
+
+class ShardRouter:
+    """
+    Распределение хостов по шардам API-сервера.
+    IP принадлежит шарду с самым длинным совпавшим диапазоном CIDR, остальные IP
+    распределяются rendezvous-хешем между шардами '*' (или всеми, если таких нет).
+    """
+
+    def __init__(self, spec, default_addr, timeout, cache_dir=None):
+        """
+        Args:
+            spec: Описание шардов 'cidr|cidr=host:port,host:port;*=host:port', пусто - один шард
+            default_addr: Узлы API-сервера через запятую для единственного шарда
+            timeout: Таймаут запроса к шарду (сек)
+            cache_dir: Каталог последних списков серверов шардов, общий для воркеров (None - только в памяти)
+        """
+        self.shards = []
+        for part in filter(None, (p.strip() for p in spec.split(';'))):
+            ranges, _, addresses = part.partition('=')
+            networks = [ipaddress.ip_network(r.strip(), strict=False)
+                        for r in ranges.split('|') if r.strip() and r.strip() != '*']
+            self.shards.append(Shard(ranges.strip(), networks, self._addresses(addresses), timeout, cache_dir))
+        if not self.shards:
+            self.shards.append(Shard('*', [], self._addresses(default_addr), timeout, cache_dir))
+
+        self.hashed = [s for s in self.shards if not s.networks] or self.shards
+
+    @staticmethod
+    def _addresses(value):
+        return [addr.strip() for addr in value.split(',') if addr.strip()]
+
+    def shard_for(self, ip):
+        """Шард, которому принадлежит хост"""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            address = None
+        best, best_prefix = None, -1
+        if address is not None:
+            for shard in self.shards:
+                for network in shard.networks:
+                    if address in network and network.prefixlen > best_prefix:
+                        best, best_prefix = shard, network.prefixlen
+        if best:
+            return best
+        return max(self.hashed, key=lambda s: hashlib.md5(f"{s.name}|{ip}".encode()).digest())
+
+    @staticmethod
+    def sort_key(sort, server):
+        """Ключ порядка sort=ip|username, как у API-сервера"""
+        ip = server.get('ip', '')
+        try:
+            number = int(ipaddress.ip_address(ip))
+        except ValueError:
+            number = -1
+        prefix = ((server.get('username') or ''),) if sort == 'username' else ()
+        return prefix + (number, ip, server.get('session', ''))
+
+    def group(self, ips):
+        """Разбиение списка IP по шардам"""
+        groups = {}
+        for ip in ips:
+            groups.setdefault(self.shard_for(ip), []).append(ip)
+        return groups
+
+    def fan_out(self, calls):
+        """
+        Параллельный вызов по шардам, у каждого шарда свой таймаут.
+        Args:
+            calls: {шард: функция без аргументов}
+        Returns:
+            {шард: (результат, None) или (None, исключение)}
+        """
+        started = time.monotonic()
+        futures = {shard: shard.executor.submit(call) for shard, call in calls.items()}
+        results = {}
+        for shard, future in futures.items():
+            # Отказ реплики может занять таймаут на каждой из них
+            deadline = started + shard.timeout * len(shard.bases)
+            try:
+                results[shard] = (future.result(timeout=max(0.0, deadline - time.monotonic())), None)
+            except TimeoutError:
+                future.cancel()  # Ещё не начатый запрос к перегруженному шарду не нужен
+                results[shard] = (None, TimeoutError(f"Shard {shard.name} timed out"))
+            except Exception as e:
+                results[shard] = (None, e)
+        return results
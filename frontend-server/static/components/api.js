@@ -1,18 +1,34 @@
-export async function fetchServers(includeExcluded = false) {
-  const url = includeExcluded ? '/api/servers?include_excluded=true' : '/api/servers';
-  const res = await fetch(url);
+// Фильтры выполняет API-сервер: excluded, reachable, username, ip, ip_prefix, sort, limit, cursor
+export async function fetchServers(includeExcluded = false, filters = {}) {
+  // Плиткам нужны только поля light, без процессов и прочих данных хоста
+  const params = new URLSearchParams({ light: 'true', ...filters });
+  if (includeExcluded) params.set('include_excluded', 'true');
+  const res = await fetch(`/api/servers?${params.toString()}`);
+  if (!res.ok) throw new Error(`Servers request failed: ${res.status}`);
+  // Хосты шарда без ответа показываются по последнему полученному списку
+  const failed = res.headers.get('X-Shards-Failed');
+  const label = document.getElementById('shard-status');
+  if (label) label.textContent = failed ? `Нет ответа от шардов: ${failed}` : '';
+  if (failed) console.warn(`Shards failed: ${failed}`);
+  return res.json();
+}
+
+// Поиск по пользователю или IP без учёта регистра (mode: prefix | substring)
+export async function searchServers(text, excluded = false, mode = 'substring') {
+  const params = new URLSearchParams({ q: text, mode, light: 'true', excluded: excluded ? 'true' : 'false' });
+  const res = await fetch(`/api/servers/search?${params.toString()}`);
+  if (!res.ok) throw new Error(`Search request failed: ${res.status}`);
   return res.json();
 }
 
 export async function excludeServers(ips) {
   try {
-    await Promise.all(ips.map(ip =>
-      fetch('/api/servers/exclude', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ ip })
-      })
-    ));
+    if (ips.length === 0) return;
+    await fetch('/api/servers/exclude', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ ips })
+    });
   } catch (err) {
     console.error("Error excluding servers:", err);
   }
@@ -20,18 +36,25 @@ export async function excludeServers(ips) {
 
 export async function includeServers(ips) {
   try {
-    await Promise.all(ips.map(ip =>
-      fetch('/api/servers/include', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ ip })
-      })
-    ));
+    if (ips.length === 0) return;
+    await fetch('/api/servers/include', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ ips })
+    });
   } catch (err) {
     console.error("Error including servers:", err);
   }
 }
 
+// Миниатюра экрана хоста; при неизменном ETag сервер отвечает 304 и браузер берёт её из кеша
+export async function fetchThumbnail(ip, session) {
+  const path = session ? `${ip}/${encodeURIComponent(session)}` : ip;
+  const res = await fetch(`/api/thumbnails/${path}`, { cache: 'no-cache' });
+  if (!res.ok) return null;
+  return { etag: res.headers.get('ETag'), blob: await res.blob() };
+}
+
 export async function checkHost(ip, port) {
   const res = await fetch(`/api/servers/check?ip=${ip}&websockify_port=${port}`);
   if (!res.ok) throw new Error("Check failed");
@@ -1,4 +1,4 @@
-import { fetchServers, excludeServers, includeServers } from './api.js';
+import { fetchServers, searchServers, excludeServers, includeServers } from './api.js';
 import { renderGrid } from './grid.js';
 import { showLoader, hideLoader } from './loader.js';
 import { showListManager, loadListSelector } from './lists.js';
@@ -34,6 +34,14 @@ function setupEventHandlers(config) {
   document.getElementById("showExcluded")
           .addEventListener("change", () => loadAndRender(config));
 
+  // Поиск выполняет API-сервер; запрос уходит после паузы в наборе
+  let searchTimer = null;
+  document.getElementById("host-search")
+          .addEventListener("input", () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => loadAndRender(config), 300);
+          });
+
   // Обработчики выделения
   document.getElementById("select-all")
           .addEventListener("click", selectAll);
@@ -136,16 +144,21 @@ async function loadAndRender(config) {
     const includeExcluded = document.getElementById("showExcluded").checked;
     const listName = document.getElementById("list-selector").value;
 
-    let servers = await fetchServers(includeExcluded);
-
-    if (listName !== "All Servers") {
-      const lists = await fetch('/api/lists').then(r => r.json());
-      const listServers = lists[listName] || [];
-      servers = servers.filter(server => listServers.includes(server.ip));
-    }
-
-    if (includeExcluded) {
-      servers = servers.filter(s => s.excluded);
+    const searchText = document.getElementById("host-search").value.trim();
+
+    // Хосты списка выбирает API-сервер, поиск внутри списка сужается его составом
+    const filters = { excluded: includeExcluded ? 'true' : 'false' };
+    if (listName !== "All Servers") filters.list = listName;
+
+    let servers;
+    if (searchText) {
+      servers = await searchServers(searchText, includeExcluded);
+      if (filters.list) {
+        const listIPs = new Set((await fetchServers(false, { ...filters, fields: 'ip' })).map(s => s.ip));
+        servers = servers.filter(server => listIPs.has(server.ip));
+      }
+    } else {
+      servers = await fetchServers(false, filters);
     }
 
     await renderGrid(servers, config);
@@ -188,4 +201,4 @@ async function checkCustomListsExist() {
     console.error("Error checking custom lists:", error);
     return false;
   }
-}
\ No newline at end of file
+}
\ No newline at end of file
@@ -1,17 +1,27 @@
 import { hideLoader } from './loader.js';
-import { checkHost, fetchServers } from './api.js';
+import { checkHost, fetchServers, fetchThumbnail } from './api.js';
+import { initStreams, observeTile, releaseTile, resetStreams } from './streams.js';
+import { settingsId, startQualityController, tileSettings } from './quality.js';
 
 const serverStates = new Map();
 
+// Ключ плитки: на одном хосте может быть несколько графических сессий
+export function serverKey(server) {
+  return server.session ? `${server.ip}|${server.session}` : server.ip;
+}
+
 export async function renderGrid(servers, config) {
   const grid = document.getElementById("hosts-grid");
   const n = servers.length || 1;
   const cols = Math.min(Math.ceil(Math.sqrt(n)), 4);
   grid.style.gridTemplateColumns = `repeat(${cols}, 1fr)`;
+  grid.dataset.columns = cols;
+  initStreams(config);
+  resetStreams();
   grid.innerHTML = '';
 
   servers.forEach(server => {
-    serverStates.set(server.ip, {
+    serverStates.set(serverKey(server), {
       username: server.username,
       excluded: server.excluded
     });
@@ -36,6 +46,14 @@ export async function renderGrid(servers, config) {
     startUpdateChecker(config);
   }
 
+  if (config.TILE_MODE === 'thumbnail' && !window.thumbnailRefresher) {
+    startThumbnailRefresher(config);
+  }
+
+  if (config.TILE_MODE !== 'thumbnail' && config.ADAPTIVE_QUALITY === 'true' && !window.qualityController) {
+    startQualityController(config);
+  }
+
   updateBulkButtons();
   hideLoader();
 }
@@ -46,14 +64,15 @@ function startUpdateChecker(config) {
       const currentServers = await fetchServers(true);
 
       for (const server of currentServers) {
-        const prevState = serverStates.get(server.ip);
+        const key = serverKey(server);
+        const prevState = serverStates.get(key);
 
         if (prevState && (
             prevState.username !== server.username ||
             prevState.excluded !== server.excluded
         )) {
-          updateTile(server.ip, config);
-          serverStates.set(server.ip, {
+          updateTile(key, config);
+          serverStates.set(key, {
             username: server.username,
             excluded: server.excluded
           });
@@ -65,25 +84,79 @@ function startUpdateChecker(config) {
   }, 5000);
 }
 
-function createTile(server, config) {
-  const tile = document.createElement("div");
-  tile.className = `tile ${server.excluded ? 'excluded' : ''}`;
-  tile.dataset.ip = server.ip;
+// Обновление всех миниатюр сетки; изображение меняется только при новом ETag
+function startThumbnailRefresher(config) {
+  window.thumbnailRefresher = setInterval(() => {
+    document.querySelectorAll('img.tile-thumb').forEach(refreshThumbnail);
+  }, Number(config.THUMBNAIL_REFRESH) * 1000);
+}
+
+async function refreshThumbnail(img) {
+  try {
+    const thumbnail = await fetchThumbnail(img.dataset.ip, img.dataset.session);
+    if (!thumbnail || thumbnail.etag === img.dataset.etag) return;
+    if (img.dataset.etag) URL.revokeObjectURL(img.src);
+    img.src = URL.createObjectURL(thumbnail.blob);
+    img.dataset.etag = thumbnail.etag;
+  } catch (err) {
+    console.warn(`Thumbnail update for ${img.dataset.ip} failed:`, err);
+  }
+}
 
+function createLiveFrame(server, config) {
   const iframe = document.createElement("iframe");
   iframe.loading = "lazy";
 
   iframe.src = getViewOnlyUrl(server, config);
+  // Значения, с которыми подключена плитка: при их смене поток переподключается
+  iframe.dataset.settings = settingsId(tileSettings(config, serverKey(server)));
 
   iframe.style.width = '100%';
   iframe.style.height = '100%';
   iframe.style.objectFit = 'cover';
+  return iframe;
+}
+
+// Миниатюра вместо live-потока; по щелчку плитка переключается на live-просмотр
+function createThumbnail(server, config) {
+  const img = document.createElement("img");
+  img.className = "tile-thumb";
+  img.alt = server.ip;
+  img.title = "Нажмите для просмотра в реальном времени";
+  img.dataset.ip = server.ip;
+  img.dataset.session = server.session || '';
+  img.addEventListener("click", () => {
+    if (img.dataset.etag) URL.revokeObjectURL(img.src);
+    img.replaceWith(createLiveFrame(server, config));
+  });
+  refreshThumbnail(img);
+  return img;
+}
+
+function createPlaceholder() {
+  const placeholder = document.createElement("div");
+  placeholder.className = "tile-placeholder";
+  placeholder.textContent = "Поток приостановлен";
+  return placeholder;
+}
+
+function createTile(server, config) {
+  const tile = document.createElement("div");
+  tile.className = `tile ${server.excluded ? 'excluded' : ''}`;
+  tile.dataset.ip = server.ip;
+  tile.dataset.key = serverKey(server);
+
+  const view = config.TILE_MODE === 'thumbnail'
+    ? createThumbnail(server, config)
+    : createPlaceholder();
 
   const footer = document.createElement("div");
   footer.className = "tile-footer";
 
   const label = document.createElement("span");
-  label.textContent = `${server.username} | host: ${server.ip}`;
+  label.textContent = server.session
+    ? `${server.username} | host: ${server.ip} (${server.session})`
+    : `${server.username} | host: ${server.ip}`;
 
   const right = document.createElement("div");
   right.className = "right";
@@ -105,9 +178,14 @@ function createTile(server, config) {
   right.appendChild(checkbox);
   footer.appendChild(label);
   footer.appendChild(right);
-  tile.appendChild(iframe);
+  tile.appendChild(view);
   tile.appendChild(footer);
 
+  // Live-поток подключается, только когда плитка попадает в область видимости
+  if (config.TILE_MODE !== 'thumbnail') {
+    observeTile(tile, view, () => createLiveFrame(server, config));
+  }
+
   return tile;
 }
 
@@ -123,40 +201,49 @@ function getManagementUrl(server, config, isFullscreen = false) {
   return `http://${server.ip}:${server.websockify_port}/vnc.html?${params.toString()}`;
 }
 
-// URL для режима просмотра
+// URL для режима просмотра; значения плитки подбирает quality.js
 function getViewOnlyUrl(server, config, isFullscreen = false) {
+  const tile = tileSettings(config, serverKey(server));
   const params = new URLSearchParams({
     password: config.VIEW_ONLY_PASS || '',
     autoconnect: 'true',
     resize: 'scale',
     view_only: 'true',
-    compression: config.VNC_COMPRESSION,
-    scale: isFullscreen ? config.VNC_FULLSCREEN_SCALE : config.VNC_TILE_SCALE,
-    quality: isFullscreen ? config.VNC_FULLSCREEN_QUALITY : config.VNC_TILE_QUALITY
+    compression: isFullscreen ? config.VNC_COMPRESSION : tile.compression,
+    scale: isFullscreen ? config.VNC_FULLSCREEN_SCALE : tile.scale,
+    quality: isFullscreen ? config.VNC_FULLSCREEN_QUALITY : tile.quality
   });
+  // Через шлюз хост отдаёт одно соединение VNC на всех зрителей
+  if (config.VNC_GATEWAY_ADDR && server.vnc_port) {
+    const [host, port] = config.VNC_GATEWAY_ADDR.split(':');
+    params.set('host', host);
+    params.set('port', port || '80');
+    params.set('path', server.session ? `${server.ip}/${server.session}` : server.ip);
+  }
   return `http://${server.ip}:${server.websockify_port}/vnc.html?${params.toString()}`;
 }
 
-export async function updateTile(ip, config) {
-  const tile = document.querySelector(`.tile[data-ip="${ip}"]`);
+export async function updateTile(key, config) {
+  const tile = document.querySelector(`.tile[data-key="${CSS.escape(key)}"]`);
   if (!tile) return;
 
   const scrollTop = tile.parentElement.scrollTop;
+  releaseTile(tile);
   const loader = document.createElement('div');
   loader.className = 'tile-loader';
   tile.innerHTML = '';
   tile.appendChild(loader);
 
   try {
-    const servers = await fetchServers(true);
-    const server = servers.find(s => s.ip === ip);
+    const servers = await fetchServers(true, { ip: key.split('|')[0] });
+    const server = servers.find(s => serverKey(s) === key);
     if (!server) throw new Error("Server not found");
 
     const newTile = createTile(server, config);
     tile.replaceWith(newTile);
     newTile.parentElement.scrollTop = scrollTop;
   } catch (error) {
-    console.error(`Error updating tile ${ip}:`, error);
+    console.error(`Error updating tile ${key}:`, error);
     tile.innerHTML = '<div class="tile-error">Ошибка обновления</div>';
   }
 }
@@ -176,4 +263,4 @@ function updateBulkButtons() {
     anyChecked ? "inline-block" : "none";
   document.getElementById("cancel-selection").style.display =
     anyChecked ? "inline-block" : "none";
-}
\ No newline at end of file
+}
\ No newline at end of file
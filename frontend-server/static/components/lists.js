@@ -209,7 +209,8 @@ export function showListManager(ips = [], action = 'manage', selectMode = false)
 export async function loadListSelector() {
   try {
     const selector = document.getElementById('list-selector');
-    const res = await fetch('/api/lists');
+    // Для выбора нужны только имена списков, их состав запрашивается вместе с хостами
+    const res = await fetch('/api/lists?counts=true');
     const lists = await res.json();
 
     selector.innerHTML = '';
@@ -222,4 +223,4 @@ export async function loadListSelector() {
   } catch (error) {
     console.error("Error loading lists:", error);
   }
-}
\ No newline at end of file
+}
\ No newline at end of file
@@ -0,0 +1,82 @@
+// Адаптивное качество live-плиток: раз в ADAPTIVE_INTERVAL секунд frontend-сервер подбирает
+// качество, масштаб и сжатие видимых плиток по их числу, нагрузке хостов и частоте кадров страницы.
+// Выбранные значения записываются в config, из которого grid.js строит URL плиток.
+
+import { reconnectTile, visibleTiles } from './streams.js';
+
+// Переподключений за одну корректировку: каждое стоит нового соединения и полного кадра
+const MAX_RECONNECTS = 4;
+
+// Уровень понижения качества из-за низкой частоты кадров, его ведёт сервер
+let pressure = 0;
+let frames = 0;
+let since = performance.now();
+
+function countFrames() {
+  frames++;
+  requestAnimationFrame(countFrames);
+}
+
+// Частота кадров страницы с прошлого замера (null для скрытой вкладки: браузер её не отрисовывает)
+function measureFps() {
+  const now = performance.now();
+  const fps = document.hidden ? null : frames * 1000 / (now - since);
+  frames = 0;
+  since = now;
+  return fps;
+}
+
+// Значения плитки: выбранные для неё, выбранные для новых плиток или из конфигурации
+export function tileSettings(config, key) {
+  return (config.TILE_SETTINGS && config.TILE_SETTINGS[key]) || config.TILE_DEFAULT || {
+    quality: config.VNC_TILE_QUALITY,
+    scale: config.VNC_TILE_SCALE,
+    compression: config.VNC_COMPRESSION
+  };
+}
+
+export function settingsId(settings) {
+  return `${settings.quality}/${settings.scale}/${settings.compression}`;
+}
+
+export function startQualityController(config) {
+  requestAnimationFrame(countFrames);
+  window.qualityController = setInterval(() => adjust(config), Number(config.ADAPTIVE_INTERVAL) * 1000);
+}
+
+async function adjust(config) {
+  const fps = measureFps();
+  const visible = visibleTiles();
+  if (!visible.length) return;
+
+  try {
+    const grid = document.getElementById('hosts-grid');
+    const res = await fetch('/api/tiles/quality', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        tiles: visible.map(({ tile }) => tile.dataset.key),
+        columns: Number(grid.dataset.columns) || null,
+        fps,
+        pressure
+      })
+    });
+    if (!res.ok) throw new Error(`Tile quality request failed: ${res.status}`);
+    const result = await res.json();
+    pressure = result.pressure;
+    config.TILE_SETTINGS = result.tiles;
+    config.TILE_DEFAULT = result.default;
+
+    // Подключённые плитки с изменившимися значениями переподключаются по несколько за раз
+    let reconnects = 0;
+    for (const { tile, live } of visible) {
+      if (reconnects >= MAX_RECONNECTS) break;
+      if (live && live.dataset.settings !== settingsId(tileSettings(config, tile.dataset.key))) {
+        if (reconnectTile(tile)) reconnects++;
+      }
+    }
+    if (reconnects) console.debug(`Tile quality adjusted: ${reconnects} reconnected, pressure ${pressure}`);
+  } catch (err) {
+    console.warn("Tile quality adjustment failed:", err);
+  }
+}
@@ -0,0 +1,123 @@
+// Live-потоки плиток: соединение VNC держат только плитки в области видимости,
+// одновременно не больше MAX_LIVE_TILES. Ушедшая с экрана плитка отключается
+// после LIVE_TILE_GRACE секунд и переподключается, когда снова станет видна.
+
+const tiles = new Map();
+let observer = null;
+let maxLive = 16;
+let graceMs = 10000;
+
+export function initStreams(config) {
+  maxLive = Math.max(1, Number(config.MAX_LIVE_TILES) || 16);
+  graceMs = Math.max(0, Number(config.LIVE_TILE_GRACE) || 0) * 1000;
+  if (!observer) {
+    observer = new IntersectionObserver(onIntersect, { rootMargin: '100px' });
+  }
+}
+
+// connect() создаёт элемент live-потока, placeholder показывается вместо него
+export function observeTile(tile, placeholder, connect) {
+  tiles.set(tile, { placeholder, connect, live: null, visible: false, timer: null });
+  observer.observe(tile);
+  updateStats();
+}
+
+export function releaseTile(tile) {
+  const state = tiles.get(tile);
+  if (!state) return;
+  observer.unobserve(tile);
+  clearTimeout(state.timer);
+  if (state.live) suspend(state);
+  tiles.delete(tile);
+  fillSlots();
+}
+
+export function resetStreams() {
+  for (const tile of Array.from(tiles.keys())) releaseTile(tile);
+}
+
+// Плитки в области видимости: их потоки подключены или подключатся при свободном слоте
+export function visibleTiles() {
+  return Array.from(tiles.entries())
+    .filter(([tile, state]) => state.visible && tile.isConnected)
+    .map(([tile, state]) => ({ tile, live: state.live }));
+}
+
+// Переподключение live-потока плитки с текущими настройками
+export function reconnectTile(tile) {
+  const state = tiles.get(tile);
+  if (!state || !state.live) return false;
+  const live = state.connect();
+  state.live.src = 'about:blank';
+  state.live.replaceWith(live);
+  state.live = live;
+  return true;
+}
+
+function onIntersect(entries) {
+  for (const entry of entries) {
+    const state = tiles.get(entry.target);
+    if (!state) continue;
+    state.visible = entry.isIntersecting;
+    if (state.visible) {
+      clearTimeout(state.timer);
+      state.timer = null;
+    } else if (state.live && !state.timer) {
+      state.timer = setTimeout(() => {
+        state.timer = null;
+        if (!state.visible && state.live) {
+          suspend(state);
+          fillSlots();
+        }
+      }, graceMs);
+    }
+  }
+  fillSlots();
+}
+
+function suspend(state) {
+  // Пустая страница закрывает WebSocket noVNC до удаления iframe
+  state.live.src = 'about:blank';
+  state.live.replaceWith(state.placeholder);
+  state.live = null;
+}
+
+// Подключение видимых плиток в порядке сетки, пока есть свободные слоты
+function fillSlots() {
+  let active = 0;
+  for (const [tile, state] of tiles) {
+    if (!tile.isConnected) {
+      observer.unobserve(tile);
+      clearTimeout(state.timer);
+      tiles.delete(tile);
+    } else if (state.live) {
+      active++;
+    }
+  }
+  for (const state of tiles.values()) {
+    if (active >= maxLive) break;
+    if (state.visible && !state.live) {
+      state.live = state.connect();
+      state.placeholder.replaceWith(state.live);
+      active++;
+    }
+  }
+  updateStats();
+}
+
+function updateStats() {
+  let active = 0;
+  for (const state of tiles.values()) {
+    if (state.live) active++;
+  }
+  const stats = { active, suspended: tiles.size - active, cap: maxLive };
+  const prev = window.streamStats;
+  window.streamStats = stats;
+  if (prev && prev.active === stats.active && prev.suspended === stats.suspended) return;
+
+  console.debug(`Live tiles: ${stats.active}/${stats.cap}, suspended: ${stats.suspended}`);
+  const label = document.getElementById('stream-stats');
+  if (label) {
+    label.textContent = `Live: ${stats.active}/${stats.cap}, приостановлено: ${stats.suspended}`;
+  }
+}